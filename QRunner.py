@@ -1,31 +1,209 @@
 #!/usr/bin/env python3
 
-import csv, re, sys, os, getpass, platform, subprocess, psutil, shlex
+import csv, re, sys, os, getpass, platform, shlex, time, heapq, signal, types
 
-import QRunnerTasksDatabase
+import QRunnerTasksDatabase, QRunnerReaper, QRunnerScheduler, QRunnerWorkerPool, QRunnerOutputStore, QRunnerSpawn, QRunnerConcurrency, QRunnerResources, QRunnerMetrics, QRunnerBatch, QRunnerCache, QRunnerHistory, QRunnerSubmit, QRunnerProgress, QRunnerAgent, QRunnerTemplate, QRunnerExtract
+
+# How function tasks can be run
+EXECUTORS = ['fork', 'process', 'thread']
+
+# Runs a command and leaves its exit status in the file named by $0 when it
+# ends, then ends the same way it did.
+MARKER_SCRIPT = '"$@"; s=$?; echo $s > "$0"; if [ $s -gt 128 ]; then kill -$((s - 128)) $$; fi; exit $s'
+
+class FakePopen:
+    '''Stands in for the Popen of a child we started ourselves, or of a function task on a pool worker.'''
+    def __init__(self, pid=None, returncode=None):
+        self.pid = pid
+        self.returncode = returncode
 
 class QRunner:
 
     def __exit__(self, exception_type, exception_value, traceback):
+        self.stop_listening()
+        self.close_agents()
         self.tdb.update()
+        self.close_pool()
+        self.close_output()
+        if self.cache is not None and self.cache_filename is not None:
+            self.cache.close()
+        if self.history is not None:
+            self.history.save()
+        if self.events is not None:
+            self.events.close()
+        self.reaper.close()
+        os.close(self.devnull)
 
     def __enter__(self):
         return self
 
-    def __init__(self, timeout=10, killtimeout=2, progress=None, max_tasks=64, **kwds):
+    def __init__(self, timeout=10, killtimeout=2, progress=None, max_tasks=64, group_barriers=True,
+                 executor='fork', workers=None, output_store=None, output_compress=False, output_max_bytes=None, spawn='posix_spawn', adaptive=False,
+                 resources=None, backfill=256, reserve_after=30, metrics=None, metrics_interval=5.0,
+                 batch=False, batch_seconds=0.5, max_batch=64, cache=None, history=None,
+                 shared=False, lease=60, shared_interval=1.0, listen=None, progress_interval=0.5,
+                 agents=None, agent_secret=None, markers=None, template_lookahead=1024, extractors=None, **kwds):
+        '''executor says how function tasks are run: 'fork' forks a child for each one, 'process'
+        runs them on a pool of forked workers and 'thread' on a pool of threads, with `workers' of them.
+
+        With output_store (e.g. "demo/output"), the output of tasks without an outputfile or errorfile is
+        collected through pipes into that QRunnerOutputStore rather than written to files of their own.
+
+        spawn says how commands are started: 'posix_spawn' where possible, or always 'popen'.
+
+        With adaptive=True, max_tasks is only where the limit starts: it is raised and lowered during the run
+        by a QRunnerConcurrency.AdaptiveConcurrency, which may also be passed in to set its floor, ceiling and log.
+
+        Tasks that declare cpus, mem_mb or slots only start when they fit in what the running tasks leave
+        of resources, a QRunnerResources.ResourceBudget (by default the whole host). Tasks behind one that
+        doesn't fit may go first, with up to `backfill' tasks that can't start yet passed over in the search
+        for them, until it has waited reserve_after seconds; then nothing more starts until it does.
+
+        With metrics (e.g. "demo/metrics"), a QRunnerMetrics snapshot of the run is written to metrics.json
+        and metrics.prom every metrics_interval seconds.
+
+        With batch=True, once tasks turn out to be short, ready commands that share a pwd are handed out in
+        batches of up to max_batch to QRunnerBatch workers, each of which runs its batch one task after
+        another in about batch_seconds and takes up one slot.
+
+        With cache (a file name, or a QRunnerCache.ResultCache to choose its size and environment variables), a
+        command that already succeeded in the same directory with the same input is marked FINISHED without
+        running it again, and its output files are written from the cache.
+
+        With history (a file name, or a QRunnerHistory.RuntimeHistory), how long tasks took is remembered
+        from one run to the next, and of the tasks of a group that are ready at once the ones expected to take
+        longest start first, so that a long task doesn't hold up the group by starting last. The priority
+        column, if there is one, comes before that.
+
+        With shared=True, other QRunners may be running the same tasks file at the same time, on this machine or
+        on others sharing the filesystem. Each claims ready tasks for itself before starting them, holding them
+        for `lease' seconds at a time (see QRunnerTasksDatabase), and takes in what the others have done every
+        shared_interval seconds. A runner keeps going until no task is left for any of them.
+
+        With listen (the path of a Unix domain socket, e.g. "qrunner.sock"), run() takes new tasks from
+        QRunnerSubmit clients as it runs, and keeps waiting for more once its tasks are done until a client
+        asks it to shut down.
+
+        progress is a function, called as progress(update_text=..., update_fields=...) for each task that
+        changed and progress(percentage=...), or a list of QRunnerProgress sinks. Changes are passed on in
+        batches at most every progress_interval seconds, each task once however often it changed.
+
+        With agents (a list of QRunnerAgent addresses, "host:port" or the path of a Unix domain socket), commands
+        whose host column names an agent (or is `*', for any agent) are run by the agents of that name rather
+        than here, each going to the one with the most free slots. They don't count against max_tasks. agent_secret
+        is the secret the agents ask for ($QRUNNER_AGENT_SECRET by default).
+
+        When run() starts, the tasks that an earlier run left running are sorted out: those whose process is still
+        running (the same process, by its pid_start) are taken over, and the others DIED. With markers (a directory),
+        each command is run under a shell that leaves its exit status in a marker file there, so that the commands
+        that ended while no QRunner was running get their exit status from it rather than DIED.
+
+        The tasks of TEMPLATE rows (see QRunnerTemplate) are added as they're needed, so that about
+        template_lookahead of them (or twice max_tasks, if that's more) are waiting to start at any time.
+
+        The stdout of a task with an extract or output_bytes column is read here as it comes (see QRunnerExtract),
+        and the fields found in it are put in columns of the task's row. An extract of @NAME names one of the
+        functions in extractors, a dict. This is for the tasks run here, not on an agent, a worker pool or in a batch.'''
+        if executor not in EXECUTORS:
+            raise Exception("Executor `{}' not recognised.".format(executor))
         self.timeout = timeout
         self.killtimeout = killtimeout
-        self.tdb = QRunnerTasksDatabase.QRunnerTasksDatabase(progress=progress, **kwds)
+        self.events = None
+        if progress is not None:
+            self.events = QRunnerProgress.ProgressEvents(progress, interval=progress_interval)
+        self.tdb = QRunnerTasksDatabase.QRunnerTasksDatabase(progress=self.events, shared=shared, lease=lease, **kwds)
         self.popens = {}
+        self.reaper = QRunnerReaper.Reaper()
+        # Heap of (when, pid, rownum, action) for tasks that have to be killed if they run too long. A pool or
+        # batch worker keeps its pid from one task to the next, so a deadline is only for the task in rownum.
+        self.deadlines = []
+        self.zombies = {}
         self.max_tasks = max_tasks
+        self.concurrency = None
+        if adaptive is True:
+            self.concurrency = QRunnerConcurrency.AdaptiveConcurrency(initial=max_tasks)
+        elif adaptive is not False and adaptive is not None:
+            self.concurrency = adaptive
+        if resources is None:
+            resources = QRunnerResources.ResourceBudget()
+        self.resources = resources
+        self.backfill = backfill
+        self.reserve_after = reserve_after
+        # When each task that didn't fit was first passed over, by rownum
+        self.passed_over = {}
+        self.group_barriers = group_barriers
+        self.scheduler = None
+        self.executor = executor
+        self.workers = workers
+        self.pool = None
+        # Function tasks running on a thread pool, which have no process ID
+        self.threads = {}
+        self.output_store = None
+        if output_store is not None:
+            self.output_store = QRunnerOutputStore.OutputStore(output_store, compress=output_compress,
+                                                               max_task_bytes=output_max_bytes)
+        # Output pipes being read: fd -> (rownum, stream, comment, where the output goes), which is
+        # QRunnerWorkerPool.CAPTURE for the output store, a file descriptor, or None to drop it
+        self.output_fds = {}
+        self.extractors = extractors or {}
+        # The QRunnerExtract.OutputFilters of the tasks whose stdout is read here, by rownum
+        self.filters = {}
+        self.output_reads = 0
+        # When each running task was launched, by rownum
+        self.launch_times = {}
+        self.metrics = None
+        if metrics is not None:
+            self.metrics = QRunnerMetrics.Metrics(metrics, interval=metrics_interval)
+        self.batcher = None
+        if batch is True:
+            self.batcher = QRunnerBatch.BatchSizer(seconds=batch_seconds, max_size=max_batch)
+        # Batch workers by the fd of their pipe
+        self.batches = {}
+        self.num_batches = 0
+        self.cache = cache
+        self.cache_filename = None
+        if isinstance(cache, str):
+            self.cache_filename = cache
+            self.cache = QRunnerCache.ResultCache(cache)
+        # Cache keys of the tasks that weren't in the cache, by rownum
+        self.cache_keys = {}
+        # Tasks to cache once their output has been collected in the output store, as (rownum, key)
+        self.cache_pending = []
+        self.history = history
+        if isinstance(history, str):
+            self.history = QRunnerHistory.RuntimeHistory(history)
+        self.shared_interval = shared_interval
+        self.next_refresh = 0
+        # Ready tasks that other runners have claimed, by rownum
+        self.elsewhere = {}
+        self.listen = listen
+        self.server = None
+        self.markers = markers
+        if markers is not None:
+            os.makedirs(markers, exist_ok=True)
+        # The pids of commands run under the marker shell, which lead their own process group
+        self.wrapped = {}
+        # Processes taken over from an earlier run, with their rownums
+        self.adopted = {}
+        self.template_lookahead = template_lookahead
+        # The templates whose tasks haven't all been added yet, in file order
+        self.templates = []
+        # Whether tasks have been submitted since the tasks file was last saved
+        self.submitted = False
+        self.agent_addresses = agents or []
+        self.agent_secret = agent_secret
+        self.agents = []
+        # Tasks running on an agent, by rownum
+        self.remote = {}
         self.progress = progress
-        self.original_cwd = None
+        self.spawner = QRunnerSpawn.Spawner(spawn)
+        self.devnull = os.open(os.devnull, os.O_RDWR)
         pass
 
     def _launch_task(self, t, comment='', status='INVALID', rownum=None, 
                              pid=None, rc=None, command=None, group=0, user=getpass.getuser(),
                              host=platform.node(), pwd=None, inputfile=None, outputfile=None,
-                             errorfile=None, function=None):
+                             errorfile=None, function=None, timeout=None, **kwds):
 
         if command == None and function == None:
             raise Exception("Cannot have a task with no command.")
@@ -43,74 +221,549 @@ The current user is `{}'.".format(getpass.getuser()))
 
         group = int(group)
 
-        if pwd != None:
-            if self.original_cwd is None:
-                self.original_cwd = os.getcwd()
-            else:
-                os.chdir(self.original_cwd)
-            pwd = os.path.expanduser(pwd)
+        try:
+            filt = self.output_filter(t)
+        except Exception as e:
+            # A bad extract or output_bytes (in a template, say) only fails the task it is in.
+            t['status'] = 'FAILED'
+            t['exception'] = str(e)
+            self.tdb.set_task(t, no_update=True)
+            self.task_ended(t)
+            return
+
+        # Nothing here changes the coordinator's directory; the task's
+        # directory and files are handed to the child instead.
+        d = self.spawner.directory(pwd)
+
+        inputfile, outputfile, errorfile = self.task_files(t['rownum'], group, comment, inputfile, outputfile, errorfile)
+        if self.output_store is not None and QRunnerWorkerPool.CAPTURE in [outputfile, errorfile]:
+            self.output_store.start(t['rownum'], comment)
+
+        if function is not None and self.pool is not None:
+            self._submit_task(t, pwd, d, inputfile, outputfile, errorfile, timeout)
+            return
+
+        # File descriptors for the child's stdin, stdout and stderr; the ones
+        # we open are closed again once it has started.
+        opened = []
+        if inputfile is None:
+            inputf = self.devnull
+        elif inputfile == '-':
+            inputf = 0
+        else:
             try:
-                os.chdir(pwd)
+                inputf = os.open(self.spawner.path(d, inputfile), os.O_RDONLY)
+                opened.append(inputf)
             except FileNotFoundError:
-                try:
-                    os.makedirs(pwd)
-                except OSError as e:
-                    if e.errno != errno.EEXIST:
-                        raise
-                os.chdir(pwd)
+                inputf = self.devnull
 
-        if inputfile == '-':
-            inputf=sys.stdin
-        if outputfile == '-':
-            outputf=sys.stdout
-        if errorfile == '-':
-            errorf=sys.stderr
+        # The read ends of the pipes for output going to the output store, or through the filter
+        pipes = {}
 
-        if inputfile is None:
-            inputfile = '{}-{}-{}.in.txt'.format(group, t['rownum'], comment)
+        for stream, name, fd in [('out', outputfile, 1), ('err', errorfile, 2)]:
+            if name == QRunnerWorkerPool.CAPTURE or (stream == 'out' and filt is not None):
+                pipes[stream], f = os.pipe()
+            elif name == '-':
+                sys.stdout.flush()
+                sys.stderr.flush()
+                f = fd
+            else:
+                f = os.open(self.spawner.path(d, name), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            if f != fd:
+                opened.append(f)
+            if stream == 'out':
+                outputf = f
+            else:
+                errorf = f
+
+        if timeout is None:
+            timeout = self.timeout
+        limits = []
+        need = self.resources.claims.get(t['rownum'])
+        if need is not None:
+            limits = self.resources.rlimits(need, timeout)
+
+        t['status'] = 'LAUNCHING'
+        self.tdb.set_task(t, no_update=True)
         try:
-            inputf = open(inputfile, "r")
-        except FileNotFoundError:
-            inputf = subprocess.DEVNULL
+            if command is not None:
+                argv = shlex.split(command)
+                if self.markers is not None:
+                    argv = ['/bin/sh', '-c', MARKER_SCRIPT, self.marker(t['rownum'])] + argv
+                pid = self.spawner.spawn(argv, cwd=d, stdin=inputf, stdout=outputf, stderr=errorf,
+                                         setsid=self.markers is not None, limits=limits)
+                if self.markers is not None:
+                    self.wrapped[pid] = True
+            elif function is not None:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    for f, fd in [(inputf, 0), (outputf, 1), (errorf, 2)]:
+                        if f != fd:
+                            os.dup2(f, fd)
+                    os.chdir(d)
+                    QRunnerResources.apply_rlimits(0, limits)
+                    # Leave without unwinding the coordinator's stack, which
+                    # would save the tasks database and close the reaper's
+                    # selector (shared with the parent) from the child.
+                    rc, result, exception = QRunnerWorkerPool.call_task(function)
+                    if result is not None:
+                        print(result)
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(rc)
+            else:
+                assert(False)
+        finally:
+            for f in opened:
+                os.close(f)
+        p = FakePopen(pid=pid)
+        t['pid_start'] = QRunnerReaper.start_time(pid)
+        for stream, fd in pipes.items():
+            os.set_blocking(fd, False)
+            dest = QRunnerWorkerPool.CAPTURE
+            if stream == 'out' and filt is not None:
+                self.filters[t['rownum']] = filt
+                if filt.keep_bytes == 0 and outputfile != QRunnerWorkerPool.CAPTURE:
+                    dest = None
+                elif outputfile == '-':
+                    dest = 1
+                elif outputfile != QRunnerWorkerPool.CAPTURE:
+                    dest = os.open(self.spawner.path(d, outputfile), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            self.output_fds[fd] = (t['rownum'], stream, comment, dest)
+            self.reaper.watch(fd, self._read_output)
+        t['pid'] = p.pid
+        self.popens[p.pid] = p
+        self.reaper.register(p.pid)
+        t['status'] = 'RUNNING'
+        self.task_started(t)
+        self.tdb.set_task(t, no_update=True)
+        self.done_tasks += 0.5
 
-        if outputfile is None:
-            outputfile = '{}-{}-{}.out.txt'.format(group, comment, t['rownum'])
-        outputf = open(outputfile, "w")
+        if timeout is not None and float(timeout) > 0:
+            self.add_deadline(float(timeout), p.pid, t['rownum'], 'KILLING')
 
+    def task_files(self, rownum, group, comment, inputfile, outputfile, errorfile, capture=None):
+        '''A task's input, output and error file names, with the defaults filled in; capture says whether
+        output goes to the output store by default, which it does if there is one.'''
+        if capture is None:
+            capture = self.output_store is not None
+        # With an output store, don't look for an input file nobody asked for.
+        if inputfile is None and capture is False:
+            inputfile = '{}-{}-{}.in.txt'.format(group, rownum, comment)
+        if outputfile is None:
+            outputfile = '{}-{}-{}.out.txt'.format(group, comment, rownum)
+            if capture is True:
+                outputfile = QRunnerWorkerPool.CAPTURE
         if errorfile is None:
-            errorfile = '{}-{}-{}.err.txt'.format(group, comment, t['rownum'])
-        errorf = open(errorfile, "w")
+            errorfile = '{}-{}-{}.err.txt'.format(group, comment, rownum)
+            if capture is True:
+                errorfile = QRunnerWorkerPool.CAPTURE
+        return inputfile, outputfile, errorfile
 
+    def batchable(self, t):
+        '''Whether a task can be run in a batch: a local command of the current user, writing to files and declaring no resources.'''
+        if self.batcher is None or self.output_store is not None or t.get('command') is None:
+            return False
+        if t.get('extract') is not None or t.get('output_bytes') is not None:
+            return False
+        if t['host'] not in [None, platform.node()] or t['user'] not in [None, getpass.getuser()]:
+            return False
+        for r in QRunnerResources.RESOURCES:
+            if t.get(r) is not None:
+                return False
+        return True
+
+    def start_batch(self, claim, tasks):
+        '''Hand tasks with the same pwd to a new batch worker, which takes up the resources claimed as `claim'.'''
+        d = self.spawner.directory(tasks[0]['pwd'])
+        jobs = []
+        for t in tasks:
+            files = self.task_files(t['rownum'], t['group'] or 0, t['comment'] or '', t['inputfile'], t['outputfile'], t['errorfile'])
+            jobs.append((t['rownum'], shlex.split(t['command'])) +
+                        tuple(name if name in [None, '-'] else self.spawner.path(d, name) for name in files))
+        b = QRunnerBatch.BatchWorker(d, jobs)
+        b.claim = claim
+        self.batches[b.fileno()] = b
+        self.reaper.watch(b.fileno(), self._batch_readable)
+
+    def _batch_readable(self, fd):
+        b = self.batches[fd]
+        for message in b.messages():
+            if message is None:
+                self._end_batch(b)
+                return
+            t = self.tdb.get_task(message[1])
+            if message[0] == 'started':
+                pid = message[2]
+                t['pid'] = pid
+                t['pid_start'] = QRunnerReaper.start_time(pid)
+                self.popens[pid] = FakePopen(pid=pid)
+                t['status'] = 'RUNNING'
+                self.task_started(t)
+                self.tdb.set_task(t, no_update=True)
+                self.done_tasks += 0.5
+                if self.metrics is not None:
+                    self.metrics.task_launched()
+                timeout = t.get('timeout')
+                if timeout is None:
+                    timeout = self.timeout
+                if timeout is not None and float(timeout) > 0:
+                    self.add_deadline(float(timeout), pid, message[1], 'KILLING')
+            elif message[0] == 'ended':
+                self.finished(message[2], message[3], rusage=message[4])
+                self.call_progress()
+            else:
+                t['status'] = 'FAILED'
+                t['exception'] = message[2]
+                self.tdb.set_task(t, no_update=True)
+                self.task_ended(t)
+
+    def _end_batch(self, b):
+        '''Clean up after a batch worker has gone, putting back any tasks it didn't get to.'''
+        del self.batches[b.fileno()]
+        self.reaper.unwatch(b.fileno())
+        b.close()
+        self.resources.release(b.claim)
+        if b.pid is not None and b.pid in self.popens:
+            # The worker died while running a task.
+            t = self.tdb.task_by_pid(b.pid)
+            del self.popens[b.pid]
+            self.zombies.pop(b.pid, None)
+            self.died(t)
+        for rownum in b.rownums:
+            self.scheduler.push_ready(rownum)
+
+    def connect_agents(self):
+        if len(self.agents) == 0 and len(self.agent_addresses) > 0:
+            self.agents = [QRunnerAgent.AgentConnection(a, self.reaper, self._agent_message, self.agent_secret)
+                           for a in self.agent_addresses]
+            self.tdb.add_column('agent')
+
+    def close_agents(self):
+        for a in self.agents:
+            a.close()
+
+    def remote_host(self, t):
+        '''Whether a task is to run on an agent.'''
+        return len(self.agents) > 0 and t.get('host') not in [None, platform.node()]
+
+    def agent_for(self, t):
+        '''The agent with the most free slots of those running tasks for the task's host, or None if they are all
+        busy. If they have all gone, one of them is returned anyway.'''
+        agents = [a for a in self.agents if t['host'] in ['*', a.name]]
+        if len(agents) == 0:
+            raise Exception("No agent runs tasks for host `{}'. The local host is `{}'.".format(t['host'], platform.node()))
+        agent = max(agents, key=lambda a: (a.sock is not None, a.free()))
+        if agent.sock is not None and agent.free() <= 0:
+            return None
+        return agent
+
+    def launch_remote(self, agent, t):
+        '''Send a command to an agent; it is RUNNING from then on, with no pid of ours.'''
+        if t.get('command') is None:
+            raise Exception("Only commands can run on another host, not functions.")
+        rownum = t[QRunnerTasksDatabase.ROWNUM_KEY]
+        files = self.task_files(rownum, t['group'] or 0, t['comment'] or '', t['inputfile'], t['outputfile'], t['errorfile'],
+                                capture=False)
+        timeout = t.get('timeout')
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None and float(timeout) > 0:
+            timeout = float(timeout)
+        else:
+            timeout = None
+        t['status'] = 'RUNNING'
+        t['agent'] = agent.address
+        self.task_started(t)
+        self.tdb.set_task(t, no_update=True)
+        self.done_tasks += 0.5
+        self.remote[rownum] = agent
+        agent.run(rownum, shlex.split(t['command']), t['pwd'], files, timeout, self.killtimeout)
+
+    def _agent_message(self, agent, message):
+        if message is None:
+            # The agent went away, and with it whatever became of its tasks.
+            for rownum in agent.tasks:
+                del self.remote[rownum]
+                self.launch_times.pop(rownum, None)
+                t = self.tdb.get_task(rownum)
+                t['status'] = 'DIED'
+                self.tdb.set_task(t, no_update=True)
+                self.task_ended(t)
+            return
+        if 'ended' in message:
+            t = self.tdb.get_task(message['ended'])
+            del self.remote[message['ended']]
+            if message['killed'] is not None:
+                t['status'] = message['killed']
+            rusage = types.SimpleNamespace(ru_utime=message['utime'], ru_stime=message['stime'], ru_maxrss=message['maxrss'])
+            self._finished(t, message['status'], rusage=rusage)
+            self.call_progress()
+        elif 'failed' in message:
+            t = self.tdb.get_task(message['failed'])
+            del self.remote[message['failed']]
+            self.launch_times.pop(message['failed'], None)
+            t['status'] = 'FAILED'
+            t['exception'] = message['exception']
+            self.tdb.set_task(t, no_update=True)
+            self.task_ended(t)
+
+    def forget_remote(self):
+        '''Mark DIED the tasks left running on agents by an earlier run; the agents stopped them when it went.'''
+        if 'agent' not in self.tdb.column:
+            return
+        for t in self.tdb.tasks_by_status('RUNNING'):
+            if t['pid'] is None and t.get('agent') is not None and self.mine(t) and t['rownum'] not in self.remote:
+                t['status'] = 'DIED'
+                self.tdb.set_task(t, no_update=True)
+
+    def priority(self, rownum):
+        '''The order in which ready tasks start: by group, then highest priority, then longest expected duration.
+        A priority that isn't a number counts as 0.'''
+        tdb = self.tdb
+        g = tdb.get_field(rownum, 'group')
+        try:
+            priority = float(tdb.get_field(rownum, 'priority') or 0)
+        except ValueError:
+            priority = 0.0
+        expected = 0.0
+        if self.history is not None:
+            expected = self.history.expected(tdb.get_field(rownum, 'command'), tdb.get_field(rownum, 'comment'))
+        return (g if g is not None and g > 0 else 0, -priority, -expected, rownum)
+
+    def cached(self, t):
+        '''Finish a command task from the result cache if it already succeeded; returns whether it did.'''
+        rownum = t[QRunnerTasksDatabase.ROWNUM_KEY]
+        if rownum in self.cache_keys:
+            return False
+        if t.get('extract') is not None or t.get('output_bytes') is not None:
+            # The cache has neither the fields nor all of the output.
+            return False
+        d = self.spawner.directory(t['pwd'])
+        comment = t['comment'] or ''
+        inputfile, outputfile, errorfile = self.task_files(rownum, t['group'] or 0, comment, t['inputfile'], t['outputfile'], t['errorfile'])
+        if inputfile == '-':
+            return False
+        key = self.cache.key(t['command'], d, None if inputfile is None else self.spawner.path(d, inputfile))
+        hit = self.cache.get(key)
+        if hit is None:
+            self.cache_keys[rownum] = key
+            return False
+        rc, stdout, stderr = hit
+        if QRunnerWorkerPool.CAPTURE in [outputfile, errorfile]:
+            self.output_store.start(rownum, comment)
+        for stream, name, data in [('out', outputfile, stdout), ('err', errorfile, stderr)]:
+            if name == QRunnerWorkerPool.CAPTURE:
+                if data is not None:
+                    self.output_store.write(rownum, stream, data, comment)
+                self.output_store.end(rownum, stream)
+            elif name != '-' and data is not None:
+                with open(self.spawner.path(d, name), 'wb') as f:
+                    f.write(data)
+        t['status'] = 'FINISHED'
+        t['rc'] = str(rc)
+        t['pid'] = None
+        t['ended'] = '{:.3f}'.format(time.time())
+        self.tdb.set_task(t, no_update=True)
+        self.done_tasks += 1
+        self.task_ended(t)
+        self.call_progress()
+        return True
+
+    def cache_result(self, t, key):
+        '''Keep the output of a task that succeeded in the result cache.'''
+        rownum = t[QRunnerTasksDatabase.ROWNUM_KEY]
+        d = self.spawner.directory(t['pwd'])
+        files = self.task_files(rownum, t['group'] or 0, t['comment'] or '', t['inputfile'], t['outputfile'], t['errorfile'])
+        if QRunnerWorkerPool.CAPTURE in files:
+            # Its output may still be on its way through the pipes.
+            self.cache_pending.append((rownum, key))
+            return
+        output = []
+        for name in files[1:]:
+            data = None
+            if name != '-':
+                try:
+                    with open(self.spawner.path(d, name), 'rb') as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    pass
+            output.append(data)
+        self.cache.put(key, t['command'], d, 0, output[0], output[1])
+
+    def cache_pending_results(self):
+        for rownum, key in self.cache_pending:
+            t = self.tdb.get_task(rownum)
+            self.cache.put(key, t['command'], self.spawner.directory(t['pwd']), 0,
+                           self.output_store.read(rownum, 'out'), self.output_store.read(rownum, 'err'))
+        self.cache_pending = []
+
+    def _submit_task(self, t, pwd, d, inputfile, outputfile, errorfile, timeout):
+        '''Run a function task on the worker pool, in directory d.'''
+        def path(name):
+            if name == '-':
+                return None
+            if name == QRunnerWorkerPool.CAPTURE:
+                return name
+            return self.spawner.path(d, name)
+        if inputfile is None:
+            inputfile = os.devnull
+        inputfile = path(inputfile)
+        if inputfile is not None and not os.path.exists(inputfile):
+            inputfile = os.devnull
         t['status'] = 'LAUNCHING'
         self.tdb.set_task(t, no_update=True)
-        if command is not None:
-            p = subprocess.Popen(shlex.split(command), stdin=inputf, stdout=outputf, stderr=errorf)
-        elif function is not None:
-            pid = os.fork()
-            if pid > 0:
-                class FakePopen:
-                    def __init__(self, pid=None, returncode=None):
-                        self.pid = pid
-                        self.returncode = returncode
-                p = FakePopen(pid=pid)
-            else:
-#                if inputf != sys.stdin:
-#                    os.dup2(inputf, 0)
-#                if outputf != sys.stdout:
-#                    os.dup2(outputf, 1)
-#                if errorf != sys.stderr:
-#                    os.dup2(outputf, 2)
-                sys.exit(function())
+        pid = self.pool.submit(t[QRunnerTasksDatabase.ROWNUM_KEY], pwd=d if pwd is not None else None,
+                               inputfile=inputfile, outputfile=path(outputfile), errorfile=path(errorfile))
+        if pid is None:
+            raise Exception("The worker pool is full.")
+        if pid is True:
+            self.threads[t[QRunnerTasksDatabase.ROWNUM_KEY]] = True
         else:
-            assert(False)
-        t['pid'] = p.pid
-        self.popens[p.pid] = p
+            t['pid'] = pid
+            self.popens[pid] = FakePopen(pid=pid)
         t['status'] = 'RUNNING'
+        self.task_started(t)
         self.tdb.set_task(t, no_update=True)
         self.done_tasks += 0.5
 
-        if self.original_cwd is not None:
-            os.chdir(self.original_cwd)
+        if timeout is None:
+            timeout = self.timeout
+        if pid is not True and timeout is not None and float(timeout) > 0:
+            self.add_deadline(float(timeout), pid, t[QRunnerTasksDatabase.ROWNUM_KEY], 'KILLING')
+
+    def start_pool(self):
+        if self.pool is None and self.executor != 'fork':
+            Pool = QRunnerWorkerPool.ProcessPool if self.executor == 'process' else QRunnerWorkerPool.ThreadPool
+            self.pool = Pool(self.tdb.functions, workers=self.workers, reaper=self.reaper)
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def pool_finished(self):
+        '''Record the function tasks the worker pool has finished.'''
+        if self.pool is None:
+            return
+        for rownum, pid, rc, result, exception, output in self.pool.completed():
+            if output is not None and self.output_store is not None:
+                comment = self.tdb.get_field(rownum, 'comment')
+                for stream, data in zip(QRunnerOutputStore.STREAMS, output):
+                    if data is not None:
+                        self.output_store.write(rownum, stream, data, comment)
+                        self.output_store.end(rownum, stream)
+            if pid is not None:
+                self.finished(pid, rc, result=result, exception=exception)
+            else:
+                del self.threads[rownum]
+                self._finished(self.tdb.get_task(rownum), rc, result=result, exception=exception)
+            self.call_progress()
+
+    def output_filter(self, t):
+        '''A QRunnerExtract.OutputFilter for a task with an extract or output_bytes column, or None.'''
+        if t.get('extract') is None and t.get('output_bytes') is None:
+            return None
+        extract = None
+        if t.get('extract') is not None:
+            extract = QRunnerExtract.compile_extract(t['extract'], self.extractors)
+        keep_bytes = None
+        if t.get('output_bytes') is not None:
+            try:
+                keep_bytes = int(t['output_bytes'])
+            except ValueError:
+                raise Exception("output_bytes should be a number of bytes, not `{}'.".format(t['output_bytes']))
+        return QRunnerExtract.OutputFilter(extract, keep_bytes)
+
+    def _read_output(self, fd):
+        '''Read what there is in an output pipe; returns whether there was anything.'''
+        rownum, stream, comment, dest = self.output_fds[fd]
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return False
+        self.output_reads += 1
+        if len(data) == 0:
+            self._close_output(fd)
+            return False
+        filt = self.filters.get(rownum) if stream == 'out' else None
+        if filt is not None:
+            data = filt.feed(data)
+            self.extracted(rownum, filt)
+        if len(data) == 0 or dest is None:
+            pass
+        elif dest == QRunnerWorkerPool.CAPTURE:
+            self.output_store.write(rownum, stream, data, comment)
+        else:
+            while len(data) > 0:
+                data = data[os.write(dest, data):]
+        return True
+
+    def _close_output(self, fd):
+        rownum, stream, comment, dest = self.output_fds.pop(fd)
+        self.reaper.unwatch(fd)
+        os.close(fd)
+        if stream == 'out' and rownum in self.filters:
+            filt = self.filters.pop(rownum)
+            filt.finish()
+            self.extracted(rownum, filt)
+        if dest == QRunnerWorkerPool.CAPTURE:
+            self.output_store.end(rownum, stream)
+        elif dest is not None and dest != 1:
+            os.close(dest)
+
+    def extracted(self, rownum, filt):
+        '''Put what a task's output filter has found since last time in its row.'''
+        if filt.changed is False:
+            return
+        filt.changed = False
+        t = self.tdb.get_task(rownum)
+        for k, v in filt.fields.items():
+            self.tdb.add_column(k)
+            t[k] = v
+        self.tdb.set_task(t, no_update=True)
+
+    def finish_output(self, t):
+        '''Read the rest of a task's stdout that is already in the pipe, and fill in t with what was found in it.'''
+        filt = self.filters.get(t[QRunnerTasksDatabase.ROWNUM_KEY])
+        if filt is None:
+            return
+        for fd, (rownum, stream, comment, dest) in list(self.output_fds.items()):
+            if rownum == t[QRunnerTasksDatabase.ROWNUM_KEY] and stream == 'out':
+                while fd in self.output_fds and self._read_output(fd):
+                    pass
+        t.update(filt.fields)
+        if filt.error is not None:
+            t['exception'] = filt.error
+
+    def drain_output(self):
+        '''Read what's left in the output pipes, giving up on any that stay open (e.g. held by a
+        task's background processes) with no output for killtimeout seconds.'''
+        while len(self.output_fds) > 0:
+            reads = self.output_reads
+            self.reap(self.killtimeout)
+            if self.output_reads == reads:
+                break
+        for fd in list(self.output_fds):
+            self._close_output(fd)
+
+    def close_output(self):
+        self.drain_output()
+        if self.output_store is not None:
+            self.output_store.close()
+
+    def read_output(self, rownum, stream='out'):
+        '''The output of a task kept in the output store, as bytes.'''
+        if self.output_store is None:
+            raise Exception('There is no output store.')
+        return self.output_store.read(rownum, stream)
+
+    def running(self):
+        '''The number of tasks taking up a slot, counting a batch between tasks as one.'''
+        between = sum(1 for b in self.batches.values() if b.pid is None)
+        return len(self.popens) + len(self.threads) - len(self.zombies) + between + len(self.remote)
 
     def launch_task(self, t):
         tt = {}
@@ -120,33 +773,39 @@ The current user is `{}'.".format(getpass.getuser()))
         self._launch_task(t, **tt)
 
     def done(self):
-        for t in self.tdb.tasks():
-            if t['status'] in ['NEW', 'LAUNCHING', 'RUNNING', 'KILLING', 'KILLING9']:
+        for status in ['NEW', 'LAUNCHING', 'RUNNING', 'KILLING', 'KILLING9', 'TEMPLATE']:
+            if self.tdb.count_by_status(status) > 0:
                 return False
         return True
 
+    def mine(self, t):
+        '''False if the task belongs to another runner sharing the tasks.'''
+        return self.tdb.shared is False or t.get('owner') == self.tdb.owner
+
     def check(self):
-        all_pids = psutil.pids()
-        # Check for tasks we think are still running but aren't
-        popens_c = self.popens.keys()
+        # Check for tasks we think are still running but aren't. Our own
+        # children are collected by the reaper in wait(). With shared tasks,
+        # list_pids() only has our own.
         for pid in self.tdb.list_pids():
-            if pid not in all_pids:
-                if pid not in popens_c:
-                    self.died(self.tdb.task_by_pid(pid))
-                else:
-                    # Check for tasks Popen got before our own os.wait().
-                    returncode = self.popens[pid].returncode
-                    if returncode is not None:
-                        self.finished(pid, returncode)
+            if pid not in self.popens and not self.reaper.is_alive(pid):
+                self.died(self.tdb.task_by_pid(pid))
 
         for t in self.tdb.tasks_by_status('LAUNCHING'):
+            if not self.mine(t):
+                continue
             t['status'] = 'FAILED'
             t['pid'] = None
             t['rc'] = None
             self.tdb.set_task(t)
+            self.task_ended(t)
         for t in self.tdb.tasks_by_status('KILLING9'):
             pid = t['pid']
-            if pid in all_pids:
+            if not self.mine(t):
+                continue
+            if pid in self.popens:
+                # Our own child; the reaper and the deadlines look after it.
+                continue
+            if self.reaper.is_alive(pid):
                 self.tdb.set_task_field(t, 'status', 'ZOMBIE')
             else:
                 t = dict(t)
@@ -154,67 +813,488 @@ The current user is `{}'.".format(getpass.getuser()))
                 t['pid'] = None
                 t['rc'] = -9
                 self.tdb.set_task(t)
+                self.task_ended(t)
         for t in self.tdb.tasks_by_status('LOST'):
-            raise Exception("I don't expect this to happen")
-            self.died(t)
+            if not self.mine(t):
+                # Its runner went away.
+                continue
+            self.recover_task(t)
 
     def died(self, t):
         pid = t['pid']
         if t['status'] != 'RUNNING':
             return
-        if pid in psutil.pids():
+        if self.reaper.is_alive(pid):
             t['status'] = 'LOST'
         else:
             t = dict(t)
             t['pid'] = None
             t['status'] = 'DIED'
         self.tdb.set_task(t)
+        if t['status'] == 'DIED':
+            self.task_ended(t)
+
+    def task_ended(self, t):
+        self.resources.release(t[QRunnerTasksDatabase.ROWNUM_KEY])
+        if self.scheduler is not None:
+            self.scheduler.task_ended(t[QRunnerTasksDatabase.ROWNUM_KEY])
 
-    def finished(self, pid, rc):
+    def task_started(self, t):
+        self.launch_times[t[QRunnerTasksDatabase.ROWNUM_KEY]] = time.monotonic()
+        t['started'] = '{:.3f}'.format(time.time())
+
+    def task_timings(self, t, rusage):
+        '''Fill in when a task ended, how long it took and, given its rusage, what it used; returns its duration.'''
+        started = self.launch_times.pop(t[QRunnerTasksDatabase.ROWNUM_KEY], None)
+        t['ended'] = '{:.3f}'.format(time.time())
+        duration = None
+        if started is not None:
+            duration = time.monotonic() - started
+            t['duration'] = '{:.3f}'.format(duration)
+        if rusage is not None:
+            t['utime'] = '{:.3f}'.format(rusage.ru_utime)
+            t['stime'] = '{:.3f}'.format(rusage.ru_stime)
+            # ru_maxrss is in kilobytes, except on macOS where it is in bytes.
+            t['maxrss_kb'] = str(rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss)
+        return duration
+
+    def finished(self, pid, rc, result=None, exception=None, rusage=None):
         t = self.tdb.task_by_pid(pid)
-        t = dict(t)
-        t['status'] = 'FINISHED'
+        del self.popens[pid]
+        self.zombies.pop(pid, None)
+        self.wrapped.pop(pid, None)
+        self._finished(t, rc, result=result, exception=exception, rusage=rusage)
+
+    def _finished(self, t, rc, result=None, exception=None, rusage=None):
+        '''Record the end of a task, given its wait status; the rc column gets its exit code, or minus the signal that ended it.'''
+        if t['status'] == 'KILLING':
+            t['status'] = 'KILLED'
+            t['rc'] = str(os.waitstatus_to_exitcode(rc))
+        elif t['status'] in ['KILLING9', 'ZOMBIE']:
+            t['status'] = 'KILLED9'
+            t['rc'] = '-9'
+        else:
+            t['status'] = 'FINISHED'
+            t['rc'] = str(os.waitstatus_to_exitcode(rc))
         t['pid'] = None
-        t['rc'] = str(rc)
+        t['pid_start'] = None
+        self.finish_output(t)
+        duration = self.task_timings(t, rusage)
+        key = self.cache_keys.pop(t[QRunnerTasksDatabase.ROWNUM_KEY], None)
+        if key is not None and t['status'] == 'FINISHED' and t['rc'] == '0':
+            self.cache_result(t, key)
+        if self.batcher is not None and duration is not None and t.get('command') is not None:
+            self.batcher.task_ended(duration)
+        if self.history is not None and duration is not None and t['status'] == 'FINISHED':
+            self.history.record(t.get('command'), t.get('comment'), duration)
+        if result is not None:
+            self.tdb.add_column('result')
+            t['result'] = repr(result)
+        if exception is not None:
+            t['exception'] = exception
         self.tdb.set_task(t, no_update=True)
-        del self.popens[pid]
         self.done_tasks += 0.5
+        if self.concurrency is not None:
+            self.concurrency.task_finished()
+        if self.metrics is not None:
+            self.metrics.task_ended(duration)
+        self.task_ended(t)
+
+    def kill(self, pid, sig):
+        '''Signal a task's process, and with the marker shell the command it runs.'''
+        try:
+            if pid in self.wrapped:
+                os.killpg(pid, sig)
+            else:
+                os.kill(pid, sig)
+        except ProcessLookupError:
+            # A process we took over that has just gone
+            pass
+
+    def marker(self, rownum):
+        return os.path.join(self.markers, str(rownum))
+
+    def read_marker(self, t):
+        '''The wait status a command run under the marker shell left behind, or None.'''
+        if self.markers is None or t.get('command') is None:
+            return None
+        try:
+            filename = self.marker(t[QRunnerTasksDatabase.ROWNUM_KEY])
+            # Not one left by an earlier run of the same row
+            if t.get('started') is not None and os.stat(filename).st_mtime < float(t['started']) - 1:
+                return None
+            with open(filename) as f:
+                rc = int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        if rc > 128:
+            return rc - 128
+        return rc << 8
+
+    def clear_markers(self):
+        if self.markers is None:
+            return
+        with os.scandir(self.markers) as entries:
+            for e in entries:
+                os.unlink(e.path)
+
+    def recover(self):
+        '''Sort out the tasks an earlier run left running, in one pass over them.'''
+        for status in ['RUNNING', 'KILLING', 'KILLING9', 'LOST']:
+            for t in self.tdb.tasks_by_status(status):
+                if t['pid'] is not None and t['pid'] not in self.popens and self.mine(t):
+                    self.recover_task(t)
+
+    def recover_task(self, t):
+        '''Take over a task's process if it is still running; otherwise it ended with what its marker says, or DIED.'''
+        pid = t['pid']
+        if t.get('pid_start') is not None:
+            running = QRunnerReaper.start_time(pid) == t['pid_start']
+        else:
+            running = self.reaper.is_alive(pid)
+        if running is True:
+            rownum = t[QRunnerTasksDatabase.ROWNUM_KEY]
+            self.popens[pid] = FakePopen(pid=pid)
+            self.adopted[pid] = rownum
+            self.reaper.adopt(pid)
+            # It takes up its share of slots, cpus and memory until task_ended() gives them back.
+            if rownum not in self.resources.claims:
+                self.resources.claim(rownum, self.resources.needs(t))
+            if self.markers is not None and t.get('command') is not None:
+                self.wrapped[pid] = True
+            if t['status'] == 'LOST':
+                t['status'] = 'RUNNING'
+                self.tdb.set_task(t, no_update=True)
+            elapsed = 0
+            if t.get('started') is not None:
+                elapsed = max(0, time.time() - float(t['started']))
+                self.launch_times[rownum] = time.monotonic() - elapsed
+            timeout = t.get('timeout')
+            if timeout is None:
+                timeout = self.timeout
+            if t['status'] == 'RUNNING' and timeout is not None and float(timeout) > 0:
+                self.add_deadline(max(0, float(timeout) - elapsed), pid, rownum, 'KILLING')
+            elif t['status'] == 'KILLING':
+                self.add_deadline(self.killtimeout, pid, rownum, 'KILLING9')
+            elif t['status'] == 'KILLING9':
+                self.add_deadline(self.killtimeout, pid, rownum, 'ZOMBIE')
+            return
+        self.ended_elsewhere(t)
+
+    def ended_elsewhere(self, t):
+        '''Record the end of a task whose process wasn't our child.'''
+        status = self.read_marker(t)
+        if status is not None:
+            self._finished(t, status)
+            return
+        self.launch_times.pop(t[QRunnerTasksDatabase.ROWNUM_KEY], None)
+        t['status'] = 'DIED'
+        t['pid'] = None
+        self.tdb.set_task(t, no_update=True)
+        self.task_ended(t)
+
+    def add_deadline(self, delay, pid, rownum, action):
+        heapq.heappush(self.deadlines, (time.monotonic() + delay, pid, rownum, action))
+
+    def deadline_task(self, pid, rownum):
+        '''The task a deadline is for, if its process is still running it; None otherwise.'''
+        if pid not in self.popens:
+            return None
+        t = self.tdb.task_by_pid(pid)
+        if t is None or t[QRunnerTasksDatabase.ROWNUM_KEY] != rownum:
+            return None
+        return t
+
+    def next_deadline(self):
+        '''Seconds until the earliest deadline of a task still running, or None if there isn't one.'''
+        while len(self.deadlines) > 0 and self.deadline_task(self.deadlines[0][1], self.deadlines[0][2]) is None:
+            heapq.heappop(self.deadlines)
+        if len(self.deadlines) == 0:
+            return None
+        return max(0, self.deadlines[0][0] - time.monotonic())
+
+    def expire_deadlines(self):
+        '''SIGTERM tasks that have run past their timeout, then SIGKILL them after killtimeout.'''
+        now = time.monotonic()
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            when, pid, rownum, action = heapq.heappop(self.deadlines)
+            t = self.deadline_task(pid, rownum)
+            if t is None:
+                continue
+            if action == 'KILLING' and t['status'] == 'RUNNING':
+                self.kill(pid, signal.SIGTERM)
+                self.add_deadline(self.killtimeout, pid, rownum, 'KILLING9')
+            elif action == 'KILLING9' and t['status'] == 'KILLING':
+                self.kill(pid, signal.SIGKILL)
+                self.add_deadline(self.killtimeout, pid, rownum, 'ZOMBIE')
+            elif action == 'ZOMBIE' and t['status'] == 'KILLING9':
+                # It survived SIGKILL; stop holding up the tasks that depend on it.
+                self.zombies[pid] = True
+            else:
+                continue
+            self.tdb.set_task_field(t, 'status', action)
+            if action == 'ZOMBIE':
+                self.task_ended(t)
+
+    def share(self):
+        '''Every shared_interval seconds, take in what the other runners sharing the tasks have done.'''
+        now = time.monotonic()
+        if now >= self.next_refresh:
+            self.tdb.refresh()
+            self.next_refresh = now + self.shared_interval
+            for i in list(self.elsewhere):
+                if self.tdb.claimable(i):
+                    # Its runner gave it back or went away.
+                    del self.elsewhere[i]
+                    self.scheduler.push_ready(i)
+        self.take_merged()
+
+    def take_merged(self):
+        '''Tell the scheduler about the tasks other runners have added or ended.'''
+        self.num_tasks += self.scheduler.sync()
+        for i in self.tdb.merged_rownums():
+            if self.tdb._status_key(self.tdb.get_field(i, 'status')) not in QRunnerScheduler.PENDING_STATUSES:
+                self.elsewhere.pop(i, None)
+                self.scheduler.task_ended(i)
+
+    def claim_ready(self, n):
+        '''Claim up to n ready tasks in one go, and put aside the ones other runners got first.'''
+        l = self.scheduler.next_tasks(n)
+        rownums = [t[QRunnerTasksDatabase.ROWNUM_KEY] for t in l if t.get('owner') != self.tdb.owner]
+        if len(rownums) > 0:
+            self.tdb.claim(rownums)
+        for t in l:
+            i = t[QRunnerTasksDatabase.ROWNUM_KEY]
+            if self.tdb.get_field(i, 'owner') == self.tdb.owner:
+                self.scheduler.push_ready(i)
+            else:
+                self.elsewhere[i] = None
+        self.take_merged()
+
+    def others_running(self):
+        '''True if other runners sharing the tasks have tasks running or claimed.'''
+        if self.tdb.shared is False:
+            return False
+        return len(self.elsewhere) > 0 or any(self.tdb.count_by_status(s) > 0 for s in QRunnerTasksDatabase.RUNNING_STATUSES)
+
+    def submit(self, task):
+        '''Add a task while running, for a QRunnerSubmit client; returns its rownum.'''
+        if self.tdb.loading() is True or len(self.templates) > 0:
+            raise Exception("Tasks can only be added once the tasks file has been read and the templates' tasks added.")
+        task = dict(task)
+        task.setdefault('status', 'NEW')
+        if task.get('group') == '':
+            task['group'] = None
+        if task.get('group') is not None:
+            task['group'] = int(task['group'])
+        self.scheduler.check_task(task.get('comment'), task.get('group'), task.get('depends_on'))
+        self.tdb.add_task(**task)
+        # Saved by the next pass of wait(), once for all the tasks submitted meanwhile.
+        self.submitted = True
+        self.num_tasks += self.scheduler.sync()
+        return self.tdb.num_tasks() - 1
+
+    def listening(self):
+        '''True while clients may still add tasks.'''
+        return self.server is not None and self.server.stopped is False
+
+    def stop_listening(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    def load_more(self):
+        '''Read the next chunk of a streamed tasks file, or add more of the templates' tasks, and hand
+        them to the scheduler.'''
+        if self.tdb.loading() is True:
+            self.tdb.load_more()
+            self.num_tasks += self.scheduler.sync()
+            if self.tdb.loading() is False:
+                self.find_templates()
+                if len(self.templates) == 0:
+                    self.scheduler.close()
+            return
+        if len(self.templates) > 0:
+            waiting = self.scheduler.pending() - self.running()
+            self.expand_templates(max(self.template_lookahead, 2 * self.max_tasks) - waiting)
+
+    def find_templates(self):
+        '''Take up the templates whose tasks haven't all been added yet.'''
+        rownums = [t[QRunnerTasksDatabase.ROWNUM_KEY] for t in self.tdb.tasks_by_status('TEMPLATE')]
+        if len(rownums) > 0 and self.tdb.shared is True:
+            raise Exception("Runners sharing the tasks can't add the tasks of templates.")
+        basedir = os.getcwd()
+        if self.tdb.storage.filename is not None:
+            basedir = os.path.dirname(self.tdb.storage.filename)
+        self.templates = [QRunnerTemplate.TaskTemplate(self.tdb, i, basedir) for i in rownums]
+
+    def expand_templates(self, n):
+        '''Add up to n more of the templates' tasks.'''
+        while n > 0 and len(self.templates) > 0:
+            template = self.templates[0]
+            g = template.group(template.expanded)
+            if g is not None and g > 0 and self.scheduler.last_group is not None and g < self.scheduler.last_group:
+                raise Exception("The tasks of template `{}' would go in group {}, after group {}; a template's groups have to come after the others."
+                                .format(template.task['comment'], g, self.scheduler.last_group))
+            n -= template.expand(n)
+            if template.done is True:
+                self.templates.pop(0)
+            self.num_tasks += self.scheduler.sync()
+        if len(self.templates) == 0:
+            self.scheduler.close()
 
     def wait(self):
-        pids_to_wait = {}
-        for pid in self.tdb.list_pids():
-            pids_to_wait[pid] = True
-        more_tasks = True
-        while len(pids_to_wait) > 0:
-            try:
-                pid, rc = os.wait()
-            except ChildProcessError:
+        while True:
+            self.load_more()
+            if self.running() <= 0:
+                # Everything may have been launched at once, so only stop
+                # if nothing is running afterwards.
+                self.launch()
+                if self.running() <= 0:
+                    if self.tdb.loading() is True:
+                        continue
+                    if len(self.templates) > 0:
+                        # Whatever is waiting needs more of the templates' tasks first.
+                        self.expand_templates(self.template_lookahead)
+                        continue
+                    if self.listening() is False:
+                        if self.others_running() is False:
+                            break
+                        # Wait to see what the other runners leave to do.
+                        time.sleep(self.shared_interval)
+                        continue
+            timeout = self.next_deadline()
+            if self.concurrency is not None and self.running() >= self.max_tasks:
+                # Wake up in time to see whether there is room for more.
+                wakeup = self.concurrency.next_update()
+                if timeout is None or wakeup < timeout:
+                    timeout = wakeup
+            if self.metrics is not None:
+                wakeup = self.metrics.next_write()
+                if timeout is None or wakeup < timeout:
+                    timeout = wakeup
+            if self.tdb.shared is True:
+                wakeup = max(0, self.next_refresh - time.monotonic())
+                if timeout is None or wakeup < timeout:
+                    timeout = wakeup
+            if self.events is not None:
+                wakeup = self.events.next_flush()
+                if wakeup is not None and (timeout is None or wakeup < timeout):
+                    timeout = wakeup
+            if self.tdb.loading() is True:
+                timeout = 0
+            if self.tdb.storage.incremental is True or self.submitted is True:
+                # Cheap enough to keep the file up to date, for a restart to pick up from. Saved
+                # before waiting, so that the tasks just launched are on record while they run.
+                self.tdb.persist()
+                self.submitted = False
+            self.reap(timeout)
+            self.expire_deadlines()
+            self.launch()
+            self.write_metrics()
+            self.call_progress()
+
+    def reap(self, timeout):
+        '''Wait up to timeout seconds for tasks to end, and record the ones that have.'''
+        for pid, rc, rusage in self.reaper.poll(timeout):
+            if rc is None and pid in self.adopted:
+                # Not our child, so its exit status is only in its marker, if anywhere.
+                del self.adopted[pid]
+                del self.popens[pid]
+                self.zombies.pop(pid, None)
+                self.wrapped.pop(pid, None)
+                self.ended_elsewhere(self.tdb.task_by_pid(pid))
+                self.call_progress()
+                continue
+            if rc is None:
                 # Popen managed to call wait before we did
-                for pid2 in pids_to_wait:
-                    if pid2 in self.popens:
-                        self.finished(pid, self.popens[pid].returncode)
-                    else:
-                        raise Exception("Process ID {} inexplicably never returned.".format(pid))
+                rc = self.popens[pid].returncode
+                if rc is None:
+                    raise Exception("Process ID {} inexplicably never returned.".format(pid))
+            else:
+                self.popens[pid].returncode = rc
+            self.finished(pid, rc, rusage=rusage)
             self.call_progress()
-            if pid not in pids_to_wait:
-                raise Exception("Did not have process ID {} in my list".format(pid))
-            self.finished(pid, rc)
-#            del pids_to_wait[pid]
-            if more_tasks is True:
-                more_tasks = self.launch()
-            pids_to_wait = {}
-            for pid in self.tdb.list_pids():
-                pids_to_wait[pid] = True
+        self.pool_finished()
 
     def launch(self):
+        '''Launch ready tasks into the free slots; returns False once no task is left to launch.'''
         self.check()
-        cur_tasks = len(self.tdb.list_pids())
-        l = self.tdb.tasks_by_status('NEW')
-        if len(l) < 1:
-            return False
-        for i, t in enumerate(l):
-            if (i + cur_tasks) > self.max_tasks:
-                return True
+        if self.concurrency is not None:
+            self.max_tasks = self.concurrency.update(self.running())
+        if self.tdb.shared is True:
+            self.share()
+        now = time.monotonic()
+        deferred = []
+        size = 1
+        if self.batcher is not None:
+            size = self.batcher.size(len(self.scheduler.ready), self.resources.free_slots(self.max_tasks))
+        if self.tdb.shared is True:
+            self.claim_ready(int(self.resources.free_slots(self.max_tasks)) * size)
+        # The batches being filled, by pwd, as (claim, tasks)
+        batches = {}
+        started = []
+        # Only the tasks put back count against backfill, so that as many start as there is room for.
+        while len(deferred) < self.backfill * size:
+            full = self.resources.free_slots(self.max_tasks) <= 0
+            if full is True and not any(len(tasks) < size for claim, tasks in batches.values()):
+                if not any(a.free() > 0 for a in self.agents):
+                    break
+            l = self.scheduler.next_tasks(1)
+            if len(l) == 0:
+                break
+            t = l[0]
+            rownum = t[QRunnerTasksDatabase.ROWNUM_KEY]
+            if not self.mine(t):
+                # The tasks claimed for this launch have all been seen.
+                deferred.append(rownum)
+                break
+            if self.cache is not None and t.get('command') is not None and self.cached(t):
+                continue
+            if self.remote_host(t):
+                agent = self.agent_for(t)
+                if agent is None:
+                    deferred.append(rownum)
+                    continue
+                if agent.sock is None:
+                    t['status'] = 'FAILED'
+                    t['exception'] = "The agents for host `{}' have gone.".format(t['host'])
+                    self.tdb.set_task(t, no_update=True)
+                    self.task_ended(t)
+                    continue
+                self.launch_remote(agent, t)
+                if self.metrics is not None:
+                    self.metrics.task_launched()
+                self.call_progress()
+                continue
+            if t.get('function') is not None and self.pool is not None and self.pool.free() <= 0:
+                deferred.append(rownum)
+                continue
+            batchable = size > 1 and self.batchable(t)
+            if batchable is True and t['pwd'] in batches and len(batches[t['pwd']][1]) < size:
+                batches[t['pwd']][1].append(t)
+                continue
+            if full is True:
+                # Only looking for more tasks for the batches.
+                deferred.append(rownum)
+                continue
+            need = self.resources.needs(t)
+            if not self.resources.fits(need, self.max_tasks):
+                deferred.append(rownum)
+                if now - self.passed_over.setdefault(rownum, now) >= self.reserve_after:
+                    # Hold what is left for it rather than letting
+                    # smaller tasks keep going ahead of it.
+                    break
+                continue
+            self.passed_over.pop(rownum, None)
+            if batchable is True:
+                claim = ('batch', self.num_batches)
+                self.num_batches += 1
+                self.resources.claim(claim, need)
+                batches[t['pwd']] = (claim, [t])
+                started.append(batches[t['pwd']])
+                continue
+            self.resources.claim(rownum, need)
 #            try:
 #                self.launch_task(t)
             self.launch_task(t)
@@ -222,12 +1302,29 @@ The current user is `{}'.".format(getpass.getuser()))
 #                t['status'] = 'EXCEPTION'
 #                t['exception'] = str(e)
 #                self.tdb.set_task(t)
+            if self.metrics is not None:
+                self.metrics.task_launched()
             self.call_progress()
-        return True
+        for claim, tasks in started:
+            self.start_batch(claim, tasks)
+        for i in deferred:
+            self.scheduler.push_ready(i)
+        return self.tdb.count_by_status('NEW') > 0
+
+    def write_metrics(self, force=False):
+        if self.metrics is None:
+            return
+        statuses = {}
+        for status in self.tdb.statuses:
+            if status != '':
+                n = self.tdb.count_by_status(status)
+                if n > 0:
+                    statuses[status] = n
+        self.metrics.write(statuses, self.running(), force=force)
 
-    def call_progress(self):
-        if self.progress is not None:
-            self.progress(percentage=self.calculate_percentage())
+    def call_progress(self, force=False):
+        if self.events is not None:
+            self.events.flush(self.tdb, self.calculate_percentage, force=force)
 
     def calculate_percentage(self):
         if self.num_groups > 0:
@@ -245,21 +1342,48 @@ The current user is `{}'.".format(getpass.getuser()))
         return str(round(100 * total_done))
 
     def run(self):
-        groups = self.tdb.groups
-        self.num_groups = len(groups)
+        '''Run every NEW task, each as soon as the tasks it depends on have ended.'''
+        self.tdb.choose_group(QRunnerTasksDatabase.ALL_GROUPS)
+        self.num_groups = 0
         self.done_groups = 0
-        self.num_tasks = 0
-        for g in groups:
-            self.done_tasks = 0
-            self.tdb.choose_group(g)
-            self.num_tasks = len(self.tdb.tasks_by_status('NEW'))
-            self.check()
-            self.launch()
-            self.wait()
-            self.check()
-            self.done_groups += 1
         self.done_tasks = 0
-        self.call_progress()
+        self.num_tasks = 0
+        if self.tdb.shared is True:
+            self.tdb.refresh()
+            self.tdb.merged_rownums()
+        for h in QRunnerTasksDatabase.TIMING_HEADERS:
+            self.tdb.add_column(h)
+        self.recover()
+        self.templates = []
+        if self.tdb.loading() is False:
+            self.find_templates()
+        priority = None
+        if self.history is not None or 'priority' in self.tdb.column:
+            priority = self.priority
+        self.scheduler = QRunnerScheduler.DependencyScheduler(self.tdb, group_barriers=self.group_barriers, priority=priority,
+                                                              more=len(self.templates) > 0)
+        self.num_tasks = self.tdb.count_by_status('NEW')
+        self.start_pool()
+        self.connect_agents()
+        self.forget_remote()
+        self.check()
+        if self.listen is not None:
+            self.server = QRunnerSubmit.SubmissionServer(self.listen, self.reaper, self.submit)
+        self.wait()
+        self.stop_listening()
+        self.check()
+        self.close_pool()
+        self.clear_markers()
+        self.drain_output()
+        if self.output_store is not None and self.cache is not None:
+            self.cache_pending_results()
+        if self.scheduler.blocked() > 0:
+            raise Exception("{} tasks can never run because they depend on each other.".format(self.scheduler.blocked()))
+        self.done_tasks = self.num_tasks
+        self.call_progress(force=True)
+        self.write_metrics(force=True)
+        if self.history is not None:
+            self.history.save()
         self.tdb.update()
 
     def add_task(self, **kwds):
@@ -287,7 +1411,23 @@ def test():
     print(qr.tdb.tasks())
 
 def main():
-    test()
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the NEW tasks of a tasks file.')
+    parser.add_argument('tasksfile', help='The tasks file, e.g. tasks.csv or tasks.sqlite')
+    parser.add_argument('--max-tasks', type=int, default=64, help='How many tasks to run at once')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds a task may run before it is killed (0 for no limit)')
+    if len(sys.argv) < 2:
+        test()
+        return
+    args = parser.parse_args()
+    def show_percentage(update_text=None, update_fields=None, percentage=None):
+        if percentage is not None:
+            print("\r{}%   ".format(percentage), end='')
+            sys.stdout.flush()
+    with QRunner(tasksdb_filename=args.tasksfile, max_tasks=args.max_tasks, timeout=args.timeout or None,
+                 progress=show_percentage) as qr:
+        qr.run()
+    print()
 
 if __name__ == '__main__':
     sys.exit(main())
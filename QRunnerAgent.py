@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+import sys, os, json, time, heapq, hmac, signal, socket, secrets, platform, itertools
+
+import QRunnerReaper, QRunnerSpawn, QRunnerBatch
+
+'''
+Runs commands for a QRunner on another host, or on this one without
+taking up the coordinator's own file descriptors and process slots.
+
+An agent listens on a TCP port ("host:port") or a Unix domain socket (a
+path), and a coordinator keeps one connection open to each of its agents.
+Both sides send one JSON object per line.
+
+Anyone who can connect to an agent can run commands as its user, so an
+agent on a TCP port needs a secret (from --secret-file, or the
+QRUNNER_AGENT_SECRET environment variable) that its coordinators share.
+It starts each connection with {"challenge": nonce}, and only carries on if
+the coordinator answers {"auth": HMAC-SHA256 of the nonce keyed with the
+secret, in hex}; a Unix domain socket is guarded by the permissions of its
+directory instead, and needs a secret only if given one. The agent then
+starts with
+
+    {"agent": name, "host": ..., "slots": N}
+
+where name is what tasks put in their host column to run there (the host
+name by default; several agents may share a name). The coordinator then
+sends a line per command to run
+
+    {"run": rownum, "argv": [...], "pwd": ..., "inputfile": ...,
+     "outputfile": ..., "errorfile": ..., "timeout": ..., "killtimeout": ...}
+
+and the agent answers {"started": rownum, "pid": pid} once it has started,
+{"failed": rownum, "exception": "..."} if it couldn't, and then
+{"ended": rownum, "status": wait status, "killed": null, "utime": ...,
+"stime": ..., "maxrss": ...} when it ends, with "killed" set to KILLING or
+KILLING9 if the agent had to send it SIGTERM or SIGKILL for running past
+its timeout. File names are relative to pwd on the agent's host, and pwd
+to the directory the agent was started in. A run message that can't be
+run (a bad argv, say) is answered with "failed"; a line that isn't a run
+message at all disconnects the coordinator that sent it.
+
+Commands whose coordinator goes away are sent SIGTERM, as nobody is left
+to hear how they ended. Start an agent with
+
+    QRUNNER_AGENT_SECRET=... ./QRunnerAgent.py serve 127.0.0.1:7001 --name workers --slots 256
+'''
+
+# Where the secret comes from when none is given
+SECRET_ENV = 'QRUNNER_AGENT_SECRET'
+
+def address_family(address):
+    '''The socket family and address for "host:port" (TCP) or a path (a Unix domain socket).'''
+    if '/' in address or ':' not in address:
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+def _send(sock, message):
+    sock.sendall(json.dumps(message).encode() + b'\n')
+
+def answer(secret, challenge):
+    return hmac.new(secret.encode(), challenge.encode(), 'sha256').hexdigest()
+
+class Agent:
+
+    def __init__(self, address, name=None, slots=64, secret=None):
+        self.address = address
+        self.name = name or platform.node()
+        self.slots = slots
+        self.secret = secret or os.environ.get(SECRET_ENV) or None
+        family, addr = address_family(address)
+        if family == socket.AF_INET and self.secret is None:
+            raise Exception("An agent on a TCP port lets anyone who can reach `{}' run commands, so it needs a secret \
+(--secret-file or {}).".format(address, SECRET_ENV))
+        self.reaper = QRunnerReaper.Reaper()
+        self.spawner = QRunnerSpawn.Spawner('posix_spawn')
+        self.devnull = os.open(os.devnull, os.O_RDWR)
+        # Connected coordinators by fd, as [socket, unread bytes, the challenge they have yet to answer or None]
+        self.clients = {}
+        # Running commands by pid, as [client, rownum, status, killtimeout, launch]
+        self.tasks = {}
+        # Numbers each command started, so that a deadline can't outlive its command and catch the next to get its pid
+        self.launches = itertools.count()
+        # Heap of (when, pid, launch, action) for commands that have to be killed if they run too long
+        self.deadlines = []
+        if family == socket.AF_UNIX:
+            try:
+                os.unlink(addr)
+            except FileNotFoundError:
+                pass
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.reaper.watch(self.sock.fileno(), self._accept)
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def _accept(self, fd):
+        try:
+            conn, addr = self.sock.accept()
+        except BlockingIOError:
+            return
+        if conn.family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.settimeout(10)
+        client = [conn, b'', None]
+        self.clients[conn.fileno()] = client
+        self.reaper.watch(conn.fileno(), self._readable)
+        if self.secret is not None:
+            client[2] = secrets.token_hex(16)
+            self._tell(client, {'challenge': client[2]})
+        else:
+            self._hello(client)
+
+    def _hello(self, client):
+        self._tell(client, {'agent': self.name, 'host': platform.node(), 'slots': self.slots})
+
+    def _drop(self, client):
+        conn = client[0]
+        if conn is None:
+            return
+        client[0] = None
+        del self.clients[conn.fileno()]
+        self.reaper.unwatch(conn.fileno())
+        conn.close()
+        for pid, task in self.tasks.items():
+            if task[0] is client and task[2] == 'RUNNING':
+                self._kill(pid, signal.SIGTERM)
+
+    def _tell(self, client, message):
+        if client[0] is None:
+            return
+        try:
+            _send(client[0], message)
+        except OSError:
+            self._drop(client)
+
+    def _readable(self, fd):
+        client = self.clients[fd]
+        try:
+            data = client[0].recv(1 << 16)
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            self._drop(client)
+            return
+        lines = (client[1] + data).split(b'\n')
+        client[1] = lines.pop()
+        for line in lines:
+            if client[0] is None:
+                return
+            if line.strip() == b'':
+                continue
+            try:
+                m = json.loads(line)
+            except ValueError:
+                m = None
+            if client[2] is not None:
+                if not isinstance(m, dict) or not isinstance(m.get('auth'), str) \
+                        or not hmac.compare_digest(m['auth'], answer(self.secret, client[2])):
+                    self._drop(client)
+                    return
+                client[2] = None
+                self._hello(client)
+            elif not isinstance(m, dict) or type(m.get('run')) is not int:
+                # Not a coordinator; there's no telling what it wanted run.
+                self._drop(client)
+                return
+            else:
+                self.run(client, m)
+
+    def run(self, client, m):
+        rownum = m['run']
+        opened = []
+        try:
+            argv = m.get('argv')
+            if not isinstance(argv, list) or len(argv) == 0 or not all(isinstance(a, str) for a in argv):
+                raise ValueError("argv should be a list of strings, not {}".format(json.dumps(argv)))
+            timeout = None if m.get('timeout') is None else float(m['timeout'])
+            killtimeout = float(m.get('killtimeout', 2))
+            d = self.spawner.directory(m.get('pwd'))
+            names = [m.get(k) for k in ['inputfile', 'outputfile', 'errorfile']]
+            fds = QRunnerBatch.open_files(*[name if name in [None, '-'] else self.spawner.path(d, name) for name in names],
+                                          self.devnull, opened)
+            pid = self.spawner.spawn(argv, cwd=d, stdin=fds[0], stdout=fds[1], stderr=fds[2])
+        except (OSError, TypeError, ValueError) as e:
+            self._tell(client, {'failed': rownum, 'exception': "{}: {}".format(type(e).__name__, e)})
+            return
+        finally:
+            for f in opened:
+                os.close(f)
+        self.reaper.register(pid)
+        launch = next(self.launches)
+        self.tasks[pid] = [client, rownum, 'RUNNING', killtimeout, launch]
+        if timeout is not None:
+            heapq.heappush(self.deadlines, (time.monotonic() + timeout, pid, launch, 'KILLING'))
+        self._tell(client, {'started': rownum, 'pid': pid})
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _ended(self, pid, status, rusage):
+        client, rownum, action, killtimeout, launch = self.tasks.pop(pid)
+        self._tell(client, {'ended': rownum, 'status': status, 'killed': None if action == 'RUNNING' else action,
+                            'utime': rusage.ru_utime, 'stime': rusage.ru_stime, 'maxrss': rusage.ru_maxrss})
+
+    def expire_deadlines(self):
+        '''SIGTERM commands that have run past their timeout, then SIGKILL them after killtimeout.'''
+        now = time.monotonic()
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            when, pid, launch, action = heapq.heappop(self.deadlines)
+            task = self.tasks.get(pid)
+            if task is None or task[4] != launch:
+                continue
+            if action == 'KILLING' and task[2] == 'RUNNING':
+                self._kill(pid, signal.SIGTERM)
+                heapq.heappush(self.deadlines, (now + task[3], pid, launch, 'KILLING9'))
+            elif action == 'KILLING9' and task[2] == 'KILLING':
+                self._kill(pid, signal.SIGKILL)
+            else:
+                continue
+            task[2] = action
+
+    def poll(self, timeout=None):
+        '''Handle what the coordinators have sent and the commands that have ended, waiting up to timeout seconds.'''
+        if len(self.deadlines) > 0:
+            wakeup = max(0, self.deadlines[0][0] - time.monotonic())
+            if timeout is None or wakeup < timeout:
+                timeout = wakeup
+        for pid, status, rusage in self.reaper.poll(timeout):
+            self._ended(pid, status, rusage)
+        self.expire_deadlines()
+
+    def serve(self):
+        while True:
+            self.poll()
+
+    def close(self):
+        for client in list(self.clients.values()):
+            self._drop(client)
+        if self.sock is not None:
+            self.reaper.unwatch(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            family, addr = address_family(self.address)
+            if family == socket.AF_UNIX:
+                try:
+                    os.unlink(addr)
+                except FileNotFoundError:
+                    pass
+            self.reaper.close()
+            os.close(self.devnull)
+
+class AgentConnection:
+    '''A coordinator's connection to an agent. handle(agent, message) is called from the poll() of reaper
+    (a QRunnerReaper.Reaper) for every message after the hello, and handle(agent, None) once the agent has gone.
+    secret is needed if the agent asks for one, and defaults to $QRUNNER_AGENT_SECRET.'''
+
+    def __init__(self, address, reaper, handle, secret=None):
+        self.address = address
+        self.reaper = reaper
+        self.handle = handle
+        # The tasks sent to the agent that haven't ended yet, by rownum, with their pid once they have started
+        self.tasks = {}
+        family, addr = address_family(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(10)
+        self.sock.connect(addr)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.unread = b''
+        hello = self._receive('closed the connection')
+        if 'challenge' in hello:
+            secret = secret or os.environ.get(SECRET_ENV)
+            if not secret:
+                raise Exception("The agent at `{}' needs a secret; give it as agent_secret or {}.".format(address, SECRET_ENV))
+            _send(self.sock, {'auth': answer(secret, hello['challenge'])})
+            hello = self._receive('turned down the secret')
+        self.name = hello['agent']
+        self.slots = hello['slots']
+        self.reaper.watch(self.sock.fileno(), self._readable)
+
+    def _receive(self, closed):
+        '''The next message from the agent, waiting for it.'''
+        while b'\n' not in self.unread:
+            data = self.sock.recv(1 << 16)
+            if len(data) == 0:
+                raise Exception("The agent at `{}' {}.".format(self.address, closed))
+            self.unread += data
+        line, self.unread = self.unread.split(b'\n', 1)
+        return json.loads(line)
+
+    def free(self):
+        '''How many more tasks the agent can take.'''
+        if self.sock is None:
+            return 0
+        return self.slots - len(self.tasks)
+
+    def run(self, rownum, argv, pwd, files, timeout, killtimeout):
+        '''Have the agent run argv in pwd with files as its (inputfile, outputfile, errorfile).'''
+        self.tasks[rownum] = None
+        message = {'run': rownum, 'argv': argv, 'pwd': pwd, 'timeout': timeout, 'killtimeout': killtimeout}
+        message.update(zip(['inputfile', 'outputfile', 'errorfile'], files))
+        try:
+            _send(self.sock, message)
+        except OSError:
+            self._gone()
+
+    def _readable(self, fd):
+        try:
+            data = self.sock.recv(1 << 16)
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            self._gone()
+            return
+        lines = (self.unread + data).split(b'\n')
+        self.unread = lines.pop()
+        for line in lines:
+            if line.strip() == b'':
+                continue
+            message = json.loads(line)
+            if 'started' in message:
+                self.tasks[message['started']] = message['pid']
+            elif 'ended' in message:
+                self.tasks.pop(message['ended'], None)
+            elif 'failed' in message:
+                self.tasks.pop(message['failed'], None)
+            self.handle(self, message)
+
+    def _gone(self):
+        self.close()
+        self.handle(self, None)
+        self.tasks = {}
+
+    def close(self):
+        if self.sock is not None:
+            self.reaper.unwatch(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+def test():
+    import tempfile, subprocess
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'agent.sock')
+        agent = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', path, '--name', 'test', '--slots', '2'])
+        messages = []
+        try:
+            while not os.path.exists(path):
+                time.sleep(0.01)
+            with QRunnerReaper.Reaper() as reaper:
+                c = AgentConnection(path, reaper, lambda a, m: messages.append(m))
+                if c.name != 'test' or c.free() != 2:
+                    raise Exception("Unexpected hello {} {}".format(c.name, c.slots))
+                c.run(0, ['sh', '-c', 'echo $0', 'a'], tmp, (None, 'a.txt', None), None, 2)
+                c.run(1, ['no-such-command'], tmp, (None, None, None), None, 2)
+                c.run(2, ['sleep', '10'], None, (None, None, None), 0.1, 0.1)
+                deadline = time.monotonic() + 4
+                while len(c.tasks) > 0 and time.monotonic() < deadline:
+                    reaper.poll(0.1)
+                c.close()
+        finally:
+            agent.terminate()
+            agent.wait()
+        ended = {m['ended']: m for m in messages if 'ended' in m}
+        failed = [m['failed'] for m in messages if 'failed' in m]
+        if ended.get(0, {}).get('status') != 0 or failed != [1] or ended.get(2, {}).get('killed') != 'KILLING':
+            raise Exception("Unexpected messages {}".format(messages))
+        with open(os.path.join(tmp, 'a.txt')) as f:
+            if f.read() != 'a\n':
+                raise Exception("The first command didn't write its output")
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        address = '127.0.0.1:{}'.format(s.getsockname()[1])
+        s.close()
+        env = {k: v for k, v in os.environ.items() if k != SECRET_ENV}
+        if subprocess.run([sys.executable, os.path.abspath(__file__), 'serve', address], env=env,
+                          stderr=subprocess.DEVNULL).returncode == 0:
+            raise Exception("An agent on a TCP port shouldn't start without a secret")
+        with open(os.path.join(tmp, 'secret'), 'w') as f:
+            f.write('s3cret\n')
+        agent = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', address, '--secret-file', os.path.join(tmp, 'secret')])
+        messages = []
+        try:
+            with QRunnerReaper.Reaper() as reaper:
+                for i in range(500):
+                    try:
+                        AgentConnection(address, reaper, None, secret='wrong')
+                    except ConnectionRefusedError:
+                        time.sleep(0.01)
+                        continue
+                    except Exception as e:
+                        if 'secret' in str(e):
+                            break
+                    raise Exception("The wrong secret was let in")
+                # Neither garbage nor a bad task stops the agent serving the others.
+                bad = AgentConnection(address, reaper, lambda a, m: None, secret='s3cret')
+                bad.sock.sendall(b'not json\n')
+                c = AgentConnection(address, reaper, lambda a, m: messages.append(m), secret='s3cret')
+                c.sock.sendall(b'{"run": 5, "argv": "true"}\n')
+                c.run(6, ['true'], None, (None, None, None), None, 2)
+                deadline = time.monotonic() + 4
+                while (len(c.tasks) > 0 or bad.sock is not None) and time.monotonic() < deadline:
+                    reaper.poll(0.1)
+                c.close()
+        finally:
+            agent.terminate()
+            agent.wait()
+        if [m.get('failed') for m in messages if 'failed' in m] != [5] or [m['ended'] for m in messages if 'ended' in m] != [6]:
+            raise Exception("Unexpected messages {}".format(messages))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run commands for a QRunner.')
+    subparsers = parser.add_subparsers(dest='action')
+    p = subparsers.add_parser('serve', help='Listen for a QRunner and run the commands it sends.')
+    p.add_argument('address', help='host:port, or the path of a Unix domain socket')
+    p.add_argument('--name', help='The host name that tasks give to run here (this host\'s name by default)')
+    p.add_argument('--slots', type=int, default=64, help='How many commands to run at once')
+    p.add_argument('--secret-file', help='A file holding the secret coordinators must know ({} by default)'.format(SECRET_ENV))
+    if len(sys.argv) < 2:
+        test()
+        return
+    args = parser.parse_args()
+    if args.action == 'serve':
+        # Leave through close(), which stops the commands still running.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        secret = None
+        if args.secret_file is not None:
+            with open(args.secret_file) as f:
+                secret = f.read().strip()
+        with Agent(args.address, name=args.name, slots=args.slots, secret=secret) as agent:
+            try:
+                agent.serve()
+            except KeyboardInterrupt:
+                pass
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    sys.exit(main())
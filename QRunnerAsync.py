@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+import sys, os, getpass, platform, shlex, asyncio
+
+import QRunnerTasksDatabase, QRunnerScheduler, QRunnerReaper, QRunnerSpawn, QRunnerWorkerPool, QRunnerOutputStore, QRunnerProgress
+
+'''
+An asyncio version of QRunner, for running tasks from inside an asyncio
+program.
+
+The tasks database is still the source of truth and the same dependency
+scheduler decides what runs next, so groups and depends_on behave as they
+do with QRunner.run(), and progress is passed on in the same batches.
+Commands run through asyncio.create_subprocess_exec, at most max_tasks at
+a time, and function tasks run on a thread (with the coordinator's stdio).
+
+completions() runs the tasks and yields each one as it ends. With
+capture_output=True (or an output_store), the output of tasks without an
+outputfile or errorfile is read through pipes rather than written to
+files, and stream(rownum) yields a running task's stdout as it arrives.
+'''
+
+ROWNUM_KEY = QRunnerTasksDatabase.ROWNUM_KEY
+
+def wait_status(returncode):
+    '''The wait status for an asyncio returncode, which is negative for a signal.'''
+    if returncode < 0:
+        return -returncode
+    return QRunnerWorkerPool.exit_status(returncode)
+
+class AsyncQRunner:
+
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        self.tdb.update()
+        if self.output_store is not None:
+            self.output_store.close()
+        if self.events is not None:
+            self.events.close()
+
+    async def __aenter__(self):
+        return self
+
+    def __init__(self, timeout=10, killtimeout=2, progress=None, max_tasks=64, group_barriers=True,
+                 capture_output=False, output_store=None, output_compress=False, output_max_bytes=None,
+                 progress_interval=0.5, **kwds):
+        self.timeout = timeout
+        self.killtimeout = killtimeout
+        self.events = None
+        if progress is not None:
+            self.events = QRunnerProgress.ProgressEvents(progress, interval=progress_interval)
+        self.tdb = QRunnerTasksDatabase.QRunnerTasksDatabase(progress=self.events, **kwds)
+        self.max_tasks = max_tasks
+        self.group_barriers = group_barriers
+        self.scheduler = None
+        self.progress = progress
+        self.spawner = QRunnerSpawn.Spawner('popen')
+        self.output_store = None
+        if output_store is not None:
+            self.output_store = QRunnerOutputStore.OutputStore(output_store, compress=output_compress,
+                                                               max_task_bytes=output_max_bytes)
+        self.capture_output = capture_output or output_store is not None
+        # Queues of stream() readers by rownum
+        self.streams = {}
+        # Rownums whose stdout is being read by _pump()
+        self.pumping = set()
+        self.semaphore = None
+        self.done_tasks = 0
+        self.num_tasks = 0
+
+    def add_task(self, **kwds):
+        self.tdb.add_task(**kwds)
+
+    def done(self):
+        for status in QRunnerScheduler.PENDING_STATUSES:
+            if self.tdb.count_by_status(status) > 0:
+                return False
+        return True
+
+    def call_progress(self, force=False):
+        if self.events is not None:
+            self.events.flush(self.tdb, self.calculate_percentage, force=force)
+
+    def calculate_percentage(self):
+        if self.num_tasks > 0:
+            return str(round(100 * self.done_tasks / self.num_tasks))
+        return '0'
+
+    def check(self):
+        '''Tasks left LAUNCHING or RUNNING by an earlier run have failed or died.'''
+        for t in self.tdb.tasks_by_status('LAUNCHING'):
+            t['status'] = 'FAILED'
+            t['pid'] = None
+            t['rc'] = None
+            self.tdb.set_task(t)
+        for t in self.tdb.tasks_by_status('RUNNING'):
+            if t['pid'] is None or not QRunnerReaper.Reaper.is_alive(t['pid']):
+                t['pid'] = None
+                t['status'] = 'DIED'
+                self.tdb.set_task(t)
+
+    def stream(self, rownum):
+        '''An async iterator over the stdout of a task, as bytes, from the point it is called until the task ends.'''
+        q = asyncio.Queue()
+        if rownum in self.pumping or self.may_pump(rownum):
+            self.streams.setdefault(rownum, []).append(q)
+        else:
+            q.put_nowait(None)
+        async def chunks():
+            while True:
+                data = await q.get()
+                if data is None:
+                    return
+                yield data
+        return chunks()
+
+    def may_pump(self, rownum):
+        '''Whether the task in row rownum is yet to start, so its stdout may still be read.'''
+        if rownum >= self.tdb.num_tasks():
+            return self.tdb.loading()
+        t = self.tdb.get_task(rownum)
+        return t['status'] in ['NEW', 'LAUNCHING'] and t.get(QRunnerTasksDatabase.FUNCTION_KEY) is None
+
+    def end_streams(self, rownum):
+        '''End the stream() readers of a task that is over, or won't run.'''
+        for q in self.streams.pop(rownum, []):
+            q.put_nowait(None)
+
+    async def _pump(self, reader, t, stream):
+        rownum = t[ROWNUM_KEY]
+        try:
+            while True:
+                data = await reader.read(65536)
+                if self.output_store is not None:
+                    if len(data) > 0:
+                        self.output_store.write(rownum, stream, data, t['comment'])
+                    else:
+                        self.output_store.end(rownum, stream)
+                if stream == 'out':
+                    for q in self.streams.get(rownum, []):
+                        q.put_nowait(data or None)
+                if len(data) == 0:
+                    break
+        finally:
+            if stream == 'out':
+                self.pumping.discard(rownum)
+                self.end_streams(rownum)
+
+    async def _wait(self, t, proc, timeout):
+        '''Wait for a command, sending it SIGTERM and then SIGKILL if it runs too long. Returns its wait status, or None if it wouldn't die.'''
+        try:
+            return wait_status(await asyncio.wait_for(proc.wait(), timeout))
+        except asyncio.TimeoutError:
+            pass
+        for status, kill in [('KILLING', proc.terminate), ('KILLING9', proc.kill)]:
+            t['status'] = status
+            self.tdb.set_task(t)
+            kill()
+            try:
+                return wait_status(await asyncio.wait_for(proc.wait(), self.killtimeout))
+            except asyncio.TimeoutError:
+                pass
+        return None
+
+    async def _run_task(self, t):
+        async with self.semaphore:
+            try:
+                return await self._launch_task(t)
+            except Exception as e:
+                # It couldn't be started (a missing command, say); the other tasks carry on.
+                self.done_tasks += 0.5 if t['status'] == 'RUNNING' else 1
+                t['status'] = 'FAILED'
+                t['pid'] = None
+                t['exception'] = "{}: {}".format(type(e).__name__, e)
+                self.tdb.set_task(t, no_update=True)
+                return t
+
+    async def _launch_task(self, t):
+        command = t.get('command')
+        function = t.get(QRunnerTasksDatabase.FUNCTION_KEY)
+        if command is None and function is None:
+            raise Exception("Cannot have a task with no command.")
+        if t['host'] not in [None, platform.node()]:
+            raise Exception("Executing tasks on a remote host is not yet supported. \
+The local host is `{}'.".format(platform.node()))
+        if t['user'] not in [None, getpass.getuser()]:
+            raise Exception("Executing tasks as another user is not yet supported. \
+The current user is `{}'.".format(getpass.getuser()))
+        rownum = t[ROWNUM_KEY]
+        group = t['group'] or 0
+        comment = t['comment'] or ''
+        timeout = float(t.get('timeout') or self.timeout or 0) or None
+
+        t['status'] = 'LAUNCHING'
+        self.tdb.set_task(t, no_update=True)
+        if function is not None:
+            t['status'] = 'RUNNING'
+            self.tdb.set_task(t, no_update=True)
+            self.done_tasks += 0.5
+            self.call_progress()
+            rc, result, exception = await asyncio.to_thread(QRunnerWorkerPool.call_task, function)
+            return self._finished(t, QRunnerWorkerPool.exit_status(rc), result, exception)
+
+        d = self.spawner.directory(t['pwd'])
+        files = []
+        try:
+            inputfile = t['inputfile']
+            if inputfile is None and self.capture_output is False:
+                inputfile = '{}-{}-{}.in.txt'.format(group, rownum, comment)
+            stdin = asyncio.subprocess.DEVNULL
+            if inputfile == '-':
+                stdin = None
+            elif inputfile is not None and os.path.exists(self.spawner.path(d, inputfile)):
+                stdin = open(self.spawner.path(d, inputfile), 'rb')
+                files.append(stdin)
+            std = []
+            for name, suffix in [(t['outputfile'], 'out'), (t['errorfile'], 'err')]:
+                if name is None and self.capture_output is True:
+                    std.append(asyncio.subprocess.PIPE)
+                    continue
+                if name is None:
+                    name = '{}-{}-{}.{}.txt'.format(group, comment, rownum, suffix)
+                if name == '-':
+                    std.append(None)
+                    continue
+                f = open(self.spawner.path(d, name), 'wb')
+                files.append(f)
+                std.append(f)
+            if self.output_store is not None and asyncio.subprocess.PIPE in std:
+                self.output_store.start(rownum, t['comment'])
+            proc = await asyncio.create_subprocess_exec(*shlex.split(command), cwd=d, stdin=stdin, stdout=std[0], stderr=std[1])
+        finally:
+            for f in files:
+                f.close()
+
+        t['pid'] = proc.pid
+        t['status'] = 'RUNNING'
+        self.tdb.set_task(t, no_update=True)
+        self.done_tasks += 0.5
+        self.call_progress()
+        if proc.stdout is not None:
+            self.pumping.add(rownum)
+        pumps = [asyncio.ensure_future(self._pump(r, t, stream))
+                 for r, stream in [(proc.stdout, 'out'), (proc.stderr, 'err')] if r is not None]
+        rc = await self._wait(t, proc, timeout)
+        if rc is None:
+            # It survived SIGKILL; stop holding up the tasks that depend on it.
+            for p in pumps:
+                p.cancel()
+            t['status'] = 'ZOMBIE'
+            self.tdb.set_task(t)
+            return t
+        if len(pumps) > 0:
+            await asyncio.gather(*pumps)
+        return self._finished(t, rc)
+
+    def _finished(self, t, rc, result=None, exception=None):
+        if t['status'] == 'KILLING':
+            t['status'] = 'KILLED'
+            t['rc'] = str(os.waitstatus_to_exitcode(rc))
+        elif t['status'] == 'KILLING9':
+            t['status'] = 'KILLED9'
+            t['rc'] = '-9'
+        else:
+            t['status'] = 'FINISHED'
+            t['rc'] = str(os.waitstatus_to_exitcode(rc))
+        t['pid'] = None
+        if result is not None:
+            self.tdb.add_column('result')
+            t['result'] = repr(result)
+        if exception is not None:
+            t['exception'] = exception
+        self.tdb.set_task(t, no_update=True)
+        self.done_tasks += 0.5
+        return t
+
+    async def completions(self):
+        '''Run every NEW task, each as soon as the tasks it depends on have ended, yielding each task as it ends.'''
+        self.tdb.choose_group(QRunnerTasksDatabase.ALL_GROUPS)
+        self.semaphore = asyncio.Semaphore(self.max_tasks)
+        self.done_tasks = 0
+        self.check()
+        self.scheduler = QRunnerScheduler.DependencyScheduler(self.tdb, group_barriers=self.group_barriers)
+        self.num_tasks = self.tdb.count_by_status('NEW')
+        running = set()
+        while True:
+            if self.tdb.loading() is True:
+                self.tdb.load_more()
+                self.num_tasks += self.scheduler.sync()
+                if self.tdb.loading() is False:
+                    self.scheduler.close()
+            for t in self.scheduler.next_tasks(max(0, self.max_tasks - len(running))):
+                running.add(asyncio.ensure_future(self._run_task(t)))
+            if len(running) == 0:
+                if self.tdb.loading() is True:
+                    continue
+                break
+            timeout = None
+            if self.events is not None:
+                timeout = self.events.next_flush()
+            if self.tdb.loading() is True:
+                timeout = 0
+            done, pending = await asyncio.wait(running, timeout=timeout,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                self.call_progress()
+            for f in done:
+                running.remove(f)
+                t = f.result()
+                self.scheduler.task_ended(t[ROWNUM_KEY])
+                self.end_streams(t[ROWNUM_KEY])
+                if self.tdb.storage.incremental is True:
+                    self.tdb.persist()
+                self.call_progress()
+                yield t
+        # Whatever is left can't run now.
+        for rownum in list(self.streams):
+            self.end_streams(rownum)
+        if self.scheduler.blocked() > 0:
+            raise Exception("{} tasks can never run because they depend on each other.".format(self.scheduler.blocked()))
+        self.done_tasks = self.num_tasks
+        self.call_progress(force=True)
+        self.tdb.update()
+
+    async def run(self):
+        '''Run every NEW task, like QRunner.run().'''
+        async for t in self.completions():
+            pass
+
+def test():
+    async def run():
+        seen = []
+        async with AsyncQRunner(tasksdb_filename=None, capture_output=True, max_tasks=2) as qr:
+            qr.add_task(comment='a', status='NEW', command='echo hello', group=1)
+            qr.add_task(comment='b', status='NEW', command='sh -c "exit 3"', group=1)
+            qr.add_task(comment='c', status='NEW', command='echo world', group=2)
+            qr.add_task(comment='d', status='NEW', function=lambda: 'done', group=2)
+            qr.add_task(comment='e', status='NEW', command='no-such-command', group=2)
+            lines = []
+            async def reader():
+                async for data in qr.stream(2):
+                    lines.append(data)
+            r = asyncio.ensure_future(reader())
+            async for t in qr.completions():
+                seen.append((t['comment'], t['rc']))
+            await r
+            if sorted(seen[:2]) != [('a', '0'), ('b', '3')] or lines != [b'world\n'] or not qr.done():
+                raise Exception("Unexpected completions {} and output {}".format(seen, lines))
+            e = qr.tdb.get_task(4)
+            if e['status'] != 'FAILED' or 'FileNotFoundError' not in (e['exception'] or ''):
+                raise Exception("A command that can't start should fail on its own: {}".format(e))
+            # Streams of a function task, or of one that has ended, end at once.
+            for rownum in [3, 0]:
+                async for data in qr.stream(rownum):
+                    raise Exception("Unexpected output {} from task {}".format(data, rownum))
+    asyncio.run(run())
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import sys, os, signal
+
+from multiprocessing import Pipe
+
+import QRunnerSpawn
+
+'''
+Runs a batch of short commands one after another in a forked worker, so
+that the coordinator doesn't start each of them itself.
+
+The worker changes into the batch's directory once, then starts each
+command with posix_spawn and waits for it, sending ('started', rownum,
+pid) and ('ended', rownum, pid, status, rusage) back over a pipe as it
+goes, or ('failed', rownum, exception) if a command can't be started. The
+worker exits after the last command, and the coordinator sees the end of
+the pipe.
+
+Every task in a batch keeps its own row: it is RUNNING with the pid of its
+own command while it runs, and the coordinator can kill that command when
+it runs too long just as it would one it started itself. The tasks of a
+batch that haven't started yet stay NEW, so if the coordinator goes away
+they are simply run again next time.
+
+BatchSizer picks how many tasks go in a batch from how long tasks have
+been taking: enough for a batch to take about `seconds', but no more than
+it takes to spread the ready tasks over the free slots, so batching never
+leaves slots idle. Tasks that take longer than that aren't batched at all.
+'''
+
+class BatchWorker:
+
+    def __init__(self, cwd, jobs):
+        '''jobs is a list of (rownum, argv, inputfile, outputfile, errorfile), the files as paths, None for
+        /dev/null, or '-' for the coordinator's own stdin, stdout or stderr.'''
+        # Tasks not yet started, in order
+        self.rownums = [job[0] for job in jobs]
+        # The rownum and pid of the command running now
+        self.rownum = None
+        self.pid = None
+        self.result_r, result_w = Pipe(duplex=False)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.worker_pid = os.fork()
+        if self.worker_pid == 0:
+            try:
+                self.result_r.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.chdir(cwd)
+                serve(jobs, result_w)
+            finally:
+                os._exit(0)
+        result_w.close()
+
+    def fileno(self):
+        return self.result_r.fileno()
+
+    def messages(self):
+        '''The messages the worker has sent so far, ending with None once it has gone.'''
+        try:
+            while self.result_r.poll():
+                message = self.result_r.recv()
+                if message[0] == 'started':
+                    self.rownums.remove(message[1])
+                    self.rownum, self.pid = message[1], message[2]
+                elif message[0] == 'ended':
+                    self.rownum, self.pid = None, None
+                else:
+                    self.rownums.remove(message[1])
+                yield message
+        except (EOFError, OSError):
+            yield None
+
+    def close(self):
+        self.result_r.close()
+        try:
+            os.waitpid(self.worker_pid, 0)
+        except ChildProcessError:
+            pass
+
+def open_files(inputfile, outputfile, errorfile, devnull, opened):
+    '''File descriptors for a command's stdin, stdout and stderr, given paths, None for devnull or '-'
+    for our own; the ones opened are appended to `opened'. A missing input file reads as devnull.'''
+    fds = []
+    for fd, name, flags in [(0, inputfile, os.O_RDONLY),
+                            (1, outputfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC),
+                            (2, errorfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)]:
+        if name is None:
+            fds.append(devnull)
+        elif name == '-':
+            fds.append(fd)
+        else:
+            try:
+                f = os.open(name, flags, 0o666)
+            except FileNotFoundError:
+                if fd != 0:
+                    raise
+                f = devnull
+            else:
+                opened.append(f)
+            fds.append(f)
+    return fds
+
+def serve(jobs, result_w):
+    spawner = QRunnerSpawn.Spawner('posix_spawn')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for rownum, argv, inputfile, outputfile, errorfile in jobs:
+        opened = []
+        try:
+            fds = open_files(inputfile, outputfile, errorfile, devnull, opened)
+            pid = spawner.spawn(argv, stdin=fds[0], stdout=fds[1], stderr=fds[2])
+        except OSError as e:
+            result_w.send(('failed', rownum, "{}: {}".format(type(e).__name__, e)))
+            continue
+        finally:
+            for f in opened:
+                os.close(f)
+        result_w.send(('started', rownum, pid))
+        wpid, status, rusage = os.wait4(pid, 0)
+        result_w.send(('ended', rownum, pid, status, rusage))
+
+class BatchSizer:
+
+    def __init__(self, seconds=0.5, max_size=64):
+        self.seconds = seconds
+        self.max_size = max_size
+        # Moving average of how long tasks take, once one has ended
+        self.duration = None
+
+    def task_ended(self, duration):
+        if self.duration is None:
+            self.duration = duration
+        else:
+            self.duration = 0.9 * self.duration + 0.1 * duration
+
+    def size(self, ready, free_slots):
+        '''How many of `ready' tasks to put in each batch with `free_slots' slots free; 1 means don't batch.'''
+        if self.duration is None:
+            return 1
+        size = int(self.seconds / max(self.duration, 0.001))
+        spread = -(-ready // max(1, int(free_slots)))
+        return max(1, min(self.max_size, size, spread))
+
+def test():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        jobs = [(0, ['sh', '-c', 'echo $0', 'a'], None, 'a.txt', None),
+                (1, ['no-such-command'], None, None, None),
+                (2, ['sh', '-c', 'exit 3'], 'missing.txt', None, None)]
+        b = BatchWorker(tmp, jobs)
+        messages = []
+        while True:
+            os.waitid(os.P_PID, b.worker_pid, os.WEXITED | os.WNOWAIT)
+            l = list(b.messages())
+            messages.extend(l)
+            if None in l:
+                break
+        b.close()
+        kinds = [(m[0], m[1]) for m in messages if m is not None]
+        if kinds != [('started', 0), ('ended', 0), ('failed', 1), ('started', 2), ('ended', 2)] or messages[-2][3] != 3 << 8:
+            raise Exception("Unexpected messages {}".format(messages))
+        with open(os.path.join(tmp, 'a.txt')) as f:
+            if f.read() != 'a\n':
+                raise Exception("The first command didn't write its output")
+    s = BatchSizer(seconds=0.5, max_size=64)
+    if s.size(1000, 10) != 1:
+        raise Exception("Nothing should be batched before a task has ended")
+    s.task_ended(0.01)
+    if s.size(1000, 10) != 50 or s.size(100, 10) != 10:
+        raise Exception("Wrong batch sizes {} and {}".format(s.size(1000, 10), s.size(100, 10)))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import csv, sys, os, json, time, platform, resource, subprocess, tempfile
+
+import QRunner, QRunnerTasksDatabase
+
+'''
+Measures QRunner itself rather than the tasks it runs.
+
+For each size and kind of queue, a tasks file of that many synthetic tasks
+is generated and run by a fresh Python process, so that its peak memory is
+its own. The kinds are:
+
+- true: every task is the command `true'
+- sleep: every task sleeps for 10 to 50 ms
+- function: every task is a function that returns straight away
+- mixed: a mix of the three, in groups of 1000 with some ungrouped tasks
+
+Each run reports the tasks launched and reaped per second (from the
+started and ended columns), the coordinator's CPU time per task, its peak
+RSS, and the time spent in QRunnerTasksDatabase.update() and
+QRunner.check(), along with how long tasks() takes to list a database
+holding the whole queue. Results are appended to a JSON lines file, one line per
+run, and `compare' lines up two such files to show what got slower:
+
+    ./QRunnerBenchmark.py run --sizes 1000,10000,100000 --output before.jsonl
+    ./QRunnerBenchmark.py run --sizes 1000,10000,100000 --output after.jsonl
+    ./QRunnerBenchmark.py compare before.jsonl after.jsonl
+'''
+
+KINDS = ['true', 'sleep', 'function', 'mixed']
+STORAGES = ['csv', 'journal', 'sqlite']
+# What identifies a run when comparing results
+KEY_FIELDS = ['size', 'kind', 'storage', 'executor', 'max_tasks', 'batch']
+# The results compared, and whether a higher number is better
+COMPARED_FIELDS = {'wall': False, 'launch_rate': True, 'reap_rate': True, 'cpu_per_task_ms': False,
+                   'peak_rss_mb': False, 'update_s': False, 'tasks_s': False, 'check_s': False}
+
+def noop():
+    pass
+
+def kind_of_task(kind, i):
+    '''The command (or None for a function) and group of the i'th task of a queue.'''
+    if kind == 'mixed':
+        kind = KINDS[i % 3]
+        group = 0 if i % 10 == 0 else 1 + i // 1000
+    else:
+        group = 1
+    if kind == 'true':
+        return 'true', group
+    if kind == 'sleep':
+        return 'sleep 0.0{}'.format(1 + i % 5), group
+    return None, group
+
+def make_tasks_file(filename, size, kind):
+    '''Write the command tasks of a queue; the function tasks are added once it is open.'''
+    with open(filename, 'w', newline='') as f:
+        w = csv.writer(f, dialect='unix')
+        w.writerow(QRunnerTasksDatabase.STANDARD_HEADERS)
+        for i in range(size):
+            command, group = kind_of_task(kind, i)
+            if command is not None:
+                w.writerow(['B{}'.format(i), 'NEW', '', '', command, group, '', '', '', '', os.devnull, os.devnull, ''])
+
+def timed(obj, name, totals):
+    '''Replace obj.name with a version that adds up the time spent in it.'''
+    f = getattr(obj, name)
+    totals[name] = 0.0
+    def wrapper(*args, **kwds):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwds)
+        finally:
+            totals[name] += time.perf_counter() - start
+    setattr(obj, name, wrapper)
+
+def time_tasks(size, kind):
+    '''Seconds QRunnerTasksDatabase.tasks() takes to list every task of a queue held in memory, the best of 3.'''
+    tdb = QRunnerTasksDatabase.QRunnerTasksDatabase(tasksdb_filename=None)
+    for i in range(size):
+        command, group = kind_of_task(kind, i)
+        if command is None:
+            tdb.add_task(comment='B{}'.format(i), status='NEW', function=noop, group=group)
+        else:
+            tdb.add_task(comment='B{}'.format(i), status='NEW', command=command, group=group)
+    tdb.choose_group(QRunnerTasksDatabase.ALL_GROUPS)
+    best = None
+    for n in range(3):
+        start = time.perf_counter()
+        if len(tdb.tasks()) != size:
+            raise Exception("tasks() didn't list all {} tasks.".format(size))
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def rate(values):
+    '''Events per second, given the times at which they happened.'''
+    if len(values) < 2 or max(values) == min(values):
+        return None
+    return round(len(values) / (max(values) - min(values)), 1)
+
+def run_one(size, kind, storage='csv', executor='fork', max_tasks=64, batch=False):
+    '''Run one queue in the current directory and return its results as a dict.'''
+    filename = 'tasks.csv'
+    make_tasks_file(filename, size, kind)
+    kwds = {}
+    if storage == 'sqlite':
+        QRunnerTasksDatabase.convert(filename, 'tasks.sqlite')
+        filename = 'tasks.sqlite'
+    elif storage == 'journal':
+        kwds['journal'] = True
+    totals = {}
+    with QRunner.QRunner(tasksdb_filename=filename, max_tasks=max_tasks, executor=executor, batch=batch, **kwds) as qr:
+        for i in range(size):
+            command, group = kind_of_task(kind, i)
+            if command is None:
+                qr.add_task(comment='B{}'.format(i), status='NEW', function=noop, group=group,
+                            outputfile=os.devnull, errorfile=os.devnull)
+        timed(qr.tdb, 'update', totals)
+        timed(qr, 'check', totals)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        qr.run()
+        wall = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        started = []
+        ended = []
+        for i in range(qr.tdb.num_tasks()):
+            for column, values in [('started', started), ('ended', ended)]:
+                v = qr.tdb.get_field(i, column)
+                if v is not None:
+                    values.append(float(v))
+        if qr.done() is not True:
+            raise Exception("The {} {} tasks didn't all run.".format(size, kind))
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    maxrss = after.ru_maxrss / 1024 if sys.platform == 'darwin' else after.ru_maxrss
+    # Apart from the run, and after its peak RSS has been taken.
+    totals['tasks'] = time_tasks(size, kind)
+    return {'size': size, 'kind': kind, 'storage': storage, 'executor': executor, 'max_tasks': max_tasks, 'batch': batch,
+            'wall': round(wall, 3), 'launch_rate': rate(started), 'reap_rate': rate(ended),
+            'cpu_per_task_ms': round(1000 * cpu / size, 3), 'peak_rss_mb': round(maxrss / 1024, 1),
+            'update_s': round(totals['update'], 3), 'tasks_s': round(totals['tasks'], 3),
+            'check_s': round(totals['check'], 3)}
+
+def run(size, kind, storage='csv', executor='fork', max_tasks=64, batch=False):
+    '''Run one queue in a fresh process and temporary directory; returns its results with details of the machine.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        p = subprocess.run([sys.executable, os.path.abspath(__file__), 'one', str(size), kind, '--storage', storage,
+                            '--executor', executor, '--max-tasks', str(max_tasks)] + (['--batch'] if batch else []),
+                           cwd=tmp, stdout=subprocess.PIPE, check=True,
+                           env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))))
+    result = json.loads(p.stdout.decode().splitlines()[-1])
+    result.update({'time': round(time.time()), 'host': platform.node(), 'python': platform.python_version(),
+                   'cpus': os.cpu_count()})
+    return result
+
+def load_results(filename):
+    '''The last result for each run in a results file, by KEY_FIELDS.'''
+    results = {}
+    with open(filename) as f:
+        for line in f:
+            if line.strip() != '':
+                r = json.loads(line)
+                results[tuple(r.get(k) for k in KEY_FIELDS)] = r
+    return results
+
+def compare(before_filename, after_filename):
+    '''Lines comparing each result in both files, with the change from before to after as a percentage.
+
+    Changes for the worse of more than 10% are marked with a `!'.'''
+    before = load_results(before_filename)
+    after = load_results(after_filename)
+    lines = []
+    for key in sorted(k for k in after if k in before):
+        name = ' '.join(str(k) for k in key)
+        for field, higher_is_better in COMPARED_FIELDS.items():
+            old = before[key].get(field)
+            new = after[key].get(field)
+            if old is None or new is None or old == 0:
+                continue
+            change = 100 * (new - old) / old
+            worse = -change if higher_is_better else change
+            lines.append('{:40} {:16} {:>12} {:>12} {:+7.1f}%{}'.format(name, field, old, new, change, ' !' if worse > 10 else ''))
+    return lines
+
+def test():
+    with tempfile.TemporaryDirectory() as tmp:
+        results = os.path.join(tmp, 'results.jsonl')
+        for kind in KINDS:
+            r = run(40, kind)
+            if r['size'] != 40 or r['cpu_per_task_ms'] <= 0 or r['tasks_s'] is None:
+                raise Exception("Strange results {}".format(r))
+            with open(results, 'a') as f:
+                f.write(json.dumps(r) + '\n')
+        if len(compare(results, results)) == 0:
+            raise Exception("Nothing to compare")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark QRunner on synthetic queues of tasks.')
+    subparsers = parser.add_subparsers(dest='action')
+    p = subparsers.add_parser('run', help='Run the benchmarks and append the results to a file.')
+    p.add_argument('--sizes', default='1000,10000', help='Comma separated numbers of tasks, e.g. 1000,10000,100000,1000000')
+    p.add_argument('--kinds', default=','.join(KINDS), help='Comma separated kinds of task: ' + ', '.join(KINDS))
+    p.add_argument('--storages', default='csv', help='Comma separated tasks databases: ' + ', '.join(STORAGES))
+    p.add_argument('--executor', choices=QRunner.EXECUTORS, default='fork')
+    p.add_argument('--max-tasks', type=int, default=64)
+    p.add_argument('--batch', action='store_true', help='Run short commands in batches.')
+    p.add_argument('--output', default='benchmark.jsonl', help='The JSON lines file to append the results to.')
+    p = subparsers.add_parser('one', help='Run one benchmark in the current directory and print its results.')
+    p.add_argument('size', type=int)
+    p.add_argument('kind', choices=KINDS)
+    p.add_argument('--storage', choices=STORAGES, default='csv')
+    p.add_argument('--executor', choices=QRunner.EXECUTORS, default='fork')
+    p.add_argument('--max-tasks', type=int, default=64)
+    p.add_argument('--batch', action='store_true', help='Run short commands in batches.')
+    p = subparsers.add_parser('compare', help='Compare two results files.')
+    p.add_argument('before')
+    p.add_argument('after')
+    if len(sys.argv) < 2:
+        test()
+        return
+    args = parser.parse_args()
+    if args.action == 'run':
+        for size in [int(s) for s in args.sizes.split(',')]:
+            for kind in args.kinds.split(','):
+                for storage in args.storages.split(','):
+                    r = run(size, kind, storage, args.executor, args.max_tasks, args.batch)
+                    print(json.dumps(r))
+                    with open(args.output, 'a') as f:
+                        f.write(json.dumps(r) + '\n')
+    elif args.action == 'one':
+        print(json.dumps(run_one(args.size, args.kind, args.storage, args.executor, args.max_tasks, args.batch)))
+    elif args.action == 'compare':
+        for line in compare(args.before, args.after):
+            print(line)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    sys.exit(main())
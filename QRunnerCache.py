@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import sys, os, re, json, time, hashlib, sqlite3
+
+from pathlib import Path
+
+'''
+Remembers the commands that succeeded, so that running the same command
+again with the same input can be skipped.
+
+An entry is keyed on a hash of the command, the directory it runs in, a
+hash of the contents of its input file and the values of the environment
+variables named in env. It keeps the exit code (only successful runs are
+kept) and the task's stdout and stderr, which are written back to the
+task's output files when the entry is used.
+
+Entries live in one SQLite file. Using an entry marks it as used, and once
+the entries add up to more than max_bytes the least recently used ones are
+dropped. invalidate() drops the entries whose command matches a regular
+expression, and clear() drops them all; so does running this file with
+`invalidate PATTERN' or `clear'.
+'''
+
+TABLE = 'results'
+
+def file_hash(filename):
+    '''The SHA-256 of a file's contents, or None if there is no such file.'''
+    h = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    return h.hexdigest()
+
+class ResultCache:
+
+    def __init__(self, filename, max_bytes=1 << 30, env=[]):
+        self.filename = str(Path(filename).resolve())
+        self.max_bytes = max_bytes
+        self.env = list(env)
+        self.conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, command TEXT, pwd TEXT, rc INTEGER, '
+                          'stdout BLOB, stderr BLOB, size INTEGER, created REAL, used REAL)'.format(TABLE))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS {0}_used ON {0} (used)'.format(TABLE))
+        self.size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM {}'.format(TABLE)).fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def key(self, command, pwd, inputfile=None):
+        '''The key for running command in directory pwd with stdin from inputfile (a path, or None).'''
+        h = None if inputfile is None else file_hash(inputfile)
+        env = {name: os.environ.get(name) for name in self.env}
+        return hashlib.sha256(json.dumps([command, pwd, h, env]).encode()).hexdigest()
+
+    def get(self, key):
+        '''The (rc, stdout, stderr) kept for key, or None.'''
+        row = self.conn.execute('SELECT rc, stdout, stderr FROM {} WHERE key = ?'.format(TABLE), (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE {} SET used = ? WHERE key = ?'.format(TABLE), (time.time(), key))
+        return row[0], row[1], row[2]
+
+    def put(self, key, command, pwd, rc, stdout=None, stderr=None):
+        '''Keep the result of a successful run; anything else is ignored.'''
+        if rc != 0:
+            return
+        size = len(key) + len(command) + len(stdout or b'') + len(stderr or b'')
+        now = time.time()
+        old = self.conn.execute('SELECT size FROM {} WHERE key = ?'.format(TABLE), (key,)).fetchone()
+        self.conn.execute('INSERT OR REPLACE INTO {} (key, command, pwd, rc, stdout, stderr, size, created, used) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(TABLE),
+                          (key, command, pwd, rc, stdout, stderr, size, now, now))
+        self.size += size - (old[0] if old is not None else 0)
+        if self.size > self.max_bytes:
+            self.evict(self.max_bytes * 9 // 10)
+
+    def evict(self, max_bytes):
+        '''Drop the least recently used entries until they add up to max_bytes or less.'''
+        rows = self.conn.execute('SELECT key, size FROM {} ORDER BY used'.format(TABLE))
+        drop = []
+        for key, size in rows:
+            if self.size <= max_bytes:
+                break
+            drop.append((key,))
+            self.size -= size
+        self.conn.executemany('DELETE FROM {} WHERE key = ?'.format(TABLE), drop)
+        return len(drop)
+
+    def invalidate(self, pattern):
+        '''Drop the entries whose command matches a regular expression; returns how many.'''
+        r = re.compile(pattern)
+        drop = [(key, size) for key, command, size in self.conn.execute('SELECT key, command, size FROM {}'.format(TABLE))
+                if r.search(command)]
+        self.conn.executemany('DELETE FROM {} WHERE key = ?'.format(TABLE), [(key,) for key, size in drop])
+        self.size -= sum(size for key, size in drop)
+        return len(drop)
+
+    def clear(self):
+        self.conn.execute('DELETE FROM {}'.format(TABLE))
+        self.size = 0
+
+    def entries(self):
+        '''(command, pwd, size, used) for every entry, most recently used first.'''
+        return self.conn.execute('SELECT command, pwd, size, used FROM {} ORDER BY used DESC'.format(TABLE)).fetchall()
+
+def test():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        inputfile = os.path.join(tmp, 'in.txt')
+        with open(inputfile, 'w') as f:
+            f.write('one')
+        with ResultCache(os.path.join(tmp, 'cache.sqlite'), max_bytes=500) as c:
+            k = c.key('cat', tmp, inputfile)
+            c.put(k, 'cat', tmp, 0, b'one', b'')
+            c.put(c.key('false', tmp), 'false', tmp, 1)
+            if c.get(k) != (0, b'one', b'') or c.get(c.key('false', tmp)) is not None:
+                raise Exception('Only the successful run should be kept')
+            with open(inputfile, 'w') as f:
+                f.write('two')
+            if c.key('cat', tmp, inputfile) == k:
+                raise Exception('Changing the input should change the key')
+            for i in range(4):
+                c.put(c.key('echo {}'.format(i), tmp), 'echo {}'.format(i), tmp, 0, b'x' * 80)
+            if c.get(k) is not None or c.size > 500:
+                raise Exception('The oldest entry should have been evicted')
+            if c.invalidate('^echo [12]$') != 2 or len(c.entries()) != 1:
+                raise Exception('Wrong entries after invalidating: {}'.format(c.entries()))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Look after a QRunner result cache.')
+    parser.add_argument('cache', help='The cache file, e.g. cache.sqlite')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.add_parser('list', help='List the cached commands, most recently used first.')
+    p = subparsers.add_parser('invalidate', help='Drop the entries whose command matches a regular expression.')
+    p.add_argument('pattern')
+    subparsers.add_parser('clear', help='Drop every entry.')
+    if len(sys.argv) < 2:
+        test()
+        return
+    args = parser.parse_args()
+    with ResultCache(args.cache) as c:
+        if args.action == 'list':
+            for command, pwd, size, used in c.entries():
+                print('{}\t{}\t{}\t{}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(used)), size, pwd, command))
+        elif args.action == 'invalidate':
+            print(c.invalidate(args.pattern))
+        elif args.action == 'clear':
+            c.clear()
+        else:
+            parser.print_help()
+
+if __name__ == '__main__':
+    sys.exit(main())
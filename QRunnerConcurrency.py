@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import csv, sys, os, time, resource, psutil
+
+'''
+Tunes how many tasks QRunner runs at once while it runs them.
+
+Every interval seconds AdaptiveConcurrency looks at the host and at how
+many tasks ended since the last look:
+
+- If the host is under pressure (the load average is above target_load,
+  the CPUs are less than min_idle percent idle, less than min_free_memory
+  of the memory is available, or there aren't enough file descriptors
+  left for more tasks), the limit is cut by a quarter.
+- Otherwise, if every slot was in use, the limit is raised by a step, as
+  long as the last raise didn't make tasks end more slowly; if it did,
+  the limit goes back down a step and stays there for a while. The step
+  doubles the limit until the first time either of those happens, and is
+  an eighth of it after that.
+
+The limit always stays between floor and ceiling. Every change is kept in
+history (and appended to log_filename as CSV, if given) along with the
+readings that led to it.
+'''
+
+LOG_HEADERS = ['time', 'limit', 'reason', 'running', 'rate', 'load', 'idle', 'free_memory', 'free_fds']
+
+class AdaptiveConcurrency:
+
+    def __init__(self, initial=64, floor=1, ceiling=1024, interval=1.0, target_load=None, min_idle=5.0,
+                 min_free_memory=0.1, fds_per_task=4, log_filename=None):
+        if target_load is None:
+            target_load = 2 * (os.cpu_count() or 1)
+        self.limit = max(floor, min(ceiling, initial))
+        self.floor = floor
+        self.ceiling = ceiling
+        self.interval = interval
+        self.target_load = target_load
+        self.min_idle = min_idle
+        self.min_free_memory = min_free_memory
+        self.fds_per_task = fds_per_task
+        self.log_filename = log_filename
+        self.history = []
+        self.finished = 0
+        self.last_update = time.monotonic()
+        self.last_rate = None
+        self.last_change = 0
+        self.hold_until = 0
+        self.slow_start = True
+        self.process = psutil.Process()
+        # The first reading only starts the measurement.
+        psutil.cpu_times_percent(interval=None)
+
+    def step(self):
+        if self.slow_start is True:
+            return self.limit
+        return max(1, self.limit // 8)
+
+    def task_finished(self):
+        self.finished += 1
+
+    def next_update(self):
+        '''Seconds until the limit may change again.'''
+        return max(0, self.last_update + self.interval - time.monotonic())
+
+    def readings(self):
+        '''The host's load average, CPU idle percentage, fraction of memory available and free file descriptors.'''
+        load = os.getloadavg()[0]
+        idle = psutil.cpu_times_percent(interval=None).idle
+        memory = psutil.virtual_memory()
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        free_fds = None
+        if soft != resource.RLIM_INFINITY:
+            free_fds = soft - self.process.num_fds()
+        return load, idle, memory.available / memory.total, free_fds
+
+    def update(self, running, now=None):
+        '''Called with the number of tasks running; returns the limit to use now.'''
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.last_update
+        if elapsed < self.interval:
+            return self.limit
+        rate = self.finished / elapsed
+        self.finished = 0
+        self.last_update = now
+        load, idle, free_memory, free_fds = self.readings()
+
+        reason = None
+        limit = self.limit
+        if load > self.target_load:
+            reason = 'load'
+        elif idle < self.min_idle:
+            reason = 'cpu'
+        elif free_memory < self.min_free_memory:
+            reason = 'memory'
+        elif free_fds is not None and free_fds < self.fds_per_task * self.step():
+            reason = 'fds'
+        if reason is not None:
+            limit = max(self.floor, self.limit * 3 // 4)
+            self.last_change = 0
+            self.slow_start = False
+        elif self.last_change > 0 and self.last_rate is not None and rate < 0.9 * self.last_rate:
+            # The last raise didn't help; go back and leave it there for a while.
+            reason = 'slower'
+            limit = max(self.floor, self.limit - self.last_change)
+            self.last_change = 0
+            self.hold_until = now + 10 * self.interval
+            self.slow_start = False
+        elif running >= self.limit and now >= self.hold_until:
+            reason = 'saturated'
+            limit = min(self.ceiling, self.limit + self.step())
+            self.last_change = limit - self.limit
+        else:
+            self.last_change = 0
+        self.last_rate = rate
+
+        if limit != self.limit:
+            self.limit = limit
+            self.log([round(time.time(), 3), limit, reason, running, round(rate, 2), round(load, 2), idle, round(free_memory, 3), free_fds])
+        return self.limit
+
+    def log(self, row):
+        self.history.append(dict(zip(LOG_HEADERS, row)))
+        if self.log_filename is not None:
+            new_log = not os.path.exists(self.log_filename)
+            with open(self.log_filename, 'a', newline='') as f:
+                w = csv.writer(f, dialect='unix')
+                if new_log:
+                    w.writerow(LOG_HEADERS)
+                w.writerow(row)
+
+def test():
+    c = AdaptiveConcurrency(initial=4, floor=2, ceiling=6, interval=1.0, target_load=float('inf'), min_idle=-1,
+                            min_free_memory=0, fds_per_task=0)
+    now = c.last_update
+    for i in range(4):
+        c.finished = 10 * (i + 1)
+        now += 1
+        c.update(c.limit, now)
+    if c.limit != 6 or [h['reason'] for h in c.history] != ['saturated']:
+        raise Exception("The limit should have gone up to the ceiling: {}".format(c.history))
+    c.target_load = -1
+    now += 1
+    if c.update(0, now) != 4 or c.history[-1]['reason'] != 'load':
+        raise Exception("The limit should have come down under load: {}".format(c.history))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import sys, re
+
+import QRunnerTasksDatabase
+
+'''
+Picks results out of a task's output while it runs, so that they end up in
+columns of the tasks file rather than taking another pass over every output
+file afterwards.
+
+A task's extract column is either a regular expression with named groups,
+e.g. `ttl=(?P<ttl>\\d+) time=(?P<time_ms>[\\d.]+)', or @NAME for the function
+of that name in QRunner(extractors={...}), which is given each line and
+returns a dict of the fields in it, or None. Each line of the task's stdout
+is looked at as it arrives, and the fields found go in columns of their
+names; a field found again later replaces what was found before.
+
+A task's output_bytes column says how much of its stdout to keep where it
+was going (its output file or the output store): blank keeps all of it and
+0 none of it, for a task whose results are all in its columns.
+'''
+
+# Longer lines are looked at in pieces of this many bytes
+MAX_LINE = 65536
+
+def check_fields(names):
+    for name in names:
+        if (name in QRunnerTasksDatabase.STANDARD_HEADERS + QRunnerTasksDatabase.OPTIONAL_HEADERS
+                or name in [QRunnerTasksDatabase.ROWNUM_KEY, QRunnerTasksDatabase.FUNCTION_KEY]):
+            raise Exception("`{}' is one of QRunner's own columns, so nothing can be extracted into it.".format(name))
+
+def compile_extract(extract, extractors=None):
+    '''The function that finds the fields in a line of output, for an extract column.'''
+    if extract.startswith('@'):
+        if extractors is None or extract[1:] not in extractors:
+            raise Exception("There is no extractor called `{}'.".format(extract[1:]))
+        return extractors[extract[1:]]
+    try:
+        rx = re.compile(extract)
+    except re.error as e:
+        raise Exception("Can't extract with `{}': {}".format(extract, e))
+    if len(rx.groupindex) == 0:
+        raise Exception("`{}' has no named groups to extract.".format(extract))
+    check_fields(rx.groupindex)
+    def search(line):
+        m = rx.search(line)
+        if m is None:
+            return None
+        return {k: v for k, v in m.groupdict().items() if v is not None}
+    return search
+
+class OutputFilter:
+    '''Stands between a task's stdout and wherever it was going: feed() it each chunk read, and
+    pass on what it returns. fields holds what has been found so far, and changed says whether
+    that has changed since the caller last set it to False.'''
+
+    def __init__(self, extract=None, keep_bytes=None):
+        self.extract = extract
+        self.keep_bytes = keep_bytes
+        self.kept = 0
+        self.partial = b''
+        self.fields = {}
+        self.changed = False
+        # Why extracting stopped, if the extract function failed
+        self.error = None
+
+    def feed(self, data):
+        if self.extract is not None and self.error is None:
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            if len(self.partial) > MAX_LINE:
+                lines.append(self.partial)
+                self.partial = b''
+            for line in lines:
+                self._line(line)
+        if self.keep_bytes is not None:
+            data = data[:max(0, self.keep_bytes - self.kept)]
+        self.kept += len(data)
+        return data
+
+    def finish(self):
+        '''The output has ended, so a last line without a newline counts too.'''
+        if self.partial != b'' and self.extract is not None and self.error is None:
+            self._line(self.partial)
+        self.partial = b''
+
+    def _line(self, line):
+        try:
+            found = self.extract(line.decode(errors='replace').rstrip('\r'))
+            if found is None:
+                return
+            check_fields(found)
+            for k, v in found.items():
+                v = None if v is None else str(v)
+                if self.fields.get(k) != v:
+                    self.fields[k] = v
+                    self.changed = True
+        except Exception as e:
+            self.error = 'Extracting from the output: {}'.format(e)
+
+def test():
+    f = OutputFilter(compile_extract(r'from (?P<address>[\d.]+): .*time=(?P<time_ms>[\d.]+)'), keep_bytes=10)
+    kept = f.feed(b'PING 10.20.50.11 (10.20.50.11): 56 data bytes\n64 bytes from 10.20.50.11: icmp_seq=0 ttl=64 ti')
+    kept += f.feed(b'me=0.052 ms\n64 bytes from 10.20.50.11: icmp_seq=1 ttl=64 time=0.061 ms')
+    if kept != b'PING 10.20' or f.fields != {'address': '10.20.50.11', 'time_ms': '0.052'}:
+        raise Exception('Unexpected {} and {}'.format(kept, f.fields))
+    f.finish()
+    if f.fields['time_ms'] != '0.061' or f.changed is False or f.error is not None:
+        raise Exception('The last line should count once the output ends: {}'.format(f.fields))
+    words = OutputFilter(compile_extract('@words', {'words': lambda line: {'words': len(line.split())}}))
+    if words.feed(b'a b c\n') != b'a b c\n' or words.fields != {'words': '3'}:
+        raise Exception('Unexpected {}'.format(words.fields))
+    bad = OutputFilter(lambda line: {'status': 'FINISHED'})
+    bad.feed(b'x\n')
+    if bad.error is None or bad.fields != {}:
+        raise Exception("An extract function shouldn't be able to set the status.")
+    for extract in ['no groups', '(?P<x', '(?P<rc>\\d+)', '@nothing']:
+        try:
+            compile_extract(extract)
+        except Exception:
+            continue
+        raise Exception("`{}' should not have been accepted.".format(extract))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
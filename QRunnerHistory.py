@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import sys, os, re, json
+
+'''
+Remembers how long tasks took, so that the longest ones can be started
+first next time.
+
+Durations are kept per template rather than per task: the command and the
+comment with every run of digits replaced by `#', so `ping -c 1 10.20.48.7'
+and `ping -c 1 10.20.51.9' share an entry. Each entry is a moving average
+and a count, so the history stays small however many tasks are run. The
+expected duration of a task is that of the templates of its command and
+comment together, or else of its command's template, or else of its
+comment's; failing that it is the average of all the entries.
+
+The history is a JSON file, read when it is opened and written by save().
+'''
+
+DIGITS = re.compile(r'\d+')
+# How much a new duration counts in the moving average
+WEIGHT = 0.3
+
+def template(s):
+    return DIGITS.sub('#', s)
+
+class RuntimeHistory:
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+        self.changed = False
+        self._mean = None
+
+    def keys(self, command, comment):
+        keys = []
+        if command is not None and comment is not None:
+            keys.append('task:' + template(command) + '\0' + template(comment))
+        if command is not None:
+            keys.append('command:' + template(command))
+        if comment is not None:
+            keys.append('comment:' + template(comment))
+        return keys
+
+    def record(self, command, comment, duration):
+        for key in self.keys(command, comment):
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = [duration, 1]
+            else:
+                entry[0] += WEIGHT * (duration - entry[0])
+                entry[1] += 1
+        self.changed = True
+        self._mean = None
+
+    def mean(self):
+        '''The average of the expected durations, or 0 if there is no history.'''
+        if self._mean is None:
+            self._mean = 0.0
+            if len(self.entries) > 0:
+                self._mean = sum(e[0] for e in self.entries.values()) / len(self.entries)
+        return self._mean
+
+    def expected(self, command, comment):
+        '''How long a task is expected to take, in seconds.'''
+        for key in self.keys(command, comment):
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry[0]
+        return self.mean()
+
+    def save(self):
+        if self.filename is None or self.changed is False:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, separators=(',', ':'))
+        os.replace(tmp, self.filename)
+        self.changed = False
+
+def makespan_bound(durations, slots):
+    '''The least wall time in which tasks of the given durations could all run on `slots' slots.'''
+    if len(durations) == 0:
+        return 0.0
+    return max(max(durations), sum(durations) / slots)
+
+def test():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        h = RuntimeHistory(os.path.join(tmp, 'history.json'))
+        h.record('ping -c 1 10.20.48.7', 'TASK_1', 2.0)
+        h.record('sleep 1', 'nap', 1.0)
+        h.save()
+        h = RuntimeHistory(os.path.join(tmp, 'history.json'))
+        if h.expected('ping -c 1 10.20.51.9', None) != 2.0 or h.expected('true', 'TASK_2') != 2.0:
+            raise Exception('Tasks should share the history of their template')
+        if h.expected('true', 'other') != h.mean() or h.mean() != 1.5:
+            raise Exception('Unknown tasks should be expected to take the average')
+    if makespan_bound([3, 1, 1, 1], 2) != 3 or makespan_bound([1, 1, 1, 1], 2) != 2:
+        raise Exception('Wrong makespan bound')
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
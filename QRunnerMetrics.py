@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import sys, os, time, json, bisect
+
+'''
+Keeps running totals about a QRunner run and writes them out every so often
+for something else to pick up.
+
+Every interval seconds, write() replaces <path>.json and <path>.prom with a
+snapshot: how many tasks are in each status, how many are running, how many
+have been launched and have ended, the launch and completion rates since
+the last snapshot, and a histogram of how long tasks took from launch to
+end. The .prom file is in the Prometheus text format, so it can be served
+by node_exporter's textfile collector as it is.
+
+Both files are written to a temporary name and renamed into place, so a
+reader never sees half a snapshot.
+'''
+
+# Upper bounds in seconds of the duration histogram's buckets
+BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800, 3600]
+
+class Metrics:
+
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.launched = 0
+        self.ended = 0
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.duration_sum = 0.0
+        self.started = time.time()
+        self.last_write = None
+        self.last_launched = 0
+        self.last_ended = 0
+        d = os.path.dirname(path)
+        if d != '':
+            os.makedirs(d, exist_ok=True)
+
+    def task_launched(self):
+        self.launched += 1
+
+    def task_ended(self, duration):
+        self.ended += 1
+        if duration is not None:
+            self.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+            self.duration_sum += duration
+
+    def next_write(self):
+        '''Seconds until the next snapshot is due.'''
+        if self.last_write is None:
+            return 0
+        return max(0, self.last_write + self.interval - time.monotonic())
+
+    def snapshot(self, statuses, running):
+        '''The numbers to write, given the number of tasks in each status and the number running.'''
+        now = time.monotonic()
+        elapsed = now - self.last_write if self.last_write is not None else time.time() - self.started
+        launch_rate = (self.launched - self.last_launched) / elapsed if elapsed > 0 else 0.0
+        end_rate = (self.ended - self.last_ended) / elapsed if elapsed > 0 else 0.0
+        self.last_write = now
+        self.last_launched = self.launched
+        self.last_ended = self.ended
+        buckets = {}
+        total = 0
+        for le, count in zip(BUCKETS + ['+Inf'], self.counts):
+            total += count
+            buckets[str(le)] = total
+        return {'time': round(time.time(), 3), 'statuses': statuses, 'running': running,
+                'launched': self.launched, 'ended': self.ended,
+                'launch_rate': round(launch_rate, 3), 'end_rate': round(end_rate, 3),
+                'duration_seconds': {'buckets': buckets, 'sum': round(self.duration_sum, 6), 'count': total}}
+
+    def write(self, statuses, running, force=False):
+        '''Write a snapshot if one is due (or force is True).'''
+        if force is False and self.next_write() > 0:
+            return
+        s = self.snapshot(statuses, running)
+        self._replace(self.path + '.json', json.dumps(s, indent=1) + '\n')
+        self._replace(self.path + '.prom', prometheus(s))
+
+    def _replace(self, filename, text):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, filename)
+
+def prometheus(s):
+    '''A snapshot in the Prometheus text format.'''
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append('# HELP qrunner_{} {}'.format(name, help))
+        lines.append('# TYPE qrunner_{} {}'.format(name, kind))
+        for labels, value in samples:
+            lines.append('qrunner_{}{} {}'.format(name, labels, value))
+    metric('tasks', 'gauge', 'Tasks in each status.',
+           [('{{status="{}"}}'.format(status), n) for status, n in sorted(s['statuses'].items())])
+    metric('running', 'gauge', 'Tasks running now.', [('', s['running'])])
+    metric('launched_total', 'counter', 'Tasks launched.', [('', s['launched'])])
+    metric('ended_total', 'counter', 'Tasks that have ended.', [('', s['ended'])])
+    metric('launch_rate', 'gauge', 'Tasks launched per second since the last snapshot.', [('', s['launch_rate'])])
+    metric('end_rate', 'gauge', 'Tasks ended per second since the last snapshot.', [('', s['end_rate'])])
+    h = s['duration_seconds']
+    metric('task_duration_seconds', 'histogram', 'Time from launch to end.',
+           [('_bucket{{le="{}"}}'.format(le), n) for le, n in h['buckets'].items()] +
+           [('_sum', h['sum']), ('_count', h['count'])])
+    return '\n'.join(lines) + '\n'
+
+def test():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        m = Metrics(os.path.join(tmp, 'm', 'metrics'))
+        for d in [0.02, 0.02, 2, 7200]:
+            m.task_launched()
+            m.task_ended(d)
+        m.write({'FINISHED': 4}, 0)
+        with open(os.path.join(tmp, 'm', 'metrics.json')) as f:
+            s = json.load(f)
+        if s['duration_seconds']['buckets']['0.05'] != 2 or s['duration_seconds']['buckets']['+Inf'] != 4 or s['ended'] != 4:
+            raise Exception("Wrong snapshot {}".format(s))
+        with open(os.path.join(tmp, 'm', 'metrics.prom')) as f:
+            if 'qrunner_task_duration_seconds_bucket{le="5"} 3\n' not in f.read():
+                raise Exception("Wrong Prometheus text")
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
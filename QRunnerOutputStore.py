@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import csv, re, sys, os, gzip
+
+from pathlib import Path
+
+'''
+Keeps the stdout and stderr of every task in one place instead of two
+files per task.
+
+The output is appended to a log split into segments (<store>.0.log,
+<store>.1.log, ...) in chunks as it arrives, so the output of tasks
+running at the same time is interleaved on disk. Every chunk gets a line in
+<store>.idx giving the task's rownum, its comment, the stream, the segment,
+and where the chunk is. The log and the index are only ever appended to.
+When a task is run again its earlier output is kept but read() and grep()
+only return the latest run's.
+
+Chunks can be gzip compressed (each is a complete gzip member) and the
+output of each task can be capped, in which case the rest is dropped and
+the number of bytes dropped is recorded in the index.
+'''
+
+INDEX_SUFFIX = '.idx'
+INDEX_HEADERS = ['rownum', 'comment', 'stream', 'segment', 'offset', 'length', 'size', 'dropped', 'compressed']
+STREAMS = ['out', 'err']
+# The stream of the index line that marks the start of a new run of a task
+START = 'start'
+
+class OutputStore:
+
+    def __init__(self, path, compress=False, max_task_bytes=None, segment_bytes=1 << 28, buffer_bytes=1 << 16):
+        '''path is the name of the store without a suffix, e.g. "output" for output.idx and output.0.log.'''
+        self.path = str(Path(path).resolve())
+        self.index_filename = self.path + INDEX_SUFFIX
+        self.compress = compress
+        self.max_task_bytes = max_task_bytes
+        self.segment_bytes = segment_bytes
+        self.buffer_bytes = buffer_bytes
+        self.buffers = {}
+        self.index = None
+        self.index_f = None
+        self.index_w = None
+        self.segment = None
+        self.segment_f = None
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def segment_filename(self, segment):
+        return '{}.{}.log'.format(self.path, segment)
+
+    def _open_for_append(self):
+        if self.index_f is not None:
+            return
+        Path(self.index_filename).parent.mkdir(parents=True, exist_ok=True)
+        new_index = not os.path.exists(self.index_filename)
+        self.index_f = open(self.index_filename, 'a', newline='')
+        self.index_w = csv.writer(self.index_f, dialect='unix')
+        if new_index:
+            self.index_w.writerow(INDEX_HEADERS)
+        self.segment = 0
+        while os.path.exists(self.segment_filename(self.segment + 1)):
+            self.segment += 1
+        self.segment_f = open(self.segment_filename(self.segment), 'ab')
+
+    def _index_line(self, d):
+        self.index_w.writerow([d.get(h) for h in INDEX_HEADERS])
+        if self.index is not None:
+            self._index_add(d)
+
+    def start(self, rownum, comment=None):
+        '''Say that a task is starting again; its earlier output is no longer returned.'''
+        self._open_for_append()
+        self._index_line({'rownum': rownum, 'comment': comment, 'stream': START})
+        self.index_f.flush()
+
+    def write(self, rownum, stream, data, comment=None):
+        '''Add some output of a task.'''
+        key = (rownum, stream)
+        if key not in self.buffers:
+            self.buffers[key] = [bytearray(), 0, 0, comment]
+        b = self.buffers[key]
+        if self.max_task_bytes is not None:
+            room = self.max_task_bytes - b[1]
+            if len(data) > room:
+                b[2] += len(data) - max(room, 0)
+                data = data[:max(room, 0)]
+        b[0] += data
+        b[1] += len(data)
+        if len(b[0]) >= self.buffer_bytes:
+            self._append(rownum, stream, b)
+
+    def _append(self, rownum, stream, b, dropped=0):
+        data = bytes(b[0])
+        b[0] = bytearray()
+        if len(data) == 0 and dropped == 0:
+            return
+        self._open_for_append()
+        size = len(data)
+        if self.compress is True and size > 0:
+            data = gzip.compress(data)
+        if self.segment_f.tell() > 0 and self.segment_f.tell() + len(data) > self.segment_bytes:
+            self.segment_f.close()
+            self.segment += 1
+            self.segment_f = open(self.segment_filename(self.segment), 'ab')
+        offset = self.segment_f.tell()
+        self.segment_f.write(data)
+        self.segment_f.flush()
+        self._index_line({'rownum': rownum, 'comment': b[3], 'stream': stream, 'segment': self.segment,
+                          'offset': offset, 'length': len(data), 'size': size,
+                          'dropped': dropped or None, 'compressed': 1 if self.compress is True and size > 0 else None})
+        self.index_f.flush()
+
+    def end(self, rownum, stream):
+        '''Say that a task's stream is finished and save whatever is left of it.'''
+        b = self.buffers.pop((rownum, stream), None)
+        if b is not None:
+            self._append(rownum, stream, b, dropped=b[2])
+
+    def close(self):
+        for rownum, stream in list(self.buffers):
+            self.end(rownum, stream)
+        if self.index_f is not None:
+            self.index_f.close()
+            self.segment_f.close()
+            self.index_f = None
+            self.index_w = None
+            self.segment_f = None
+
+    def _index_add(self, d):
+        rownum = int(d['rownum'])
+        if d['stream'] == START:
+            self.index[rownum] = {'comment': d['comment'], 'chunks': []}
+            return
+        if rownum not in self.index:
+            self.index[rownum] = {'comment': d['comment'], 'chunks': []}
+        self.index[rownum]['chunks'].append(d)
+
+    def load_index(self):
+        '''Read the index; the chunks of each task's latest run by rownum.'''
+        if self.index is None:
+            self.index = {}
+            try:
+                with open(self.index_filename, 'r', newline='') as f:
+                    for d in csv.DictReader(f, dialect='unix'):
+                        if None in d.values() or None in d:
+                            break
+                        self._index_add(d)
+            except FileNotFoundError:
+                pass
+        return self.index
+
+    def tasks(self):
+        '''(rownum, comment) of every task with output, by rownum.'''
+        return [(rownum, t['comment'] or None) for rownum, t in sorted(self.load_index().items())]
+
+    def read(self, rownum, stream='out'):
+        '''The output of a task's latest run, as bytes.'''
+        if stream not in STREAMS:
+            raise Exception("Stream `{}' not recognised.".format(stream))
+        t = self.load_index().get(rownum)
+        if t is None:
+            return b''
+        if self.segment_f is not None:
+            self.segment_f.flush()
+        data = []
+        files = {}
+        try:
+            for d in t['chunks']:
+                if d['stream'] != stream or d['length'] in ['', None] or int(d['length']) == 0:
+                    continue
+                segment = int(d['segment'])
+                if segment not in files:
+                    files[segment] = open(self.segment_filename(segment), 'rb')
+                f = files[segment]
+                f.seek(int(d['offset']))
+                chunk = f.read(int(d['length']))
+                if d['compressed'] not in ['', None]:
+                    chunk = gzip.decompress(chunk)
+                data.append(chunk)
+        finally:
+            for f in files.values():
+                f.close()
+        return b''.join(data)
+
+    def dropped(self, rownum, stream='out'):
+        '''How many bytes of a task's latest run were dropped because of max_task_bytes.'''
+        t = self.load_index().get(rownum)
+        if t is None:
+            return 0
+        return sum(int(d['dropped']) for d in t['chunks'] if d['stream'] == stream and d['dropped'] not in ['', None])
+
+    def grep(self, pattern, stream='out'):
+        '''Lines of output matching a regular expression, as (rownum, comment, line).'''
+        r = re.compile(pattern)
+        for rownum, comment in self.tasks():
+            for line in self.read(rownum, stream).decode(errors='replace').splitlines():
+                if r.search(line):
+                    yield (rownum, comment, line)
+
+def test():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        with OutputStore(os.path.join(d, 'output'), compress=True, max_task_bytes=10, buffer_bytes=4) as store:
+            store.start(0, 'a')
+            store.start(1, 'b')
+            store.write(0, 'out', b'hello ', 'a')
+            store.write(1, 'out', b'64 bytes from x\n', 'b')
+            store.write(0, 'out', b'world\n', 'a')
+            store.end(0, 'out')
+            store.end(1, 'out')
+        store = OutputStore(os.path.join(d, 'output'))
+        if store.read(0) != b'hello worl' or store.dropped(0) != 2:
+            raise Exception("Read back {!r}".format(store.read(0)))
+        if [l for l in store.grep('64 bytes')] != [(1, 'b', '64 bytes f')]:
+            raise Exception("grep didn't find the output of task 1")
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Read the output QRunner kept in an output store.')
+    parser.add_argument('store', help='The output store, e.g. demo/output for demo/output.idx')
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.add_parser('list', help='List the tasks that have output.')
+    p = subparsers.add_parser('cat', help="Print one task's output.")
+    p.add_argument('rownum', type=int)
+    p.add_argument('--stream', choices=STREAMS, default='out')
+    p = subparsers.add_parser('grep', help='Print the lines of output matching a regular expression.')
+    p.add_argument('pattern')
+    p.add_argument('--stream', choices=STREAMS, default='out')
+    if len(sys.argv) < 2:
+        test()
+        return
+    args = parser.parse_args()
+    store = OutputStore(args.store)
+    if args.action == 'list':
+        for rownum, comment in store.tasks():
+            print('{},{}'.format(rownum, comment or ''))
+    elif args.action == 'cat':
+        sys.stdout.buffer.write(store.read(args.rownum, args.stream))
+    elif args.action == 'grep':
+        for rownum, comment, line in store.grep(args.pattern, args.stream):
+            print('{}:{}'.format(comment or rownum, line))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import sys, io, csv, json, time
+
+'''
+Tells whoever is watching a run how it is going, without holding it up.
+
+Rather than passing on every change as it happens, a ProgressEvents only
+notes which tasks changed, and every interval seconds hands the sinks a
+ProgressBatch: the percentage done and the tasks that changed since the
+last batch, each once however often it changed. A task's row is turned
+into CSV text only if a sink asks the batch for it.
+
+A sink is anything with send(batch) (and, optionally, close()):
+
+    PercentageSink()            writes the percentage to the terminal
+    JSONLinesSink(filename)     appends a line per batch to a file
+    CallbackSink(progress)      calls progress(update_text=..., update_fields=...)
+                                for each task and then progress(percentage=...)
+
+A plain function passed as a sink is taken as a CallbackSink.
+'''
+
+def row_text(row):
+    '''A task's values as a line of CSV.'''
+    f = io.StringIO()
+    csv.writer(f, dialect='unix').writerow(row)
+    return f.getvalue()
+
+class ProgressBatch:
+
+    def __init__(self, tdb, rownums, percentage):
+        self.tdb = tdb
+        self.rownums = rownums
+        self.percentage = percentage
+        self.time = time.time()
+        self._tasks = None
+
+    def tasks(self):
+        '''The tasks that changed, as dicts like get_task() returns.'''
+        if self._tasks is None:
+            self._tasks = [self.tdb.get_task(i) for i in self.rownums]
+        return self._tasks
+
+    def texts(self):
+        '''The rows of the tasks that changed, each as a line of CSV.'''
+        return [row_text(self.tdb.rawdata[i]) for i in self.rownums]
+
+class PercentageSink:
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.shown = None
+
+    def send(self, batch):
+        if batch.percentage != self.shown:
+            self.stream.write("\r{}%   ".format(batch.percentage))
+            self.stream.flush()
+            self.shown = batch.percentage
+
+class JSONLinesSink:
+    '''Appends {"time": ..., "percentage": ..., "tasks": [...]} to filename for each batch.'''
+
+    def __init__(self, filename):
+        self.f = open(filename, 'a')
+
+    def send(self, batch):
+        tasks = [{k: v for k, v in t.items() if not callable(v)} for t in batch.tasks()]
+        self.f.write(json.dumps({'time': batch.time, 'percentage': batch.percentage, 'tasks': tasks}, default=str) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class CallbackSink:
+    '''Calls progress the way QRunner always has. With text=False, update_text is left None and
+    the rows are never turned into CSV.'''
+
+    def __init__(self, progress, text=True):
+        self.progress = progress
+        self.text = text
+
+    def send(self, batch):
+        texts = batch.texts() if self.text is True else [None] * len(batch.rownums)
+        for text, t in zip(texts, batch.tasks()):
+            self.progress(update_text=text, update_fields=t)
+        self.progress(percentage=batch.percentage)
+
+class ProgressEvents:
+
+    def __init__(self, sinks, interval=0.5):
+        if callable(sinks) or hasattr(sinks, 'send'):
+            sinks = [sinks]
+        self.sinks = [s if hasattr(s, 'send') else CallbackSink(s) for s in sinks]
+        self.interval = interval
+        # The rows changed since the last batch, in the order they first changed
+        self.changed = {}
+        self.last_flush = None
+        self.flushed = False
+
+    def task_changed(self, rownum):
+        self.changed[rownum] = None
+
+    def next_flush(self):
+        '''Seconds until a batch is due, or None if there is nothing to send.'''
+        if len(self.changed) == 0:
+            return None
+        if self.last_flush is None:
+            return 0
+        return max(0, self.last_flush + self.interval - time.monotonic())
+
+    def flush(self, tdb, percentage, force=False):
+        '''Send a batch if one is due, or at once with force=True; percentage is a function
+        returning the percentage done, only called when a batch is sent.'''
+        now = time.monotonic()
+        if force is False:
+            if len(self.changed) == 0 and self.flushed is True:
+                return
+            if self.last_flush is not None and now < self.last_flush + self.interval:
+                return
+        batch = ProgressBatch(tdb, list(self.changed), percentage())
+        self.changed = {}
+        self.last_flush = now
+        self.flushed = True
+        for s in self.sinks:
+            s.send(batch)
+
+    def close(self):
+        for s in self.sinks:
+            if hasattr(s, 'close'):
+                s.close()
+        self.sinks = []
+
+def test():
+    import os, tempfile, QRunnerTasksDatabase
+    with tempfile.TemporaryDirectory() as tmp:
+        calls = []
+        def progress(update_text=None, update_fields=None, percentage=None):
+            calls.append((update_text, update_fields, percentage))
+        filename = os.path.join(tmp, 'progress.jsonl')
+        events = ProgressEvents([progress, JSONLinesSink(filename), PercentageSink(io.StringIO())], interval=60)
+        tdb = QRunnerTasksDatabase.QRunnerTasksDatabase(tasksdb_filename=None, progress=events)
+        tdb.add_task(comment='a', status='NEW', command='true')
+        tdb.add_task(comment='b', status='NEW', command='true')
+        events.flush(tdb, lambda: '0')
+        for status in ['LAUNCHING', 'RUNNING', 'FINISHED']:
+            t = tdb.get_task(1)
+            t['status'] = status
+            tdb.set_task(t, no_update=True)
+            events.flush(tdb, lambda: '50')
+        if len(calls) != 1 or calls[0][2] != '0':
+            raise Exception('Changes within the interval should wait for the next batch: {}'.format(calls))
+        events.flush(tdb, lambda: '100', force=True)
+        events.close()
+        if calls[1:] != [('"b","FINISHED","","","true"' + ',""' * (len(tdb.headers) - 5) + '\n', tdb.get_task(1), None),
+                         (None, None, '100')]:
+            raise Exception('A task that changed three times should be sent once: {}'.format(calls))
+        with open(filename) as f:
+            lines = [json.loads(l) for l in f]
+        if [l['percentage'] for l in lines] != ['0', '100'] or lines[1]['tasks'][0]['status'] != 'FINISHED':
+            raise Exception('Unexpected JSON lines {}'.format(lines))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
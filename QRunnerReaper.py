@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import sys, os, signal, selectors, psutil
+
+'''
+Waits for child processes to exit without scanning the process table.
+
+On Linux each child gets a pidfd (os.pidfd_open) that becomes readable when
+the child exits. Elsewhere a SIGCHLD handler writes to a pipe and the
+registered children are polled with os.waitpid(WNOHANG). Either way, poll()
+sleeps in a selector until at least one child has exited (or the timeout
+passes) and then returns every child that has exited, so completions are
+handled in batches.
+
+Children are collected with os.wait4, so their resource usage comes back
+along with their exit status.
+
+Other file descriptors can be added with watch(); their callbacks are run
+from poll() when they become readable.
+
+adopt() watches a process that isn't our child, such as one started by a
+coordinator that has since gone away. Its exit status can't be collected,
+so poll() reports it with a status of None once it has gone: through its
+pidfd, or by checking for it every ADOPTED_POLL seconds without pidfds.
+start_time() tells such a process apart from a later one given the same
+pid.
+'''
+
+ADOPTED_POLL = 1.0
+
+# Linux gives a process's start time in clock ticks since boot, which is
+# exact and cheaper to read than through psutil.
+PROC_STAT = os.path.exists('/proc/self/stat')
+
+def start_time(pid):
+    '''When a process started, as a string that is the same every time for that process; None if there is no such process.'''
+    if PROC_STAT is True:
+        try:
+            with open('/proc/{}/stat'.format(pid), 'rb') as f:
+                s = f.read()
+        except (FileNotFoundError, ProcessLookupError):
+            return None
+        # The command name in brackets may contain spaces; start time is the 22nd field.
+        return s[s.rindex(b')') + 2:].split()[19].decode()
+    try:
+        return '{:.2f}'.format(psutil.Process(pid).create_time())
+    except psutil.NoSuchProcess:
+        return None
+
+class Reaper:
+
+    def __init__(self, use_pidfd=None):
+        if use_pidfd is None:
+            use_pidfd = hasattr(os, 'pidfd_open')
+        self.use_pidfd = use_pidfd
+        self.selector = selectors.DefaultSelector()
+        self.pids = {}
+        self.gone = []
+        # Processes that aren't our children, watched without a pidfd
+        self.adopted = {}
+        self.sigchld_r = None
+        self.sigchld_w = None
+        self.old_sigchld = None
+        if self.use_pidfd is not True:
+            self.sigchld_r, self.sigchld_w = os.pipe()
+            os.set_blocking(self.sigchld_r, False)
+            os.set_blocking(self.sigchld_w, False)
+            self.old_sigchld = signal.signal(signal.SIGCHLD, self._sigchld)
+            self.selector.register(self.sigchld_r, selectors.EVENT_READ, None)
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def _sigchld(self, signum, frame):
+        try:
+            os.write(self.sigchld_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        for pid in list(self.pids):
+            self.unregister(pid)
+        if self.sigchld_r is not None:
+            signal.signal(signal.SIGCHLD, self.old_sigchld)
+            self.selector.unregister(self.sigchld_r)
+            os.close(self.sigchld_r)
+            os.close(self.sigchld_w)
+            self.sigchld_r = None
+            self.sigchld_w = None
+        self.selector.close()
+
+    def register(self, pid):
+        '''Start watching a child process.'''
+        pidfd = None
+        if self.use_pidfd is True:
+            try:
+                pidfd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                # Already exited and collected; report it from the next poll().
+                self.gone.append(pid)
+            else:
+                self.selector.register(pidfd, selectors.EVENT_READ, pid)
+        self.pids[pid] = pidfd
+
+    def adopt(self, pid):
+        '''Start watching a process that isn't our child.'''
+        if self.use_pidfd is True:
+            self.register(pid)
+        else:
+            self.adopted[pid] = True
+
+    def unregister(self, pid):
+        self.adopted.pop(pid, None)
+        pidfd = self.pids.pop(pid, None)
+        if pidfd is not None:
+            self.selector.unregister(pidfd)
+            os.close(pidfd)
+
+    def watch(self, fd, callback):
+        '''Call callback(fd) from poll() whenever fd is readable.'''
+        self.selector.register(fd, selectors.EVENT_READ, callback)
+
+    def unwatch(self, fd):
+        self.selector.unregister(fd)
+
+    def reap(self, pid):
+        '''Collect the exit status of a child if it has exited.
+
+        Returns (pid, status, rusage), (pid, None, None) if the status was
+        already collected by someone else (e.g. subprocess.Popen), or None if
+        it is still running.'''
+        try:
+            wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+        except ChildProcessError:
+            return (pid, None, None)
+        if wpid == 0:
+            return None
+        return (pid, status, rusage)
+
+    def poll(self, timeout=None):
+        '''Wait up to timeout seconds (forever if None) and return a list of (pid, status, rusage) for exited children.'''
+        if timeout is None and len(self.pids) == 0 and len(self.gone) == 0 and len(self.adopted) == 0 and \
+           len(self.selector.get_map()) == (0 if self.sigchld_r is None else 1):
+            return []
+        exited = []
+        if len(self.adopted) > 0 and (timeout is None or timeout > ADOPTED_POLL):
+            timeout = ADOPTED_POLL
+        check_all = False
+        if len(self.gone) > 0:
+            exited = [self.reap(pid) for pid in self.gone if pid in self.pids]
+            self.gone = []
+            timeout = 0
+        for key, events in self.selector.select(timeout):
+            if key.fd == self.sigchld_r:
+                try:
+                    while os.read(self.sigchld_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                check_all = True
+            elif callable(key.data):
+                key.data(key.fd)
+            elif key.data in self.pids:
+                r = self.reap(key.data)
+                if r is not None:
+                    exited.append(r)
+        if check_all is True:
+            for pid in list(self.pids):
+                r = self.reap(pid)
+                if r is not None:
+                    exited.append(r)
+        for pid in list(self.adopted):
+            if not self.is_running(pid):
+                exited.append((pid, None, None))
+        for pid, status, rusage in exited:
+            self.unregister(pid)
+        return exited
+
+    @staticmethod
+    def is_alive(pid):
+        '''Whether a process exists, checked for that one pid only.'''
+        return psutil.pid_exists(pid)
+
+    @staticmethod
+    def is_running(pid):
+        '''Whether a process exists and hasn't exited, for a process whose parent may not have collected it yet.'''
+        try:
+            return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return False
+
+def test():
+    import subprocess
+    with Reaper() as reaper:
+        ps = [subprocess.Popen(['sh', '-c', 'exit {}'.format(i)]) for i in range(4)]
+        for p in ps:
+            reaper.register(p.pid)
+        rcs = {}
+        while len(rcs) < len(ps):
+            for pid, status, rusage in reaper.poll(timeout=5):
+                rcs[pid] = os.waitstatus_to_exitcode(status)
+        for i, p in enumerate(ps):
+            p.returncode = rcs[p.pid]
+            if rcs[p.pid] != i:
+                raise Exception("Process {} returned {}, not {}".format(p.pid, rcs[p.pid], i))
+    for use_pidfd in sorted(set([False, hasattr(os, 'pidfd_open')])):
+        # A grandchild, which we can watch but not wait for
+        pid = int(subprocess.check_output(['sh', '-c', 'sleep 0.2 >/dev/null & echo $!']))
+        if start_time(pid) in [None, start_time(os.getpid())]:
+            raise Exception("Wrong start time {} for {}".format(start_time(pid), pid))
+        with Reaper(use_pidfd=use_pidfd) as reaper:
+            reaper.adopt(pid)
+            exited = []
+            while len(exited) == 0:
+                exited = reaper.poll(timeout=5)
+            if exited != [(pid, None, None)]:
+                raise Exception("Unexpected {} for an adopted process".format(exited))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
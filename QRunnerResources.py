@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import sys, os, math, resource, psutil
+
+'''
+Keeps track of what the running tasks have said they need, so that QRunner
+only launches a task when it fits in what is left of the host.
+
+A task can declare cpus, mem_mb and slots in columns of the same names. A
+task that doesn't declare them takes one slot and no CPUs or memory, so
+without any declarations QRunner just runs max_tasks tasks at once, as it
+always has. The host's budget is max_tasks slots, its number of CPUs and
+its total memory, unless cpus and mem_mb are given.
+
+A task bigger than the whole budget still runs, on its own. Each task is
+also held to what it declared: mem_mb becomes its RLIMIT_AS and, if it has
+a timeout, cpus times the timeout becomes its RLIMIT_CPU.
+'''
+
+RESOURCES = ['cpus', 'mem_mb', 'slots']
+MiB = 1024 * 1024
+
+class ResourceBudget:
+
+    def __init__(self, cpus=None, mem_mb=None):
+        if cpus is None:
+            cpus = os.cpu_count() or 1
+        if mem_mb is None:
+            mem_mb = psutil.virtual_memory().total // MiB
+        self.total = {'cpus': float(cpus), 'mem_mb': float(mem_mb)}
+        self.used = {r: 0.0 for r in RESOURCES}
+        self.claims = {}
+
+    def needs(self, t):
+        '''What a task declared it needs, as a dict of floats.'''
+        need = {'cpus': 0.0, 'mem_mb': 0.0, 'slots': 1.0}
+        for r in RESOURCES:
+            if t.get(r) is not None:
+                need[r] = float(t[r])
+                if need[r] < 0:
+                    raise Exception("Task `{}' needs {} {}.".format(t['comment'], t[r], r))
+        return need
+
+    def fits(self, need, slots):
+        '''Whether a task fits in what is left, with `slots' slots in total. Anything fits if nothing is running.'''
+        if len(self.claims) == 0:
+            return True
+        if self.used['slots'] + need['slots'] > slots:
+            return False
+        for r in self.total:
+            if need[r] > 0 and self.used[r] + need[r] > self.total[r]:
+                return False
+        return True
+
+    def free_slots(self, slots):
+        return slots - self.used['slots']
+
+    def claim(self, rownum, need):
+        self.claims[rownum] = need
+        for r in RESOURCES:
+            self.used[r] += need[r]
+
+    def release(self, rownum):
+        need = self.claims.pop(rownum, None)
+        if need is not None:
+            for r in RESOURCES:
+                self.used[r] -= need[r]
+
+    def rlimits(self, need, timeout):
+        '''The resource limits for a task as [(resource, (soft, hard))].'''
+        limits = []
+        if need['mem_mb'] > 0:
+            limits.append((resource.RLIMIT_AS, (int(need['mem_mb'] * MiB), int(need['mem_mb'] * MiB))))
+        if need['cpus'] > 0 and timeout is not None and float(timeout) > 0:
+            seconds = math.ceil(need['cpus'] * float(timeout))
+            # SIGXCPU at the soft limit, SIGKILL a second later.
+            limits.append((resource.RLIMIT_CPU, (seconds, seconds + 1)))
+        return limits
+
+def apply_rlimits(pid, limits):
+    '''Apply resource limits to a process that has just been started, or to ourselves if pid is 0.'''
+    for res, (soft, hard) in limits:
+        try:
+            if pid == 0:
+                resource.setrlimit(res, (soft, hard))
+            else:
+                resource.prlimit(pid, res, (soft, hard))
+        except ProcessLookupError:
+            # It has already exited.
+            return
+
+def test():
+    b = ResourceBudget(cpus=4, mem_mb=1000)
+    big = b.needs({'comment': 'big', 'cpus': '4', 'mem_mb': '800'})
+    small = b.needs({'comment': 'small', 'cpus': '1', 'mem_mb': '100'})
+    if b.fits(big, 8) is not True:
+        raise Exception('A task always fits on an empty host')
+    b.claim(0, small)
+    if b.fits(big, 8) is True or b.fits(small, 8) is not True:
+        raise Exception('Only small tasks should fit around a small one')
+    b.release(0)
+    if b.used['cpus'] != 0:
+        raise Exception('Releasing a task should give back its CPUs')
+    if b.rlimits(small, 10) != [(resource.RLIMIT_AS, (100 * MiB, 100 * MiB)), (resource.RLIMIT_CPU, (10, 11))]:
+        raise Exception('Wrong resource limits {}'.format(b.rlimits(small, 10)))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import sys, os, json, sqlite3, contextlib
+
+from pathlib import Path
+
+import QRunnerTasksDatabase
+
+'''
+Keeps a QRunnerTasksDatabase in an SQLite file instead of a CSV file.
+
+Each change is a single-row update, so large queues don't pay for rewriting
+the whole file. The database runs in WAL mode and the tasks table is indexed
+on status, group and pid so other programs can query it while QRunner runs.
+
+With shared=True, lock() is an immediate transaction, so runners sharing
+the database claim and save tasks one at a time.
+'''
+
+META_TABLE = 'qrunner_meta'
+TASKS_TABLE = 'tasks'
+INDEXED_HEADERS = ['status', 'group', 'pid']
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def sqlite_value(v):
+    if v is None or isinstance(v, (int, float)):
+        return v
+    return str(v)
+
+class SQLiteStorage(QRunnerTasksDatabase.TasksStorage):
+
+    def __init__(self, filename, timeout=30, shared=False):
+        self.filename = str(Path(filename).resolve())
+        self.timeout = timeout
+        self.conn = None
+        self.columns = []
+        self.incremental = True
+        self.shared = shared
+        # How many lock()s deep we are in the current transaction
+        self.depth = 0
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT)'.format(META_TABLE))
+        return self.conn
+
+    def get_meta(self, key):
+        row = self.connect().execute('SELECT value FROM {} WHERE key = ?'.format(META_TABLE), (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, key, value):
+        self.connect().execute('INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)'.format(META_TABLE), (key, value))
+
+    def ensure_columns(self, headers):
+        conn = self.connect()
+        if len(self.columns) == 0:
+            conn.execute('CREATE TABLE IF NOT EXISTS {} ({} INTEGER PRIMARY KEY, {})'.format(
+                TASKS_TABLE, quote(QRunnerTasksDatabase.ROWNUM_KEY), ', '.join(quote(h) + ' TEXT' for h in headers)))
+            self.columns = [r[1] for r in conn.execute('PRAGMA table_info({})'.format(TASKS_TABLE))]
+        for h in headers:
+            if h not in self.columns:
+                conn.execute('ALTER TABLE {} ADD COLUMN {} TEXT'.format(TASKS_TABLE, quote(h)))
+                self.columns.append(h)
+        for h in INDEXED_HEADERS:
+            if h in self.columns:
+                conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    quote(TASKS_TABLE + '_' + h), TASKS_TABLE, quote(h)))
+
+    def load_chunks(self, tdb, chunk_size):
+        headers = self.get_meta('headers')
+        if headers is None:
+            tdb.preservetext = QRunnerTasksDatabase.DEFAULT_TASKS_FILE_TEXT
+            tdb._set_headers(QRunnerTasksDatabase.STANDARD_HEADERS)
+            self.connect().execute('BEGIN IMMEDIATE')
+            self.set_meta('headers', json.dumps(tdb.headers))
+            self.set_meta('preservetext', tdb.preservetext)
+            self.ensure_columns(tdb.headers)
+            self.conn.execute('COMMIT')
+            return
+        tdb._set_headers(json.loads(headers))
+        tdb.preservetext = self.get_meta('preservetext') or ''
+        self.ensure_columns(tdb.headers)
+        cur = self.conn.execute('SELECT {}, {} FROM {} ORDER BY {}'.format(
+            quote(QRunnerTasksDatabase.ROWNUM_KEY), ', '.join(quote(h) for h in tdb.headers),
+            TASKS_TABLE, quote(QRunnerTasksDatabase.ROWNUM_KEY)))
+        while True:
+            rows = cur.fetchmany(chunk_size or 10000)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                if row[0] != tdb.rawdata_len:
+                    raise Exception("Task {} is missing from `{}'.".format(tdb.rawdata_len, self.filename))
+                tdb._add_row(row[1:])
+            if chunk_size is not None:
+                yield
+
+    @contextlib.contextmanager
+    def lock(self):
+        if self.depth > 0:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+            return
+        self.connect().execute('BEGIN IMMEDIATE')
+        self.depth = 1
+        try:
+            yield
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        else:
+            self.conn.execute('COMMIT')
+        finally:
+            self.depth = 0
+
+    def _take_headers(self, tdb):
+        '''Add the columns other runners have added to tdb, and save any tdb has that they haven't.'''
+        headers = json.loads(self.get_meta('headers') or '[]')
+        for h in headers:
+            tdb.add_column(h)
+        if headers != tdb.headers:
+            self.set_meta('headers', json.dumps(tdb.headers))
+        self.columns = [r[1] for r in self.conn.execute('PRAGMA table_info({})'.format(TASKS_TABLE))]
+        self.ensure_columns(tdb.headers)
+
+    def read_rows(self, tdb, rownums=None, first=0):
+        with self.lock():
+            self._take_headers(tdb)
+            sql = 'SELECT {}, {} FROM {}'.format(quote(QRunnerTasksDatabase.ROWNUM_KEY),
+                                                 ', '.join(quote(h) for h in tdb.headers), TASKS_TABLE)
+            if rownums is None:
+                return [(row[0], row[1:]) for row in self.conn.execute(
+                    sql + ' WHERE {0} >= ? ORDER BY {0}'.format(quote(QRunnerTasksDatabase.ROWNUM_KEY)), (first,))]
+            rownums = list(rownums)
+            rows = []
+            # SQLite only takes so many parameters at once.
+            for j in range(0, len(rownums), 500):
+                chunk = rownums[j:j + 500]
+                rows.extend((row[0], row[1:]) for row in self.conn.execute(
+                    sql + ' WHERE {} IN ({})'.format(quote(QRunnerTasksDatabase.ROWNUM_KEY), ', '.join('?' for i in chunk)), chunk))
+            return rows
+
+    def _write_rows(self, tdb, rownums):
+        sql = 'INSERT OR REPLACE INTO {} ({}, {}) VALUES (?, {})'.format(
+            TASKS_TABLE, quote(QRunnerTasksDatabase.ROWNUM_KEY), ', '.join(quote(h) for h in tdb.headers),
+            ', '.join('?' for h in tdb.headers))
+        self.conn.executemany(sql, ([i] + [sqlite_value(v) for v in tdb.rawdata[i]] for i in rownums))
+
+    def save_rows(self, tdb, rownums):
+        if len(rownums) == 0:
+            return
+        with self.lock():
+            if self.shared is True:
+                self._take_headers(tdb)
+            else:
+                self.ensure_columns(tdb.headers)
+            self._write_rows(tdb, rownums)
+
+    def save_all(self, tdb):
+        with self.lock():
+            self.set_meta('headers', json.dumps(tdb.headers))
+            self.set_meta('preservetext', tdb.preservetext)
+            self.ensure_columns(tdb.headers)
+            self.conn.execute('DELETE FROM {} WHERE {} >= ?'.format(
+                TASKS_TABLE, quote(QRunnerTasksDatabase.ROWNUM_KEY)), (tdb.rawdata_len,))
+            self._write_rows(tdb, range(tdb.rawdata_len))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.columns = []
+
+def test():
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        filename = os.path.join(d, 'tasks.sqlite')
+        with QRunnerTasksDatabase.QRunnerTasksDatabase(tasksdb_filename=filename) as tdb:
+            tdb.add_task(comment='My_Task1', status='NEW', command='true', group=1)
+        with QRunnerTasksDatabase.QRunnerTasksDatabase(tasksdb_filename=filename) as tdb:
+            if tdb.count_by_status('NEW', group=1) != 1:
+                raise Exception("Task was not saved to `{}'".format(filename))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+import sys, re, heapq
+
+import QRunnerTasksDatabase
+
+'''
+Decides which NEW tasks may be launched next.
+
+Every task is a node in a dependency graph and is released as soon as all of
+its predecessors have ended (finished, failed, died or been killed), so the
+runner can keep its slots full across group boundaries.
+
+A task's predecessors come from its depends_on column: a list of references
+separated by spaces or semicolons, where each reference is a task comment,
+a row number (counting from 0, used when no task has that comment), or
+group:N for every task in group N. Tasks without depends_on keep the usual
+group semantics: a task in group N waits for every task in the groups before
+it, which is expressed with one barrier node per group rather than an edge
+between every pair of tasks. With group_barriers=False such tasks don't wait
+for anything.
+
+Ready tasks are handed out in file order, or in the order of the keys that
+priority(rownum) gives them, lowest first.
+'''
+
+# The statuses of tasks that haven't ended yet
+PENDING_STATUSES = ['NEW', 'LAUNCHING', 'RUNNING', 'KILLING', 'KILLING9']
+
+DEPENDS_ON_KEY = 'depends_on'
+ROWNUM_KEY = QRunnerTasksDatabase.ROWNUM_KEY
+
+class DependencyScheduler:
+    '''Tasks are added with sync() as the database reads them, so a runner can
+    start on a streamed tasks file before all of it has been read; close()
+    says that there are no more to come.
+
+    Until then a group isn't finished even if all of its tasks so far have
+    ended, and comment references wait for every task with that comment. In
+    a streamed file the groups therefore have to appear in increasing order.
+
+    Tasks may still be added after close() (see check_task()): a task joins
+    its group, which the groups after it then wait for unless its barrier
+    has already ended, and may only depend on tasks that are already there.
+
+    With more=True, tasks are still to come once the database has been read
+    (the tasks of templates, say), and it's up to the caller to close().'''
+
+    def __init__(self, tdb, group_barriers=True, priority=None, more=False):
+        self.tdb = tdb
+        self.more = more
+        self.group_barriers = group_barriers
+        self.priority = priority
+        self.waiting = {}
+        self.successors = {}
+        self.ended = {}
+        self.ready = []
+        self.num_pending = 0
+        self.synced = 0
+        self.closed = False
+        self.in_order = False
+        self.last_group = None
+        # The groups added so far
+        self.groups = {}
+        self.row_group = None
+        self.previous = {}
+        self.open = {}
+        self.comments = None
+        self.refs = {}
+        self.build()
+
+    def _add_edge(self, before, after):
+        if before in self.ended:
+            return
+        if before not in self.successors:
+            self.successors[before] = []
+        self.successors[before].append(after)
+        self.waiting[after] = self.waiting.get(after, 0) + 1
+
+    def _members(self, g):
+        '''The node that ends once every task in group g has; it stays open until the group can't grow any more.'''
+        if g not in self.open and ('open', g) not in self.ended:
+            # sync() ends it once this group's tasks have been added.
+            self.open[g] = True
+            self._add_edge(('open', g), ('members', g))
+        return ('members', g)
+
+    def _resolve(self, i, ref):
+        m = re.match(r"^group:(-?\d+)$", ref)
+        if m:
+            return [self._members(int(m.group(1)))]
+        if self.comments is None:
+            self.comments = {}
+            for j in range(i + 1):
+                comment = self.tdb.get_field(j, 'comment')
+                if comment is not None:
+                    self.comments.setdefault(comment, []).append(j)
+        if i in self.comments.get(ref, []):
+            raise Exception("Task `{}' depends on itself.".format(ref))
+        if self.closed is True:
+            if ref in self.comments:
+                return self.comments[ref]
+            if re.match(r"^\d+$", ref) and int(ref) < self.tdb.num_tasks():
+                return [int(ref)]
+            raise Exception("Task `{}' depends on `{}', which is not a task comment, row number or group.".format(self.tdb.get_field(i, 'comment'), ref))
+        # More tasks with this comment may still be read, so wait for close().
+        node = ('comment', ref)
+        if node not in self.refs:
+            self.refs[node] = None
+            self._add_edge(('loaded',), node)
+            for j in self.comments.get(ref, []):
+                self._add_edge(j, node)
+        return [node]
+
+    def _add_group(self, g):
+        if self.last_group is not None and g < self.last_group:
+            raise Exception("Group {} comes after group {}; groups have to be in increasing order.".format(g, self.last_group))
+        self.groups[g] = True
+        self._add_edge(self._members(g), ('group', g))
+        if self.last_group is not None:
+            self.previous[g] = self.last_group
+            self._add_edge(('group', self.last_group), ('group', g))
+        self.last_group = g
+
+    def _add_task(self, i):
+        tdb = self.tdb
+        g = tdb.get_field(i, 'group')
+        comment = tdb.get_field(i, 'comment')
+        if self.in_order is True and g is not None and g > 0:
+            if self.row_group is not None and g < self.row_group:
+                raise Exception("Task `{}' is in group {} but comes after group {}; groups have to be in increasing order.".format(comment, g, self.row_group))
+            self.row_group = g
+        if self.comments is not None and comment is not None:
+            self.comments.setdefault(comment, []).append(i)
+            if ('comment', comment) in self.refs:
+                self._add_edge(i, ('comment', comment))
+        status = tdb._status_key(tdb.get_field(i, 'status'))
+        if status not in PENDING_STATUSES:
+            self.ended[i] = True
+        # A group's members node ends when all of its tasks have; its barrier
+        # ends when the members and every earlier group's barrier have.
+        if g is not None:
+            self._add_edge(i, self._members(g))
+        if i in self.ended:
+            return 0
+        self.num_pending += 1
+        depends_on = tdb.get_field(i, DEPENDS_ON_KEY)
+        if depends_on is not None:
+            for ref in re.split(r"[\s;]+", depends_on.strip()):
+                for before in self._resolve(i, ref):
+                    if before == i:
+                        raise Exception("Task `{}' depends on itself.".format(comment))
+                    self._add_edge(before, i)
+        elif self.group_barriers is True and g in self.previous:
+            self._add_edge(('group', self.previous[g]), i)
+        if status != 'NEW':
+            return 0
+        if i not in self.waiting:
+            self.push_ready(i)
+        return 1
+
+    def sync(self):
+        '''Add the tasks added to the database since the last sync; returns how many of them are NEW.'''
+        tdb = self.tdb
+        n = tdb.num_tasks()
+        if self.synced >= n:
+            return 0
+        groups = set()
+        for i in range(self.synced, n):
+            g = tdb.get_field(i, 'group')
+            if g is not None and g > 0 and g not in self.groups:
+                groups.add(g)
+        for g in sorted(groups):
+            self._add_group(g)
+        num_new = 0
+        for i in range(self.synced, n):
+            num_new += self._add_task(i)
+        self.synced = n
+        # Only the last group can still get more tasks, and after close()
+        # the tasks added later are counted in as they come.
+        for g in list(self.open):
+            if self.closed is True or (g > 0 and self.last_group is not None and g < self.last_group):
+                del self.open[g]
+                self._end(('open', g))
+        return num_new
+
+    def check_task(self, comment, group, depends_on):
+        '''Raise an exception if a task with this comment, group and depends_on couldn't be added now.'''
+        if group is not None and group > 0 and group not in self.groups and self.last_group is not None and group < self.last_group:
+            raise Exception("Group {} comes before group {}, which has already been added.".format(group, self.last_group))
+        if depends_on is None or self.closed is not True:
+            return
+        if self.comments is None:
+            self.comments = {}
+            for j in range(self.synced):
+                c = self.tdb.get_field(j, 'comment')
+                if c is not None:
+                    self.comments.setdefault(c, []).append(j)
+        for ref in re.split(r"[\s;]+", depends_on.strip()):
+            if ref == comment:
+                raise Exception("Task `{}' depends on itself.".format(ref))
+            if (re.match(r"^group:(-?\d+)$", ref) or ref in self.comments
+                    or (re.match(r"^\d+$", ref) and int(ref) < self.tdb.num_tasks())):
+                continue
+            raise Exception("Task `{}' depends on `{}', which is not a task comment, row number or group.".format(comment, ref))
+
+    def close(self):
+        '''Say that every task has been added, which lets the last group and any comment references end.'''
+        self.sync()
+        for node in self.refs:
+            ref = node[1]
+            if ref not in self.comments:
+                if re.match(r"^\d+$", ref) and int(ref) < self.tdb.num_tasks():
+                    self._add_edge(int(ref), node)
+                else:
+                    raise Exception("A task depends on `{}', which is not a task comment, row number or group.".format(ref))
+        self.closed = True
+        self.refs = {}
+        self._end(('loaded',))
+        for g in list(self.open):
+            del self.open[g]
+            self._end(('open', g))
+
+    def build(self):
+        self.in_order = self.tdb.loading()
+        self.sync()
+        if self.tdb.loading() is False and self.more is False:
+            self.close()
+
+    def push_ready(self, i):
+        if self.priority is None:
+            heapq.heappush(self.ready, (i, i))
+        else:
+            heapq.heappush(self.ready, (self.priority(i), i))
+
+    def _is_new(self, i):
+        return self.tdb._status_key(self.tdb.get_field(i, 'status')) == 'NEW'
+
+    def _end(self, node):
+        if node in self.ended:
+            return
+        self.ended[node] = True
+        for after in self.successors.pop(node, []):
+            self.waiting[after] -= 1
+            if self.waiting[after] == 0:
+                del self.waiting[after]
+                if isinstance(after, int):
+                    if self._is_new(after):
+                        self.push_ready(after)
+                else:
+                    self._end(after)
+
+    def task_ended(self, rownum):
+        '''Call when a task reaches a status it won't leave by itself; releases the tasks that were waiting for it.'''
+        if rownum in self.ended:
+            return
+        self.num_pending -= 1
+        self._end(rownum)
+
+    def next_tasks(self, n):
+        '''Up to n NEW tasks whose predecessors have all ended, in order of priority.'''
+        l = []
+        while len(l) < n and len(self.ready) > 0:
+            key, i = heapq.heappop(self.ready)
+            if i in self.ended or not self._is_new(i):
+                continue
+            l.append(self.tdb.get_task(i))
+        return l
+
+    def pending(self):
+        '''The number of tasks that haven't ended yet.'''
+        return self.num_pending
+
+    def blocked(self):
+        '''The number of tasks still waiting for predecessors.'''
+        return sum(1 for node in self.waiting if isinstance(node, int))
+
+def test():
+    tdb = QRunnerTasksDatabase.QRunnerTasksDatabase(tasksdb_filename=None)
+    tdb.add_task(comment='a', status='NEW', command='true', group=1)
+    tdb.add_task(comment='b', status='NEW', command='true', group=1)
+    tdb.add_task(comment='c', status='NEW', command='true', group=2)
+    tdb.add_task(comment='d', status='NEW', command='true', group=2, depends_on='a')
+    s = DependencyScheduler(tdb)
+    if [t['comment'] for t in s.next_tasks(10)] != ['a', 'b']:
+        raise Exception('Only group 1 should be ready')
+    s.task_ended(0)
+    if [t['comment'] for t in s.next_tasks(10)] != ['d']:
+        raise Exception('d should be ready as soon as a has ended')
+    s.task_ended(1)
+    if [t['comment'] for t in s.next_tasks(10)] != ['c']:
+        raise Exception('c should be ready once group 1 has ended')
+    s = DependencyScheduler(tdb, priority=lambda i: -i)
+    if [t['comment'] for t in s.next_tasks(10)] != ['b', 'a']:
+        raise Exception('b should come first with the higher priority')
+    tdb = QRunnerTasksDatabase.QRunnerTasksDatabase(tasksdb_filename=None)
+    tdb.add_task(comment='a', status='NEW', command='true', group=1)
+    s = DependencyScheduler(tdb)
+    s.next_tasks(10)
+    s.check_task('b', 1, 'a')
+    tdb.add_task(comment='b', status='NEW', command='true', group=1, depends_on='a')
+    tdb.add_task(comment='c', status='NEW', command='true', group=3)
+    s.sync()
+    s.task_ended(0)
+    if [t['comment'] for t in s.next_tasks(10)] != ['b']:
+        raise Exception('c should wait for b, which joined group 1 after close()')
+    s.task_ended(1)
+    if [t['comment'] for t in s.next_tasks(10)] != ['c']:
+        raise Exception('c should be ready once the whole of group 1 has ended')
+    s.check_task('d', 1, 'c')
+    for args in [('d', 2, None), ('d', 3, 'nothing'), ('d', 3, 'd')]:
+        try:
+            s.check_task(*args)
+        except Exception:
+            continue
+        raise Exception('Task {} should have been refused'.format(args))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
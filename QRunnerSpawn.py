@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import sys, os, subprocess, time, resource
+
+'''
+Starts a command in a child process without the coordinator changing its
+own directory.
+
+os.posix_spawnp is used when the command can run in the coordinator's
+directory, since it skips building a Popen object and lets the C library
+use vfork. posix_spawn can't change directory, so commands with their own
+directory go through Popen(cwd=...), which changes directory in the child.
+Either way the child's stdin, stdout and stderr are file descriptors
+opened beforehand, and the coordinator never calls os.chdir(), so launches
+don't depend on (or disturb) the coordinator's current directory. Commands
+with resource limits also go through Popen, which sets them in the child
+before it execs, so they hold from the command's first instruction.
+
+Directories are created the first time they are used and remembered, so
+a run with thousands of tasks in the same directory checks it just once.
+
+Run this file with a number of tasks to compare the launch rate of the old
+chdir-and-Popen path with the ones here.
+'''
+
+METHODS = ['posix_spawn', 'popen']
+
+class Spawner:
+
+    def __init__(self, method='posix_spawn', cwd=None):
+        '''cwd is the directory that relative task directories are relative to; the current directory by default.'''
+        if method not in METHODS:
+            raise Exception("Spawn method `{}' not recognised.".format(method))
+        if method == 'posix_spawn' and not hasattr(os, 'posix_spawnp'):
+            method = 'popen'
+        self.method = method
+        self.cwd = cwd or os.getcwd()
+        self.known_dirs = {self.cwd: True}
+
+    def directory(self, pwd):
+        '''The absolute directory for a task's pwd, which is created if need be.'''
+        if pwd is None:
+            return self.cwd
+        d = os.path.join(self.cwd, os.path.expanduser(pwd))
+        if d not in self.known_dirs:
+            os.makedirs(d, exist_ok=True)
+            self.known_dirs[d] = True
+        return d
+
+    def path(self, d, name):
+        '''A task's file name, relative to its directory d.'''
+        return os.path.join(d, os.path.expanduser(name))
+
+    def spawn(self, argv, cwd=None, stdin=0, stdout=1, stderr=2, setsid=False, limits=()):
+        '''Start argv in cwd with the given file descriptors as its stdin, stdout and stderr; returns its process ID.
+        With setsid=True it leads a session and process group of its own, which os.killpg() can signal as a whole.
+        limits are resource limits to start it with, as [(resource, (soft, hard))].'''
+        if cwd is None:
+            cwd = self.cwd
+        preexec_fn = None
+        if len(limits) > 0:
+            def preexec_fn():
+                for res, soft_hard in limits:
+                    resource.setrlimit(res, soft_hard)
+        elif self.method == 'posix_spawn' and cwd == os.getcwd():
+            actions = []
+            for fd, target in [(stdin, 0), (stdout, 1), (stderr, 2)]:
+                if fd != target:
+                    actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+            return os.posix_spawnp(argv[0], argv, os.environ, file_actions=actions, setsid=setsid)
+        p = subprocess.Popen(argv, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr, start_new_session=setsid,
+                             preexec_fn=preexec_fn)
+        # The reaper collects it. Otherwise Popen.__del__ would queue it for
+        # subprocess to reap later, racing with the reaper for its status.
+        p.returncode = 0
+        return p.pid
+
+def _launch_chdir(argv, d, stdout):
+    '''The old launch path: change directory, make sure it exists, Popen and change back.'''
+    original_cwd = os.getcwd()
+    try:
+        os.chdir(d)
+    except FileNotFoundError:
+        os.makedirs(d)
+        os.chdir(d)
+    p = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=stdout, stderr=stdout)
+    os.chdir(original_cwd)
+    p.returncode = 0
+    return p.pid
+
+def benchmark(n=1000, argv=['true']):
+    '''Tasks launched per second by each launch path, as {name: rate}.'''
+    import tempfile
+    rates = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        try:
+            methods = ['chdir'] + METHODS
+            for method in methods:
+                s = None if method == 'chdir' else Spawner(method)
+                pids = []
+                start = time.perf_counter()
+                for i in range(n):
+                    d = os.path.join(tmp, 'd{}'.format(i % 4))
+                    if method == 'chdir':
+                        pids.append(_launch_chdir(argv, d, devnull))
+                    elif method == 'posix_spawn':
+                        pids.append(s.spawn(argv, stdin=devnull, stdout=devnull, stderr=devnull))
+                    else:
+                        pids.append(s.spawn(argv, cwd=s.directory(d), stdin=devnull, stdout=devnull, stderr=devnull))
+                rates[method] = n / (time.perf_counter() - start)
+                for pid in pids:
+                    os.waitpid(pid, 0)
+        finally:
+            os.close(devnull)
+    return rates
+
+def test():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        for method in METHODS:
+            s = Spawner(method, cwd=tmp)
+            d = s.directory('sub')
+            out = os.open(s.path(d, 'out.txt'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            pid = s.spawn(['pwd'], cwd=d, stdout=out)
+            os.close(out)
+            os.waitpid(pid, 0)
+            with open(os.path.join(tmp, 'sub', 'out.txt')) as f:
+                if os.path.realpath(f.read().strip()) != os.path.realpath(d):
+                    raise Exception("{}: the command didn't run in `{}'".format(method, d))
+            # The limits are already there when the command starts.
+            out = os.open(s.path(d, 'limit.txt'), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            pid = s.spawn(['sh', '-c', 'ulimit -t'], stdout=out, limits=[(resource.RLIMIT_CPU, (7, 8))])
+            os.close(out)
+            os.waitpid(pid, 0)
+            with open(os.path.join(tmp, 'sub', 'limit.txt')) as f:
+                if f.read().strip() != '7':
+                    raise Exception("{}: the command didn't start with its CPU limit".format(method))
+
+def main():
+    if len(sys.argv) > 1:
+        for method, rate in benchmark(int(sys.argv[1])).items():
+            print('{:12} {:8.0f} tasks/s'.format(method, rate))
+        return
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
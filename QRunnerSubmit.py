@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import sys, os, json, socket
+
+'''
+Lets other programs add tasks to a QRunner while it runs, through a Unix
+domain socket.
+
+A client connects to the socket and sends one JSON object per line, each a
+task given by the fields add_task() takes (comment, command, group, pwd,
+depends_on and so on; the status defaults to NEW). For each line the
+runner answers with one JSON line: {"rownum": N} once the task has been
+added, or {"error": "..."} if it can't be. {"shutdown": true} asks the
+runner to stop listening, finish the tasks it has and return from run().
+
+submit() and shutdown() are such a client, and so is this file:
+
+    ./QRunnerSubmit.py qrunner.sock add --comment Extra_1 --group 2 -- ping -c 1 10.20.50.11
+    ./QRunnerSubmit.py qrunner.sock file more-tasks.jsonl
+    ./QRunnerSubmit.py qrunner.sock shutdown
+'''
+
+# How many tasks a client sends before reading the answers
+CHUNK = 100
+
+class SubmissionServer:
+    '''Listens on path, with its sockets watched by a QRunnerReaper.Reaper; add(task) adds a task
+    (a dict) and returns its rownum, or raises an exception saying why it can't.'''
+
+    def __init__(self, path, reaper, add):
+        self.path = path
+        self.reaper = reaper
+        self.add = add
+        self.stopped = False
+        # Connected clients by fd, as [socket, unread bytes]
+        self.clients = {}
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+        self.sock.setblocking(False)
+        self.reaper.watch(self.sock.fileno(), self._accept)
+
+    def _accept(self, fd):
+        try:
+            conn, addr = self.sock.accept()
+        except BlockingIOError:
+            return
+        # Only read once poll() says there is something to read, but wait
+        # for a slow client to take the answers.
+        conn.settimeout(10)
+        self.clients[conn.fileno()] = [conn, b'']
+        self.reaper.watch(conn.fileno(), self._readable)
+
+    def _drop(self, fd):
+        self.reaper.unwatch(fd)
+        self.clients.pop(fd)[0].close()
+
+    def _readable(self, fd):
+        client = self.clients[fd]
+        try:
+            data = client[0].recv(1 << 16)
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            self._drop(fd)
+            return
+        lines = (client[1] + data).split(b'\n')
+        client[1] = lines.pop()
+        answers = [json.dumps(self.handle(line)).encode() + b'\n' for line in lines if line.strip() != b'']
+        try:
+            client[0].sendall(b''.join(answers))
+        except OSError:
+            self._drop(fd)
+
+    def handle(self, line):
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise Exception('Expected a JSON object.')
+            if message.get('shutdown') is True:
+                self.stopped = True
+                return {'ok': True}
+            return {'rownum': self.add(message)}
+        except Exception as e:
+            return {'error': str(e)}
+
+    def close(self):
+        for fd in list(self.clients):
+            self._drop(fd)
+        if self.sock is not None:
+            self.reaper.unwatch(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+def _send(path, messages):
+    answers = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        with s.makefile('rwb') as f:
+            for i in range(0, len(messages), CHUNK):
+                chunk = messages[i:i + CHUNK]
+                f.write(b''.join(json.dumps(m).encode() + b'\n' for m in chunk))
+                f.flush()
+                for m in chunk:
+                    line = f.readline()
+                    if line == b'':
+                        raise Exception("The QRunner listening on `{}' went away.".format(path))
+                    answers.append(json.loads(line))
+    return answers
+
+def submit(path, tasks):
+    '''Add tasks (dicts of add_task() fields) to the QRunner listening on path; returns their rownums.'''
+    rownums = []
+    for task, answer in zip(tasks, _send(path, list(tasks))):
+        if 'error' in answer:
+            raise Exception("Task `{}' was not added: {}".format(task.get('comment'), answer['error']))
+        rownums.append(answer['rownum'])
+    return rownums
+
+def shutdown(path):
+    '''Ask the QRunner listening on path to stop once its tasks are done.'''
+    _send(path, [{'shutdown': True}])
+
+def test():
+    import tempfile, threading, QRunnerReaper
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'qrunner.sock')
+        added = []
+        def add(task):
+            if task.get('command') is None:
+                raise Exception('Cannot have a task with no command.')
+            added.append(task)
+            return len(added) - 1
+        with QRunnerReaper.Reaper() as reaper:
+            server = SubmissionServer(path, reaper, add)
+            results = {}
+            def client():
+                results['rownums'] = submit(path, [{'comment': 'a', 'command': 'true'}] * (CHUNK + 1))
+                try:
+                    submit(path, [{'comment': 'b'}])
+                except Exception as e:
+                    results['error'] = str(e)
+                shutdown(path)
+            thread = threading.Thread(target=client)
+            thread.start()
+            while server.stopped is False:
+                reaper.poll(1)
+            thread.join()
+            server.close()
+        if results['rownums'] != list(range(CHUNK + 1)) or 'no command' not in results.get('error', ''):
+            raise Exception("Unexpected results {}".format(results))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Add tasks to a running QRunner.')
+    parser.add_argument('socket', help='The socket the QRunner listens on, e.g. qrunner.sock')
+    subparsers = parser.add_subparsers(dest='action')
+    p = subparsers.add_parser('add', help='Add one command.')
+    p.add_argument('--comment')
+    p.add_argument('--group', type=int)
+    p.add_argument('--pwd')
+    p.add_argument('--depends-on')
+    p.add_argument('command', nargs='+')
+    p = subparsers.add_parser('file', help='Add the tasks in a JSON lines file, or - for stdin.')
+    p.add_argument('filename')
+    subparsers.add_parser('shutdown', help='Stop the QRunner once its tasks are done.')
+    if len(sys.argv) < 2:
+        test()
+        return
+    args = parser.parse_args()
+    if args.action == 'add':
+        import shlex
+        task = {'comment': args.comment, 'command': ' '.join(shlex.quote(a) for a in args.command),
+                'group': args.group, 'pwd': args.pwd, 'depends_on': args.depends_on}
+        print(submit(args.socket, [{k: v for k, v in task.items() if v is not None}])[0])
+    elif args.action == 'file':
+        f = sys.stdin if args.filename == '-' else open(args.filename)
+        with f:
+            tasks = [json.loads(l) for l in f if l.strip() != '']
+        for rownum in submit(args.socket, tasks):
+            print(rownum)
+    elif args.action == 'shutdown':
+        shutdown(args.socket)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    sys.exit(main())
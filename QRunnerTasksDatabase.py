@@ -1,15 +1,37 @@
 #!/usr/bin/env python3
 
-import csv, re, sys, os
+import csv, sys, os, io, time, fcntl, platform, contextlib, abc
 
 from pathlib import Path
 
+import QRunnerProgress
+
 '''
 Implements a simple tasks database with a CSV file.
 
 Scales reasonably well up to a few hundred thousand tasks.
 
-Beyond that, things get slow reading and writing the file.
+Beyond that, things get slow reading and writing the file. Filenames ending
+in .sqlite, .sqlite3 or .db are kept in SQLite instead (see
+QRunnerSQLiteStorage), and `QRunnerTasksDatabase.py convert tasks.csv
+tasks.sqlite' copies a CSV file into one.
+
+With journal=True, state changes are appended to a journal file next to the
+CSV file instead of rewriting it, and the journal is folded back into the CSV
+file by update() every journal_compact_every changes and on exit. parse()
+replays any journal left behind by an interrupted run.
+
+With shared=True, several runners (on one machine, or on several sharing a
+filesystem) can work on the same tasks file at once. Every save happens
+under a lock (a lock file next to a CSV file, a transaction for SQLite) and
+only writes the tasks this runner changed, on top of what the others have
+saved. A runner claim()s NEW tasks before starting them by writing its name
+in their owner column with a lease, an expiry time that it renews while the
+tasks are pending, and refresh() takes in the others' changes. Once a
+runner's lease has run out, the NEW tasks it claimed may be claimed by
+another runner and its running tasks are marked LOST (or FAILED, for
+function tasks, which only the runner that added them can run). Shared
+tasks can't be streamed or journalled.
 '''
 
 DEFAULT_TASKS_FILE_TEXT = '''\
@@ -23,6 +45,8 @@ DEFAULT_TASKS_FILE_TEXT = '''\
 # 4: ARCHIVING: task has finished, input/output files and RC are being archived
 # 5: DELETE: task has finished, input/output files are ready to be deleted
 # 6: DELETED: task has finished, ready to delete this entry (same as 0/IGNORE)
+# 8: TEMPLATE: stands for many tasks, which qrunner adds as it needs them
+# 9: EXPANDED: a template whose tasks have all been added
 # -1: INVALID: generic error; task entry is invalid
 # -2: FAILED: qrunner was unable to launch the task
 # -3: DIED: qrunner was not running when the the task finished
@@ -39,6 +63,7 @@ DEFAULT_TASKS_FILE_TEXT = '''\
 #
 # '': blank string - state is not in 3, -3, or -4 yet
 # 0-255: normal process return codes
+# -1 to -64: the process was ended by that signal (e.g. -15 for SIGTERM)
 
 # Input/output files:
 #
@@ -56,7 +81,7 @@ DEFAULT_TASKS_FILE_TEXT = '''\
 # The comment field is ignored, but can be used to help keep track of the file-
 # names generated.
 # The host indicates where the job is running. If blank, the local host is
-# assumed.
+# assumed. Another host's tasks are run by a QRunnerAgent of that name.
 # The user indicates the user the job should run is. If blank, then the user of
 # qrunner will be used.
 # The pwd indicates the working directory where the job will be run. Input and
@@ -70,51 +95,411 @@ DEFAULT_TASKS_FILE_TEXT = '''\
 # If fields at the end are missing, they will be treated as if they are blank
 # If the task runner has an internal error, it will go into the EXCEPTION
 
+# Optional columns:
+#
+# These may be added after the standard columns as long as the file has a
+# header line naming them.
+# timeout: seconds the task may run before it is sent SIGTERM (and SIGKILL
+# after QRunner's killtimeout). Blank means QRunner's timeout; 0 means none.
+# depends_on: the tasks this task waits for instead of the groups before it,
+# separated by spaces or semicolons: task comments, row numbers (from 0), or
+# group:N for every task in group N.
+# result: filled in with the repr() of whatever a function task run on a
+# worker pool returned, other than an exit code.
+# cpus, mem_mb, slots: what the task needs while it runs, so that QRunner
+# only starts it when that much is free. Blank means no CPUs or memory and
+# one slot. A command is held to mem_mb of address space and, with a
+# timeout, cpus times the timeout seconds of CPU time.
+# priority: a number; of the tasks that are ready at the same time, those
+# with a higher priority start first. Blank means 0.
+# started, ended: when QRunner launched the task and saw it end, in seconds
+# since the epoch; duration: the seconds in between.
+# utime, stime, maxrss_kb: the user and system CPU seconds and the peak
+# resident memory of a task run in its own process (not on a worker pool).
+# pid_start: when the process with the task's pid started, so that a later
+# process given the same pid isn't taken for it.
+# owner, lease: with several runners sharing the file, the runner that has
+# claimed the task (host:pid) and when its claim runs out, in seconds since
+# the epoch.
+# agent: the address of the QRunnerAgent running the task, for a task whose
+# host is another host's. Such a task has no pid while it is RUNNING.
+# params, group_size, expanded: for a TEMPLATE, where the values of the
+# parameters in its command come from, how many of its tasks go in each
+# group, and how many of them have been added so far (see QRunnerTemplate).
+# extract, output_bytes: what to pick out of a command's stdout as it runs,
+# into a column for each field, and how many bytes of the stdout to keep
+# (see QRunnerExtract).
+
 '''
 
 ROWNUM_KEY = 'rownum'
 FUNCTION_KEY = 'function'
+JOURNAL_SUFFIX = '.journal'
+LOCK_SUFFIX = '.lock'
+SQLITE_SUFFIXES = ['.sqlite', '.sqlite3', '.db']
+ALL_GROUPS = None
 
-class QRunnerTasksDatabase:
+STANDARD_HEADERS = ['comment','status','pid','rc','command','group',
+                    'user','host','pwd','inputfile','outputfile','errorfile','exception'
+                    ]
 
-    def parse(self):
-        standard_headers = ['comment','status','pid','rc','command','group',
-                            'user','host','pwd','inputfile','outputfile','errorfile','exception'
-                            ]
+# The optional columns QRunner fills in as each task runs
+TIMING_HEADERS = ['started', 'ended', 'duration', 'utime', 'stime', 'maxrss_kb', 'pid_start']
 
-        self.rawdata = []
-        self.rawdata_len = 0
+# The optional columns of tasks shared between runners
+SHARED_HEADERS = ['owner', 'lease']
 
-        if self.tasksdb_text is None:
-            self.preservetext = DEFAULT_TASKS_FILE_TEXT
-            self.headers = standard_headers
-            return
+# The optional columns of task templates
+TEMPLATE_HEADERS = ['params', 'group_size', 'expanded']
+
+# Columns that add_task() accepts even when the file doesn't have them yet.
+OPTIONAL_HEADERS = (['timeout', 'depends_on', 'result', 'cpus', 'mem_mb', 'slots', 'priority', 'agent', 'extract', 'output_bytes']
+                    + TIMING_HEADERS + SHARED_HEADERS + TEMPLATE_HEADERS)
+
+# Columns whose values repeat a lot, so each distinct string is stored once.
+INTERNED_HEADERS = ['status', 'rc', 'user', 'host', 'pwd', 'exception', 'timeout', 'cpus', 'mem_mb', 'slots', 'priority', 'owner', 'agent']
+
+# The statuses of tasks that a runner has started and that haven't ended yet
+RUNNING_STATUSES = ['LAUNCHING', 'RUNNING', 'KILLING', 'KILLING9']
+
+class TasksStorage(abc.ABC):
+    '''Where a QRunnerTasksDatabase keeps its tasks.
+
+    load_chunks() is a generator that fills in the preserved text, the
+    headers and the tasks of the database, yielding after every chunk of
+    tasks so that a runner can start on them before the rest are read.
+    save_rows() saves just the given tasks and save_all() saves everything.
+    incremental is True if save_rows() doesn't have to rewrite everything.'''
+
+    filename = None
+    incremental = False
+    shared = False
+
+    @abc.abstractmethod
+    def load_chunks(self, tdb, chunk_size):
+        pass
+
+    def load(self, tdb):
+        for _ in self.load_chunks(tdb, None):
+            pass
+
+    def save_rows(self, tdb, rownums):
+        self.save_all(tdb)
+
+    @abc.abstractmethod
+    def save_all(self, tdb):
+        pass
+
+    def close(self):
+        pass
+
+    def lock(self):
+        '''A context manager that keeps other runners sharing the tasks from saving them meanwhile.'''
+        return contextlib.nullcontext()
+
+    @abc.abstractmethod
+    def read_rows(self, tdb, rownums=None, first=0):
+        '''The saved tasks from rownum first on (or just those in rownums) as (rownum, row), the row's values
+        in the order of tdb.headers; columns tdb doesn't have yet are added to it.'''
+
+class FileLock:
+    '''An exclusive lock on a file, which whoever holds it may take again.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+        self.depth = 0
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+            # lockf() rather than flock(), as it also works over NFS.
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            os.close(self.fd)
+            self.fd = None
+
+def _is_preserved_line(l):
+    '''Blank lines and lines starting with a comment or a space are kept as they are.'''
+    return l == '' or l[0] == '#' or l[0].isspace()
 
-        '''Find lines that are blank, start with a comment, or a space, and preserve them'''
-        self.preservetext = ''
-        csvs = []
-        for l in re.split(r"\r\n|\r|\n", self.tasksdb_text):
-            if re.match(r"^$|^\s|^#", l):
-                self.preservetext += l;
-                self.preservetext += '\n';
+class CSVStorage(TasksStorage):
+
+    def __init__(self, filename=None, text=None, journal=False, journal_sync_every=0, journal_compact_every=10000, shared=False):
+        self.filename = None
+        self.filename_tmp = None
+        self.journal_filename = None
+        self.text = text
+        self.journal = journal
+        self.journal_sync_every = journal_sync_every
+        self.journal_compact_every = journal_compact_every
+        self.journal_f = None
+        self.journal_w = None
+        self.journal_entries = 0
+        self.journal_unsynced = 0
+        if filename is not None and text is not None:
+            raise Exception('Cannot specify both tasksdb_filename and tasksdb_text.')
+        elif filename is not None:
+            self.filename = str(Path(filename).resolve())
+            self.filename_tmp = self.filename + "~"
+            self.journal_filename = self.filename + JOURNAL_SUFFIX
+        self.incremental = self.journal is True and self.journal_filename is not None
+        self.shared = shared
+        self.file_lock = None
+        if shared is True:
+            if self.filename is None:
+                raise Exception('Only a tasks file can be shared.')
+            if journal is True:
+                raise Exception('A shared tasks file cannot have a journal.')
+            self.file_lock = FileLock(self.filename + LOCK_SUFFIX)
+
+    def _lines(self, f, preserve):
+        for l in f:
+            l = l.rstrip('\r\n')
+            if _is_preserved_line(l):
+                preserve.append(l + '\n')
             else:
-                csvs.append(l)
+                yield l
+
+    def load_chunks(self, tdb, chunk_size):
+        if self.filename is not None:
+            try:
+                tasksdb_f = open(self.filename, 'r', newline='')
+            except FileNotFoundError:
+                tasksdb_f = None
+        elif self.text is not None:
+            tasksdb_f = io.StringIO(self.text, newline=None)
+        else:
+            tasksdb_f = None
+
+        if tasksdb_f is None:
+            tdb.preservetext = DEFAULT_TASKS_FILE_TEXT
+            tdb._set_headers(list(STANDARD_HEADERS))
+            self.replay_journal(tdb)
+            return
 
-        self.preservetext = self.preservetext[:-1]
+        # Changes in a journal can only be applied once every task has been
+        # read, so don't hand out any tasks before then.
+        if self.journal_filename is not None and os.path.exists(self.journal_filename):
+            chunk_size = None
 
-        if len(csvs) > 0:
-            self.headers = list(csv.reader([csvs[0]]))[0]
+        with tasksdb_f:
+            preserve = []
+            rows = csv.reader(self._lines(tasksdb_f, preserve), dialect='unix')
+            first = next(rows, None)
+            headers = list(STANDARD_HEADERS)
             # If the first CSV line doesn't start with "comment", we probably don't have a header line.
-            if self.headers[0].lower() == 'comment':
-                if ROWNUM_KEY in self.headers:
+            if first is not None and first[0].lower() == 'comment':
+                if ROWNUM_KEY in first:
                     raise Exception("`rownum' is not a valid field in the CSV file. Please remove it.")
-                csvs_to_add = csv.DictReader(csvs[0:], dialect='unix')
+                headers = first
+                first = None
+            tdb._set_headers(headers)
+            if first is not None:
+                tdb._add_row(first)
+            n = 0
+            for row in rows:
+                tdb._add_row(row)
+                n += 1
+                if chunk_size is not None and n >= chunk_size:
+                    tdb.preservetext = ''.join(preserve)
+                    yield
+                    n = 0
+            tdb.preservetext = ''.join(preserve)
+        self.replay_journal(tdb)
+
+    def save_rows(self, tdb, rownums):
+        '''Append the given tasks to the journal, or rewrite the whole file if not journalling.'''
+        if self.shared is True:
+            with self.lock():
+                self._merge_rows(tdb, rownums)
+            return
+        if self.incremental is not True:
+            self.save_all(tdb)
+            return
+        if self.journal_entries >= self.journal_compact_every:
+            self.save_all(tdb)
+            return
+        if self.journal_f is None:
+            new_journal = not os.path.exists(self.journal_filename)
+            self.journal_f = open(self.journal_filename, 'a', newline='')
+            self.journal_w = csv.writer(self.journal_f, dialect='unix')
+            if new_journal:
+                self.journal_w.writerow([ROWNUM_KEY] + tdb.headers)
+        for i in rownums:
+            self.journal_w.writerow([i] + tdb.rawdata[i])
+        self.journal_entries += len(rownums)
+        self.journal_unsynced += len(rownums)
+        self.journal_f.flush()
+        if self.journal_sync_every > 0 and self.journal_unsynced >= self.journal_sync_every:
+            os.fsync(self.journal_f.fileno())
+            self.journal_unsynced = 0
+
+    def lock(self):
+        if self.file_lock is None:
+            return contextlib.nullcontext()
+        return self.file_lock
+
+    def _read_file(self):
+        '''The headers, rows and preserved text of the tasks file as it is now, or None if there isn't one.'''
+        try:
+            f = open(self.filename, 'r', newline='')
+        except FileNotFoundError:
+            return None
+        with f:
+            preserve = []
+            rows = list(csv.reader(self._lines(f, preserve), dialect='unix'))
+        headers = list(STANDARD_HEADERS)
+        if len(rows) > 0 and rows[0][0].lower() == 'comment':
+            headers = rows.pop(0)
+        return headers, rows, ''.join(preserve)
+
+    def _rows_for(self, tdb, headers, rows):
+        '''rows, given in the order of headers, in the order of tdb.headers.'''
+        for h in headers:
+            tdb.add_column(h)
+        if headers == tdb.headers:
+            return rows
+        columns = [headers.index(h) if h in headers else None for h in tdb.headers]
+        return [[row[j] if j is not None and j < len(row) else None for j in columns] for row in rows]
+
+    def read_rows(self, tdb, rownums=None, first=0):
+        saved = self._read_file()
+        if saved is None:
+            return []
+        rows = self._rows_for(tdb, saved[0], saved[1])
+        if rownums is None:
+            return [(i, rows[i]) for i in range(first, len(rows))]
+        return [(i, rows[i]) for i in rownums if i < len(rows)]
+
+    def _merge_rows(self, tdb, rownums):
+        '''Rewrite the file as it is now with the given tasks replaced by (or added from) tdb's.'''
+        saved = self._read_file()
+        if saved is None:
+            rows, preservetext = [], tdb.preservetext
+        else:
+            rows, preservetext = self._rows_for(tdb, saved[0], saved[1]), saved[2]
+        for i in rownums:
+            if i < len(rows):
+                rows[i] = tdb.rawdata[i]
+            elif i == len(rows):
+                rows.append(tdb.rawdata[i])
             else:
-                self.headers = standard_headers
-                csvs_to_add = csv.DictReader(csvs, dialect='unix', fieldnames=self.headers)
-            for i, d in enumerate(csvs_to_add):
-                d[ROWNUM_KEY] = i
-                self._add_task(d)
+                raise Exception("Task {} can't be saved to `{}', which only has {} tasks.".format(i, self.filename, len(rows)))
+        with open(self.filename_tmp, 'w', newline='') as tasksdb_tmp_f:
+            tasksdb_tmp_f.write(preservetext)
+            w = csv.writer(tasksdb_tmp_f, dialect='unix')
+            w.writerow(tdb.headers)
+            w.writerows(rows)
+        os.rename(self.filename_tmp, self.filename)
+
+    def close(self):
+        if self.journal_f is not None:
+            self.journal_f.close()
+            self.journal_f = None
+            self.journal_w = None
+
+    def replay_journal(self, tdb):
+        '''Apply the changes recorded in the journal to the tasks just read from the CSV file.'''
+        if self.journal_filename is None:
+            return
+        try:
+            journal_f = open(self.journal_filename, 'r', newline='')
+        except FileNotFoundError:
+            return
+        with journal_f:
+            for d in csv.DictReader(journal_f, dialect='unix'):
+                if None in d.values() or None in d:
+                    # A partly written last line from a run that was interrupted.
+                    break
+                i = int(d.pop(ROWNUM_KEY))
+                for k in d:
+                    if k not in tdb.column:
+                        tdb.add_column(k)
+                if i < tdb.rawdata_len:
+                    t = tdb.get_task(i)
+                    t.update(d)
+                    tdb._store_task(t)
+                elif i == tdb.rawdata_len:
+                    tdb._add_task(d)
+                else:
+                    raise Exception("The journal `{}' refers to task {} but there are only {} tasks.".format(self.journal_filename, i, tdb.rawdata_len))
+                self.journal_entries += 1
+        tdb.needs_rewrite = True
+
+    def save_all(self, tdb):
+        if self.filename_tmp is None or self.filename is None:
+            return
+
+        with open(self.filename_tmp, 'w', newline='') as tasksdb_tmp_f:
+            tasksdb_tmp_f.write(tdb.preservetext)
+            w = csv.writer(tasksdb_tmp_f, dialect='unix')
+            w.writerow(tdb.headers)
+            w.writerows(tdb.rawdata)
+
+        os.rename(self.filename_tmp, self.filename)
+
+        self.close()
+        if self.journal_entries > 0:
+            try:
+                os.remove(self.journal_filename)
+            except FileNotFoundError:
+                pass
+        self.journal_entries = 0
+        self.journal_unsynced = 0
+
+def open_storage(tasksdb_filename=None, tasksdb_text=None, shared=False, **kwds):
+    '''Pick the storage for a tasks database from its filename: SQLite for .sqlite, .sqlite3 and .db files, CSV otherwise.'''
+    if tasksdb_filename is not None and Path(tasksdb_filename).suffix.lower() in SQLITE_SUFFIXES:
+        if tasksdb_text is not None:
+            raise Exception('Cannot specify both tasksdb_filename and tasksdb_text.')
+        import QRunnerSQLiteStorage
+        return QRunnerSQLiteStorage.SQLiteStorage(tasksdb_filename, shared=shared)
+    return CSVStorage(filename=tasksdb_filename, text=tasksdb_text, shared=shared, **kwds)
+
+class QRunnerTasksDatabase:
+    '''The tasks, held in memory as one list of values per task (in the order
+    of headers) with repeated strings interned. get_task() and friends hand
+    out dicts keyed by header, plus rownum and function.'''
+
+    def parse(self):
+        self.rawdata = []
+        self.rawdata_len = 0
+        self.functions = {}
+        self.pids = {}
+        self.status_index = {}
+        self.group_index = {}
+
+        self.loader = self.storage.load_chunks(self, self.chunk_size if self.stream is True else None)
+        if self.stream is True:
+            self.load_more()
+        else:
+            for _ in self.loader:
+                pass
+            self._finish_loading()
+
+    def loading(self):
+        '''True while a streamed tasks file is still being read.'''
+        return self.loader is not None
+
+    def load_more(self):
+        '''Read the next chunk of a streamed tasks file; returns how many tasks were added.'''
+        if self.loader is None:
+            return 0
+        n = self.rawdata_len
+        try:
+            next(self.loader)
+        except StopIteration:
+            self._finish_loading()
+        return self.rawdata_len - n
+
+    def _finish_loading(self):
+        self.loader = None
         if len(self.groups) < 1:
             self.groups = [0]
         else:
@@ -122,62 +507,97 @@ class QRunnerTasksDatabase:
 
     def __exit__(self, exception_type, exception_value, traceback):
         self.update()
+        self.storage.close()
 
     def __enter__(self):
         return self
 
-    def __init__(self, tasksdb_filename="tasks.csv", progress=None, tasksdb_text=None):
-        self.tasksdb_text = None
+    def __init__(self, tasksdb_filename="tasks.csv", progress=None, tasksdb_text=None, storage=None,
+                 stream=False, chunk_size=10000, shared=False, owner=None, lease=60, **kwds):
+        '''With stream=True, only the first chunk_size tasks are read here and load_more() reads the rest.
+
+        progress is either a function, called with the new row on every change, or a
+        QRunnerProgress.ProgressEvents to note the change for its next batch.
+
+        With shared=True, other runners may be working on the same tasks; this one claims tasks as `owner'
+        (by default host:pid) for `lease' seconds at a time.
+
+        Any other keywords (journal, journal_sync_every, journal_compact_every) are passed to the CSV storage.'''
+        if shared is True and stream is True:
+            raise Exception('Shared tasks cannot be streamed.')
+        self.shared = shared
+        self.owner = owner
+        if owner is None:
+            self.owner = '{}:{}'.format(platform.node(), os.getpid())
+        self.lease = lease
+        # The tasks this runner has claimed that haven't ended yet
+        self.owned = {}
+        # The tasks other runners have changed since merged_rownums() was last called
+        self.merged = {}
+        self.owner_col = None
+        self.dirty = {}
+        self.needs_rewrite = False
         self.pids = {}
+        self.status_index = {}
+        self.group_index = {}
+        self.functions = {}
+        self.headers = []
+        self.column = {}
         self.first_group = 0
         self.groups = [0]
         self.cur_group = 0
         self.progress=progress
-        self.tasksdb_filename = None
-        self.tasksdb_filename_tmp = None
-        if tasksdb_filename is not None and tasksdb_text is not None:
-            raise Exception('Cannot specify both tasksdb_filename and tasksdb_text.')
-        elif tasksdb_filename is not None:
-            '''Read in the entire file and keep a copy of it.'''
-            tasksdb_filename = str(Path(tasksdb_filename).resolve())
-            self.tasksdb_filename = tasksdb_filename
-            self.tasksdb_filename_tmp = tasksdb_filename + "~"
-            try:
-                with open(self.tasksdb_filename, 'r') as tasksdb_f:
-                    self.tasksdb_text = tasksdb_f.read()
-            except FileNotFoundError:
-                self.tasksdb_text = None
-        elif tasksdb_text is not None:
-            self.tasksdb_text = tasksdb_text
+        # A QRunnerProgress.ProgressEvents only wants to know which tasks changed
+        self.events = progress if hasattr(progress, 'task_changed') else None
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.loader = None
+        if storage is None:
+            storage = open_storage(tasksdb_filename=tasksdb_filename, tasksdb_text=tasksdb_text, shared=shared, **kwds)
+        self.storage = storage
+        self.tasksdb_filename = storage.filename
         self.parse()
+        if shared is True:
+            for h in SHARED_HEADERS:
+                self.add_column(h)
+            # Another runner's tasks may have the same process IDs as ours.
+            self.pids = {row[self.pid_col]: i for i, row in enumerate(self.rawdata)
+                         if row[self.pid_col] is not None and row[self.owner_col] == self.owner}
 
     def choose_group(self, group):
+        '''Choose the group whose tasks are visible, or ALL_GROUPS.'''
         self.cur_group = group
-        # Needed to refresh the PID list to the new group
-        self.tasks()
+
+    def _visible_groups(self):
+        '''Groups whose tasks are visible: the current group plus every ungrouped (blank, 0 or negative) group.'''
+        if self.cur_group is ALL_GROUPS:
+            return list(self.group_index)
+        return [g for g in self.group_index if g is None or g < 1 or g == self.cur_group]
 
     def get_num_tasks_by_group(self, group):
-        c = 0
-        for t in self.rawdata:
-            if t['group'] == group:
-                c += 1
-        return c
+        if group in self.group_index:
+            return len(self.group_index[group])
+        return 0
 
-    def tasks(self):
-        d = []
-        self.pids = {}
-        for i, t in enumerate(self.rawdata):
-            t = dict(t)
-            for k, v in t.items():
-                if v == '':
-                    t[k] = None
-            t[ROWNUM_KEY] = i
-            if t['group'] is None or t['group'] == self.cur_group or t['group'] < 1:
-                if t['pid'] is not None:
-                    self.pids[t['pid']] = t
-                d.append(t)
+    def get_task(self, rownum):
+        d = dict(zip(self.headers, self.rawdata[rownum]))
+        d[ROWNUM_KEY] = rownum
+        if rownum in self.functions:
+            d[FUNCTION_KEY] = self.functions[rownum]
         return d
 
+    def get_field(self, rownum, name):
+        if name not in self.column:
+            return None
+        return self.rawdata[rownum][self.column[name]]
+
+    def tasks(self):
+        rownums = []
+        for g in self._visible_groups():
+            rownums.extend(self.group_index[g])
+        rownums.sort()
+        return [self.get_task(i) for i in rownums]
+
     statuses = {'': 0,
                 'IGNORE': 0,
                 'NEW': 1,
@@ -187,6 +607,8 @@ class QRunnerTasksDatabase:
                 'ARCHIVING': 5,
                 'DELETE': 6,
                 'DELETED': 7,
+                'TEMPLATE': 8,
+                'EXPANDED': 9,
                 'INVALID': -1,
                 'FAILED': -2,
                 'DIED': -3,
@@ -199,163 +621,442 @@ class QRunnerTasksDatabase:
                 'LOST': -10,
                 }
 
-    def tasks_by_status(self, status):
-        if status.upper() not in self.statuses:
+    def _status_key(self, status):
+        if status is None:
+            return ''
+        return status.upper()
+
+    def _index_add(self, i, row):
+        group = row[self.group_col]
+        key = (self._status_key(row[self.status_col]), group)
+        if key not in self.status_index:
+            self.status_index[key] = {}
+        self.status_index[key][i] = None
+        if group not in self.group_index:
+            self.group_index[group] = {}
+        self.group_index[group][i] = None
+        pid = row[self.pid_col]
+        if pid is not None and (self.owner_col is None or row[self.owner_col] == self.owner):
+            self.pids[pid] = i
+
+    def _index_remove(self, i, row):
+        group = row[self.group_col]
+        key = (self._status_key(row[self.status_col]), group)
+        del self.status_index[key][i]
+        if len(self.status_index[key]) == 0:
+            del self.status_index[key]
+        del self.group_index[group][i]
+        if len(self.group_index[group]) == 0:
+            del self.group_index[group]
+        pid = row[self.pid_col]
+        if pid is not None and self.pids.get(pid) == i:
+            del self.pids[pid]
+
+    def _status_rownums(self, status, group):
+        status = self._status_key(status)
+        if status not in self.statuses:
             raise Exception("Status `{}' not recognised.".format(status))
-        d = []
-        for t in self.tasks():
-            if t['status'].upper() == status.upper():
-                d.append(t)
-        return d
+        if group is None:
+            groups = self._visible_groups()
+        else:
+            groups = [group]
+        rownums = []
+        for g in groups:
+            key = (status, g)
+            if key in self.status_index:
+                rownums.extend(self.status_index[key])
+        if len(groups) > 1:
+            rownums.sort()
+        return rownums
+
+    def tasks_by_status(self, status, limit=None, group=None):
+        '''Tasks with the given status in file order, from the visible groups or only from `group'.'''
+        rownums = self._status_rownums(status, group)
+        if limit is not None:
+            rownums = rownums[:limit]
+        return [self.get_task(i) for i in rownums]
+
+    def count_by_status(self, status, group=None):
+        status = self._status_key(status)
+        if status not in self.statuses:
+            raise Exception("Status `{}' not recognised.".format(status))
+        groups = self._visible_groups() if group is None else [group]
+        return sum(len(self.status_index.get((status, g), ())) for g in groups)
 
     def task_by_pid(self, pid):
         if pid in self.pids:
-            t = self.pids[pid]
-            t_pid = t['pid']
+            i = self.pids[pid]
+            t_pid = self.rawdata[i][self.pid_col]
             if t_pid != pid:
-                raise Exception("Object is not consistent (for {}). t_pid is {} but pid is {}.".format(t['command'], t_pid, pid))
-            return self.pids[pid]
+                raise Exception("Object is not consistent (for {}). t_pid is {} but pid is {}.".format(self.get_field(i, 'command'), t_pid, pid))
+            return self.get_task(i)
         return None
 
+    def _store_task(self, t):
+        i = t[ROWNUM_KEY]
+        old = self.rawdata[i]
+        row = self._make_row([t[k] if k in t else old[j] for j, k in enumerate(self.headers)])
+        self._index_remove(i, old)
+        self.rawdata[i] = row
+        self._index_add(i, row)
+        if FUNCTION_KEY in t and t[FUNCTION_KEY] is not None:
+            self.functions[i] = t[FUNCTION_KEY]
+        self.dirty[i] = None
+        return row
+
     def set_task(self, t, no_update=False):
-        t = dict(t)
         i = t[ROWNUM_KEY]
-        old_pid = self.rawdata[i]['pid']
-        old_state = self.rawdata[i]['status']
+        old_pid = self.rawdata[i][self.pid_col]
         new_pid = t['pid']
-        new_state = t['status']
-        if old_pid != new_pid and old_pid != None and new_pid != None:
+        if new_pid == '':
+            new_pid = None
+        if old_pid != new_pid and old_pid != None and new_pid != None and int(new_pid) != old_pid:
             raise Exception("A task cannot change its process ID. Attempted from {} to {} for {}.".format(old_pid, new_pid, t['comment']))
-        if old_pid != new_pid:
-            if old_pid in self.pids:
-                del self.pids[old_pid]
-            if new_pid is not None:
-                self.pids[new_pid] = t
-        self.rawdata[i] = t
-        if self.progress is not None:
-            class StringAsFile:
-                def __init__(self):
-                    self.s = None
-
-                def write(self, s):
-                    self.s = s
-
-            f = StringAsFile()
-            w = csv.DictWriter(f, dialect='unix', fieldnames=self.headers)
-            nt = dict(t)
-            del nt[ROWNUM_KEY]
-            if FUNCTION_KEY in nt:
-                del nt[FUNCTION_KEY]
-            w.writerow(nt)
-            self.progress(update_text=f.s, update_fields=t)
+        row = self._store_task(t)
+        if self.events is not None:
+            self.events.task_changed(i)
+        elif self.progress is not None:
+            self.progress(update_text=QRunnerProgress.row_text(row), update_fields=self.get_task(i))
         if no_update is not True:
-            self.update()
+            self.persist()
 
     def set_task_field(self, t, f, d):
         t[f] = d
         self.set_task(t)
 
     def list_pids(self):
-        return list(self.pids.keys())
+        '''Process IDs of the tasks in the visible groups.'''
+        visible = set(self._visible_groups())
+        return [pid for pid, i in self.pids.items() if self.rawdata[i][self.group_col] in visible]
+
+    def persist(self):
+        '''Save the tasks changed since the last save.'''
+        if self.shared is True:
+            if len(self.dirty) > 0:
+                self.storage.save_rows(self, sorted(self.dirty))
+            self.dirty = {}
+            self.needs_rewrite = False
+            return
+        if self.loader is not None and (self.needs_rewrite is True or self.storage.incremental is not True):
+            # Saving everything would lose the tasks not read yet; they are
+            # saved once the whole file has been read.
+            return
+        if self.needs_rewrite is True:
+            self.update()
+            return
+        self.storage.save_rows(self, sorted(self.dirty))
+        self.dirty = {}
 
     def update(self):
-        if self.tasksdb_filename_tmp is None or self.tasksdb_filename is None:
+        '''Save every task, folding any journal back into the tasks file.'''
+        while self.loader is not None:
+            self.load_more()
+        if self.shared is True:
+            self.release()
+            return
+        self.storage.save_all(self)
+        self.dirty = {}
+        self.needs_rewrite = False
+
+    def _replace_row(self, i, row):
+        '''Take in a task as another runner saved it.'''
+        row = self._make_row(list(row))
+        if row == self.rawdata[i]:
             return
+        self._index_remove(i, self.rawdata[i])
+        self.rawdata[i] = row
+        self._index_add(i, row)
+        self.merged[i] = None
+        if row[self.owner_col] != self.owner:
+            self.owned.pop(i, None)
 
-        ld = []
-        for d in self.rawdata:
-            nd = dict(d)
-            del nd[ROWNUM_KEY]
-            if FUNCTION_KEY in nd:
-                del nd[FUNCTION_KEY]
-            if 'function' in nd:
-                raise Exception('Cannot write a tasks CSV database file when some of the tasks are functions, not external commands.')
-            ld.append(nd)
+    def _take_in(self, rows):
+        '''Take in the tasks other runners have saved, other than those changed here and not saved yet.'''
+        for i, row in rows:
+            if i >= self.rawdata_len:
+                self._add_row(row)
+                self.merged[i] = None
+            elif i not in self.dirty:
+                self._replace_row(i, row)
 
-        with open(self.tasksdb_filename_tmp, 'w') as tasksdb_tmp_f:
-            tasksdb_tmp_f.write(self.preservetext)
-            w = csv.DictWriter(tasksdb_tmp_f, dialect='unix', fieldnames=self.headers)
-            w.writeheader()
-            w.writerows(ld)
+    def merged_rownums(self):
+        '''The tasks other runners have changed or added since the last call.'''
+        merged = sorted(self.merged)
+        self.merged = {}
+        return merged
 
-        os.rename(self.tasksdb_filename_tmp, self.tasksdb_filename)
+    def expired(self, i, now=None):
+        '''True if task i was claimed by another runner whose lease has run out, or by no one.'''
+        owner = self.rawdata[i][self.owner_col]
+        if owner is None:
+            return True
+        if owner == self.owner:
+            return False
+        lease = self.get_field(i, 'lease')
+        return lease is None or float(lease) < (now or time.time())
+
+    def claimable(self, i, now=None):
+        '''True if task i is NEW, could be run here and isn't claimed by another runner.'''
+        return (self._status_key(self.rawdata[i][self.status_col]) == 'NEW'
+                and (self.get_field(i, 'command') is not None or i in self.functions)
+                and (self.rawdata[i][self.owner_col] == self.owner or self.expired(i, now)))
+
+    def _own(self, i, now):
+        t = self.get_task(i)
+        t['owner'] = self.owner
+        t['lease'] = '{:.3f}'.format(now + self.lease)
+        self._store_task(t)
+        self.owned[i] = None
+
+    def claim(self, rownums):
+        '''Claim the tasks in rownums that are NEW and not claimed by another runner; returns the rownums claimed.'''
+        now = time.time()
+        claimed = []
+        with self.storage.lock():
+            self._take_in(self.storage.read_rows(self, rownums))
+            for i in rownums:
+                if self.claimable(i, now):
+                    self._own(i, now)
+                    claimed.append(i)
+            self.persist()
+        return claimed
+
+    def refresh(self):
+        '''Take in what other runners have saved, renew the leases of the tasks claimed here and give up on
+        the tasks of runners whose leases have run out.'''
+        now = time.time()
+        with self.storage.lock():
+            self._take_in(self.storage.read_rows(self))
+            for i in list(self.owned):
+                status = self._status_key(self.rawdata[i][self.status_col])
+                if status != 'NEW' and status not in RUNNING_STATUSES:
+                    del self.owned[i]
+                elif float(self.get_field(i, 'lease') or 0) - now < self.lease * 2 / 3:
+                    self._own(i, now)
+            for status in RUNNING_STATUSES + ['NEW']:
+                rownums = [i for g in self.group_index for i in self.status_index.get((status, g), ())]
+                for i in rownums:
+                    if self.rawdata[i][self.owner_col] is None or not self.expired(i, now):
+                        continue
+                    t = self.get_task(i)
+                    if status == 'NEW':
+                        if t['command'] is not None:
+                            continue
+                        t['status'] = 'FAILED'
+                        t['exception'] = "The runner that added this function task, {}, has gone.".format(t['owner'])
+                    else:
+                        t['status'] = 'LOST'
+                    self._store_task(t)
+                    self.merged[i] = None
+            self.persist()
+
+    def release(self):
+        '''Give back the NEW tasks claimed here, so that other runners can have them straight away.'''
+        with self.storage.lock():
+            for i in list(self.owned):
+                if self._status_key(self.rawdata[i][self.status_col]) == 'NEW' and i not in self.functions:
+                    t = self.get_task(i)
+                    t['owner'] = None
+                    t['lease'] = None
+                    self._store_task(t)
+                    del self.owned[i]
+            self.persist()
 
     num_tasks = lambda self: self.rawdata_len
 
     def add_task(self, **kwds):
         '''add_task has the unique ability to take a lambda for the command argument'''
-        t = dict()
-        for k in self.headers:
-            t[k] = None
-        for k, v in kwds.items():
-            if k not in self.headers and k not in ['function']:
-                raise Exception("Unknown field `{}'".format(k))
-            t[k] = v
-        self._add_task(t)
+        if self.shared is True:
+            # Take in the tasks other runners have added first, so that this one gets the next rownum.
+            with self.storage.lock():
+                self._take_in(self.storage.read_rows(self, first=self.rawdata_len))
+                if kwds.get(FUNCTION_KEY) is not None:
+                    # Only this runner can run a function task, so it claims it straight away.
+                    kwds = dict(kwds, owner=self.owner, lease='{:.3f}'.format(time.time() + self.lease))
+                self._add_task_fields(kwds)
+                if kwds.get(FUNCTION_KEY) is not None:
+                    self.owned[self.rawdata_len - 1] = None
+                self.persist()
+            return
+        self._add_task_fields(kwds)
 
-    def _add_task(self, t):
-        d = dict(t)
-        d[ROWNUM_KEY] = self.num_tasks()
-        if d['group'] != None and d['group'] != '':
-            d['group'] = int(d['group'])
-            if d['group'] > 0:
-                myset = set(self.groups)
-                myset.add(d['group'])
-                self.groups = myset
-        else:
-            d['group'] = None
-        if d['pid'] != None and d['pid'] != '':
-            pid = int(d['pid'])
-            d['pid'] = pid
-            if d['group'] is None or d['group'] == '' or d['group'] < 1:
-                self.pids[pid] = d
-        else:
-            d['pid'] = None
-        self.rawdata.append(d)
+    def _add_task_fields(self, kwds):
+        for k in kwds:
+            if k not in self.column and k not in [FUNCTION_KEY]:
+                if k not in OPTIONAL_HEADERS:
+                    raise Exception("Unknown field `{}'".format(k))
+                self.add_column(k)
+        self._add_task(kwds)
+
+    def _set_headers(self, headers):
+        '''Used by the storage before adding any tasks; the standard columns are always there.'''
+        self.headers = list(headers)
+        for h in STANDARD_HEADERS:
+            if h not in self.headers:
+                self.headers.append(h)
+        self.column = {}
+        for j, h in enumerate(self.headers):
+            self.column[h] = j
+        self.status_col = self.column['status']
+        self.group_col = self.column['group']
+        self.pid_col = self.column['pid']
+        if self.shared is True:
+            self.owner_col = self.column.get('owner')
+        self.interned_cols = [self.column[h] for h in INTERNED_HEADERS if h in self.column]
+
+    def add_column(self, name):
+        '''Add a column to the tasks file; existing tasks get a blank value.'''
+        if name in self.column:
+            return
+        if name in [ROWNUM_KEY, FUNCTION_KEY]:
+            raise Exception("`{}' is not a valid field in the CSV file.".format(name))
+        self._set_headers(self.headers + [name])
+        for row in self.rawdata:
+            row.append(None)
+        self.needs_rewrite = True
+
+    def _make_row(self, row):
+        '''Normalise a list of values in header order: blanks become None, group and pid become numbers and repeated strings are interned.'''
+        n = len(self.headers)
+        if len(row) < n:
+            row = row + [None] * (n - len(row))
+        elif len(row) > n:
+            raise Exception("Task {} has {} fields but there are only {} columns.".format(self.rawdata_len, len(row), n))
+        for j, v in enumerate(row):
+            if v == '':
+                row[j] = None
+        if row[self.group_col] is not None:
+            row[self.group_col] = int(row[self.group_col])
+        if row[self.pid_col] is not None:
+            row[self.pid_col] = int(row[self.pid_col])
+        for j in self.interned_cols:
+            if isinstance(row[j], str):
+                row[j] = sys.intern(row[j])
+        return row
+
+    def _add_row(self, row):
+        '''Add a task given as a list of values in header order, without marking it as changed.'''
+        row = self._make_row(list(row))
+        i = self.rawdata_len
+        group = row[self.group_col]
+        if group is not None and group > 0 and group not in self.groups:
+            myset = set(self.groups)
+            myset.add(group)
+            self.groups = myset
+        self.rawdata.append(row)
         self.rawdata_len += 1
+        self._index_add(i, row)
+        return i
+
+    def _add_task(self, t):
+        for k in t:
+            if k not in self.column and k not in [ROWNUM_KEY, FUNCTION_KEY]:
+                raise Exception("Unknown field `{}'".format(k))
+        i = self._add_row([t.get(k) for k in self.headers])
+        if t.get(FUNCTION_KEY) is not None:
+            self.functions[i] = t[FUNCTION_KEY]
+        self.dirty[i] = None
 
     def delete_task(self, t):
         '''This fails if the task being deleted is not the very last task.'''
-        if t[ROWNUM_KEY] != self.rawdata_len:
+        i = t[ROWNUM_KEY]
+        if i != self.rawdata_len - 1:
             raise Exception('Only the most recently added task may be deleted')
         tt = self.rawdata[-1]
-        ttt = dict(t)
-        del ttt[ROWNUM_KEY]
-        if ttt != tt:
+        if self._make_row([t.get(k) for k in self.headers]) != tt:
             raise Exception('Task objects are inconsistent')
-        del ttt
-        del t
+        self._index_remove(i, tt)
         self.rawdata.pop()
-        pid = tt['pid']
-        group = tt['group']
-        del tt
-        if pid is not None:
-            del self.pids[pid]
+        self.rawdata_len -= 1
+        self.functions.pop(i, None)
+        self.dirty.pop(i, None)
+        self.needs_rewrite = True
+        group = tt[self.group_col]
         if group is not None and group > 0:
             if self.get_num_tasks_by_group(group) == 0:
-                self.groups.remove(group)
+                self.groups = [g for g in self.groups if g != group]
                 if self.cur_group == group:
                     self.cur_group = 0
                 if len(self.groups) < 1:
                     self.first_group = 0
                 else:
-                    self.first_group = min(self.group)
-        self.rawdata_len -= 1
+                    self.first_group = min(self.groups)
 
     def delete_all_tasks(self):
+        while self.loader is not None:
+            self.load_more()
         self.pids = {}
+        self.status_index = {}
+        self.group_index = {}
+        self.functions = {}
         self.first_group = 0
         self.groups = [0]
         self.cur_group = 0
         self.rawdata = []
         self.rawdata_len = 0
+        self.dirty = {}
+        self.needs_rewrite = True
+
+def convert(src_filename, dst_filename):
+    '''Copy a tasks database to a new file, e.g. tasks.csv to tasks.sqlite or back again.'''
+    if os.path.exists(dst_filename):
+        raise Exception("`{}' already exists.".format(dst_filename))
+    src = QRunnerTasksDatabase(tasksdb_filename=src_filename)
+    dst = QRunnerTasksDatabase(tasksdb_filename=dst_filename)
+    dst.preservetext = src.preservetext
+    dst._set_headers(src.headers)
+    for i in range(src.num_tasks()):
+        dst._add_task(src.get_task(i))
+    dst.update()
+    dst.storage.close()
+    src.storage.close()
 
 def test():
     with QRunnerTasksDatabase() as tdb:
         pass
+    class NoReading(TasksStorage):
+        def load_chunks(self, tdb, chunk_size):
+            yield
+        def save_all(self, tdb):
+            pass
+    try:
+        NoReading()
+    except TypeError:
+        pass
+    else:
+        raise Exception('A storage without read_rows() should not have been made.')
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        filename = os.path.join(d, 'tasks.csv')
+        with QRunnerTasksDatabase(tasksdb_filename=filename) as tdb:
+            for i in range(4):
+                tdb.add_task(comment='T{}'.format(i), status='NEW', command='true')
+        a = QRunnerTasksDatabase(tasksdb_filename=filename, shared=True, owner='a')
+        b = QRunnerTasksDatabase(tasksdb_filename=filename, shared=True, owner='b', lease=-1)
+        if a.claim([0, 1]) != [0, 1] or b.claim([1, 2]) != [2]:
+            raise Exception('A task was claimed twice')
+        t = a.get_task(0)
+        t['status'] = 'FINISHED'
+        a.set_task(t)
+        b.refresh()
+        if b.get_field(0, 'status') != 'FINISHED' or b.merged_rownums() != [0, 1]:
+            raise Exception("b didn't take in what a did")
+        # b's lease has already run out.
+        if a.claim([2, 3]) != [2, 3]:
+            raise Exception("a couldn't claim b's task once its lease ran out")
 
 def main():
-    test()
+    import argparse
+    parser = argparse.ArgumentParser(description='QRunner tasks database.')
+    subparsers = parser.add_subparsers(dest='action')
+    p = subparsers.add_parser('convert', help='Copy a tasks database between CSV and SQLite files.')
+    p.add_argument('src', help='Existing tasks file, e.g. tasks.csv')
+    p.add_argument('dst', help='New tasks file, e.g. tasks.sqlite')
+    args = parser.parse_args()
+    if args.action == 'convert':
+        convert(args.src, args.dst)
+    else:
+        test()
 
 if __name__ == '__main__':
     sys.exit(main())
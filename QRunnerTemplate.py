@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import sys, os, re, itertools
+
+'''
+Stands for many tasks with one row of the tasks file.
+
+A template is a row with the status TEMPLATE whose command (and comment,
+pwd, inputfile, outputfile, errorfile and depends_on) may name parameters
+in braces, e.g. `ping -c 1 -t 1 {ip}'. Braces that don't name a parameter
+are left alone. Its params column says where the values come from, as
+name=source separated by semicolons:
+
+    ip=file:inputlist.txt       each non-blank line of the file (relative to the tasks file)
+    y=range:1:255               1 to 254 (also range:STOP and range:START:STOP:STEP)
+    x=list:48,49,50,51          the values given
+
+With several parameters there is a task for every combination of their
+values, the last one changing fastest. {index} is the task's number,
+counting from 0. A comment without any parameters gets _ and the index
+added to it, so that each task's comment is its own.
+
+If the template is in a group and has a group_size, its tasks are split up
+between groups: the first group_size are in the template's group, the next
+group_size in the group after, and so on. The other columns (user, host,
+timeout, cpus and so on) are the same for all of them.
+
+QRunner only adds a template's tasks to the tasks file a few at a time, as
+it gets close to running them, and keeps count of how many it has added in
+the template's expanded column; a sweep of a million tasks starts at once,
+and a restarted run carries on from where the last one got to. Once all of
+them have been added, the template's status becomes EXPANDED.
+'''
+
+# Columns of the template whose parameters are filled in for each task
+FORMATTED_HEADERS = ['comment', 'command', 'pwd', 'inputfile', 'outputfile', 'errorfile', 'depends_on']
+
+# Columns each task takes from the template as they are
+INHERITED_HEADERS = ['user', 'host', 'timeout', 'cpus', 'mem_mb', 'slots', 'priority', 'extract', 'output_bytes']
+
+INDEX_PARAM = 'index'
+
+PARAM_RE = re.compile(r"\{(\w+)\}")
+
+class FileSource:
+    '''The non-blank lines of a file, read again each time round.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __iter__(self):
+        with open(self.filename) as f:
+            for line in f:
+                line = line.strip()
+                if line != '':
+                    yield line
+
+def parse_source(source, basedir):
+    kind, _, arg = source.partition(':')
+    if kind == 'file':
+        return FileSource(os.path.join(basedir, arg))
+    if kind == 'range':
+        try:
+            bounds = [int(n) for n in arg.split(':')]
+        except ValueError:
+            bounds = []
+        if len(bounds) < 1 or len(bounds) > 3:
+            raise Exception("`{}' should be range:STOP, range:START:STOP or range:START:STOP:STEP.".format(source))
+        return range(*bounds)
+    if kind == 'list':
+        return arg.split(',')
+    raise Exception("Parameter source `{}' not recognised; expected file:, range: or list:.".format(source))
+
+def parse_params(params, basedir='.'):
+    '''The names and sources of the parameters in a params column, in order.'''
+    names = []
+    sources = []
+    for param in re.split(r"\s*;\s*", (params or '').strip()):
+        if param == '':
+            continue
+        name, eq, source = param.partition('=')
+        name = name.strip()
+        if eq == '' or not re.match(r"^\w+$", name) or name == INDEX_PARAM:
+            raise Exception("Parameter `{}' should be NAME=SOURCE, with a NAME other than `{}'.".format(param, INDEX_PARAM))
+        if name in names:
+            raise Exception("Parameter `{}' is given twice.".format(name))
+        names.append(name)
+        sources.append(parse_source(source.strip(), basedir))
+    if len(names) == 0:
+        raise Exception('A template needs at least one parameter.')
+    return names, sources
+
+def combinations(sources):
+    '''Every combination of the sources' values, the last changing fastest. The first source
+    is gone through once as it is, so it may be as long as it likes; the others are read up front.'''
+    inner = list(itertools.product(*sources[1:]))
+    for value in sources[0]:
+        for values in inner:
+            yield (value,) + values
+
+def fill(text, params):
+    return PARAM_RE.sub(lambda m: str(params[m.group(1)]) if m.group(1) in params else m.group(0), text)
+
+class TaskTemplate:
+    '''The template in row rownum of tdb; basedir is where its parameter files are.'''
+
+    def __init__(self, tdb, rownum, basedir='.'):
+        self.tdb = tdb
+        self.rownum = rownum
+        self.task = tdb.get_task(rownum)
+        if self.task.get('command') is None:
+            raise Exception("Template `{}' has no command.".format(self.task.get('comment')))
+        self.names, self.sources = parse_params(self.task.get('params'), basedir)
+        self.group_size = None
+        if self.task.get('group_size') is not None:
+            self.group_size = int(self.task['group_size'])
+            if self.group_size < 1:
+                raise Exception("Template `{}' has a group_size of {}.".format(self.task.get('comment'), self.group_size))
+        self.expanded = int(self.task.get('expanded') or 0)
+        tdb.add_column('expanded')
+        self.done = False
+        self.values = None
+
+    def group(self, index):
+        '''The group of the task with this index.'''
+        g = self.task['group']
+        if g is None or g <= 0 or self.group_size is None:
+            return g
+        return g + index // self.group_size
+
+    def instance(self, index, values):
+        '''The fields of the task with this index, given its parameters' values.'''
+        params = dict(zip(self.names, values))
+        params[INDEX_PARAM] = index
+        t = {'status': 'NEW', 'group': self.group(index)}
+        for h in FORMATTED_HEADERS:
+            if self.task.get(h) is not None:
+                t[h] = fill(self.task[h], params)
+        if t.get('comment') is not None and t['comment'] == self.task['comment']:
+            t['comment'] = '{}_{}'.format(t['comment'], index)
+        for h in INHERITED_HEADERS:
+            if self.task.get(h) is not None:
+                t[h] = self.task[h]
+        return t
+
+    def expand(self, n):
+        '''Add up to n more of the template's tasks to the database; returns how many were added.'''
+        if self.values is None:
+            self.values = itertools.islice(combinations(self.sources), self.expanded, None)
+        added = 0
+        while added < n:
+            values = next(self.values, None)
+            if values is None:
+                self.done = True
+                break
+            self.tdb.add_task(**self.instance(self.expanded, values))
+            self.expanded += 1
+            added += 1
+        t = self.tdb.get_task(self.rownum)
+        t['expanded'] = str(self.expanded)
+        if self.done is True:
+            t['status'] = 'EXPANDED'
+        self.tdb.set_task(t, no_update=True)
+        return added
+
+def test():
+    import tempfile, QRunnerTasksDatabase
+    with tempfile.TemporaryDirectory() as d:
+        with open(os.path.join(d, 'hosts.txt'), 'w') as f:
+            f.write('a\n\nb\nc\n')
+        tdb = QRunnerTasksDatabase.QRunnerTasksDatabase(tasksdb_filename=None)
+        tdb.add_task(comment='PING_{host}_{n}', status='TEMPLATE', command="ping {host}.{n} | awk '{print $1}'", group=3,
+                     params='host=file:hosts.txt; n=range:1:3', group_size=4, timeout='5')
+        template = TaskTemplate(tdb, 0, d)
+        if template.expand(5) != 5 or template.done is True:
+            raise Exception('Expected 5 of the 6 tasks to be added.')
+        # Carry on from the expanded column, as a restarted run would.
+        template = TaskTemplate(tdb, 0, d)
+        if template.expand(5) != 1 or template.done is False:
+            raise Exception('Expected the last task to be added.')
+        tasks = [tdb.get_task(i) for i in range(tdb.num_tasks())]
+        if [t['comment'] for t in tasks[1:]] != ['PING_a_1', 'PING_a_2', 'PING_b_1', 'PING_b_2', 'PING_c_1', 'PING_c_2']:
+            raise Exception('Unexpected comments {}'.format([t['comment'] for t in tasks]))
+        if [t['group'] for t in tasks[1:]] != [3, 3, 3, 3, 4, 4] or tasks[1]['command'] != "ping a.1 | awk '{print $1}'":
+            raise Exception('Unexpected tasks {}'.format(tasks))
+        if tasks[0]['status'] != 'EXPANDED' or tasks[0]['expanded'] != '6' or tasks[6]['timeout'] != '5':
+            raise Exception('Unexpected template {}'.format(tasks[0]))
+        names, sources = parse_params('x=list:48,49; y=range:1:255')
+        if sum(1 for _ in combinations(sources)) != 2 * 254:
+            raise Exception('Expected 508 combinations.')
+        for params in ['', 'index=list:1', 'x=range:a', 'x=seq:1:2']:
+            try:
+                parse_params(params)
+            except Exception:
+                continue
+            raise Exception("`{}' should not have been accepted.".format(params))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+import sys, os, io, signal, threading, traceback, pickle, tempfile
+
+from multiprocessing import Pipe
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Runs function tasks on a pool of long-lived workers instead of forking a
+new child for every task.
+
+ProcessPool forks its workers lazily and each one runs one task at a time.
+A worker finds the function in the copy of the tasks database it inherited
+when it was forked; a task added after that gets a freshly forked worker.
+The worker's stdin, stdout and stderr are pointed at the task's files (and
+it changes to the task's directory) while the task runs, and the return
+value is pickled back to the coordinator. Killing a worker (e.g. when its
+task times out) ends its task and the pool forks a replacement.
+
+ThreadPool runs them on threads, which suits callables that mostly wait on
+I/O. Threads share the process, so sys.stdin, sys.stdout and sys.stderr are
+redirected per thread (output written straight to file descriptors 1 and 2
+isn't), the task's directory isn't changed into and tasks can't be killed.
+
+A file name of None leaves that stream as it is, and CAPTURE collects it
+and hands it back with the results. Both pools hold at most one task per
+worker; submit() refuses any more, so the caller keeps the rest queued as
+NEW tasks. Results come back from completed() as (rownum, pid, status,
+result, exception, output) where status is a wait status as returned by
+os.waitpid, so it can be handled like a command's, and output is a tuple of
+the captured stdout and stderr as bytes (None if not captured).
+'''
+
+# Pass as outputfile or errorfile to get the output back from completed()
+CAPTURE = -1
+
+def exit_status(code):
+    '''The wait status of a process that exited with code.'''
+    return (code & 0xff) << 8
+
+def call_task(function):
+    '''Call a task function and return (exit code, result, exception).
+
+    Returning an int sets the exit code, as it does for a forked function
+    task; any other value is kept as the result.'''
+    try:
+        result = function()
+    except SystemExit as e:
+        result = e.code
+        if result is not None and not isinstance(result, int):
+            print(result, file=sys.stderr)
+            return (1, None, None)
+    except BaseException as e:
+        traceback.print_exc()
+        return (1, None, "{}: {}".format(type(e).__name__, e))
+    if result is None:
+        return (0, None, None)
+    if isinstance(result, int) and not isinstance(result, bool):
+        return (result, None, None)
+    return (0, result, None)
+
+def _picklable(result):
+    try:
+        pickle.dumps(result)
+    except Exception:
+        return repr(result)
+    return result
+
+class _Worker:
+
+    def __init__(self, pool):
+        self.rownum = None
+        # Tasks are only ever added, so every function up to here was inherited.
+        self.known = max(pool.functions, default=-1) + 1
+        job_r, self.job_w = Pipe(duplex=False)
+        self.result_r, result_w = Pipe(duplex=False)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                # Let go of the other workers' pipes so they see EOF when the coordinator closes them.
+                for w in pool.workers.values():
+                    w.job_w.close()
+                    w.result_r.close()
+                self.job_w.close()
+                self.result_r.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                self.serve(pool.functions, job_r, result_w)
+            finally:
+                os._exit(0)
+        job_r.close()
+        result_w.close()
+
+    def serve(self, functions, job_r, result_w):
+        while True:
+            try:
+                rownum, pwd, inputfile, outputfile, errorfile = job_r.recv()
+            except EOFError:
+                return
+            sys.stdout.flush()
+            sys.stderr.flush()
+            saved = [os.dup(fd) for fd in [0, 1, 2]]
+            captured = [None, None, None]
+            cwd = os.getcwd()
+            try:
+                for fd, name, flags in [(0, inputfile, os.O_RDONLY),
+                                        (1, outputfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC),
+                                        (2, errorfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)]:
+                    if name == CAPTURE:
+                        captured[fd] = tempfile.TemporaryFile()
+                        os.dup2(captured[fd].fileno(), fd)
+                    elif name is not None:
+                        f = os.open(name, flags, 0o666)
+                        os.dup2(f, fd)
+                        os.close(f)
+                if pwd is not None:
+                    os.chdir(pwd)
+                rc, result, exception = call_task(functions[rownum])
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os.chdir(cwd)
+                for fd in [0, 1, 2]:
+                    os.dup2(saved[fd], fd)
+                    os.close(saved[fd])
+            output = None
+            if captured[1] is not None or captured[2] is not None:
+                output = []
+                for f in captured[1:]:
+                    if f is None:
+                        output.append(None)
+                    else:
+                        f.seek(0)
+                        output.append(f.read())
+                        f.close()
+                output = tuple(output)
+            result_w.send((rownum, exit_status(rc), _picklable(result), exception, output))
+
+    def close(self):
+        self.job_w.close()
+        self.result_r.close()
+
+class ProcessPool:
+
+    def __init__(self, functions, workers=None, reaper=None):
+        '''functions maps rownums to callables (QRunnerTasksDatabase.functions); reaper is used to wake up poll() when a task ends.'''
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.functions = functions
+        self.max_workers = workers
+        self.reaper = reaper
+        self.workers = {}
+        self.idle = []
+        self.done = []
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def free(self):
+        '''How many more tasks can be submitted now.'''
+        return self.max_workers - sum(1 for w in self.workers.values() if w.rownum is not None)
+
+    def _spawn(self):
+        w = _Worker(self)
+        self.workers[w.pid] = w
+        if self.reaper is not None:
+            self.reaper.watch(w.result_r.fileno(), lambda fd, w=w: self._readable(w))
+        return w
+
+    def _retire(self, w):
+        del self.workers[w.pid]
+        if w in self.idle:
+            self.idle.remove(w)
+        if self.reaper is not None:
+            self.reaper.unwatch(w.result_r.fileno())
+        w.close()
+        if w.rownum is None:
+            # Exits on its own once it sees EOF.
+            try:
+                os.waitpid(w.pid, 0)
+            except ChildProcessError:
+                pass
+
+    def submit(self, rownum, pwd=None, inputfile=None, outputfile=None, errorfile=None):
+        '''Start a task on an idle worker; returns the worker's process ID, or None if every worker is busy.'''
+        if self.free() <= 0:
+            return None
+        w = None
+        while len(self.idle) > 0:
+            w = self.idle.pop()
+            if rownum < w.known:
+                break
+            # Forked before this task was added, so it doesn't have its function.
+            self._retire(w)
+            w = None
+        if w is None:
+            if len(self.workers) >= self.max_workers:
+                return None
+            w = self._spawn()
+        w.rownum = rownum
+        w.job_w.send((rownum, pwd, inputfile, outputfile, errorfile))
+        return w.pid
+
+    def _readable(self, w):
+        try:
+            rownum, status, result, exception, output = w.result_r.recv()
+        except (EOFError, OSError):
+            # The worker died, most likely killed because its task ran too long.
+            rownum = w.rownum
+            self._retire(w)
+            w.rownum = None
+            try:
+                pid, status = os.waitpid(w.pid, 0)
+            except ChildProcessError:
+                status = exit_status(255)
+            if rownum is not None:
+                self.done.append((rownum, w.pid, status, None, None, None))
+            return
+        w.rownum = None
+        self.idle.append(w)
+        self.done.append((rownum, w.pid, status, result, exception, output))
+
+    def completed(self):
+        '''Tasks that have ended since the last call, as (rownum, pid, status, result, exception, output).'''
+        done = self.done
+        self.done = []
+        return done
+
+    def close(self):
+        for w in list(self.workers.values()):
+            if w.rownum is not None:
+                os.kill(w.pid, signal.SIGKILL)
+                w.rownum = None
+            self._retire(w)
+
+class _ThreadStdio:
+    '''Stands in for sys.stdin, sys.stdout or sys.stderr and sends each thread to its own file, if it has one.'''
+
+    def __init__(self, original):
+        self.original = original
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, 'f', None) or self.original
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def write(self, s):
+        return self._target().write(s)
+
+class ThreadPool:
+
+    def __init__(self, functions, workers=None, reaper=None):
+        if workers is None:
+            workers = 32
+        self.functions = functions
+        self.max_workers = workers
+        self.reaper = reaper
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.running = 0
+        self.lock = threading.Lock()
+        self.done = []
+        self.notify_r, self.notify_w = os.pipe()
+        os.set_blocking(self.notify_r, False)
+        os.set_blocking(self.notify_w, False)
+        if self.reaper is not None:
+            self.reaper.watch(self.notify_r, self._readable)
+        self.stdio = [_ThreadStdio(sys.stdin), _ThreadStdio(sys.stdout), _ThreadStdio(sys.stderr)]
+        sys.stdin, sys.stdout, sys.stderr = self.stdio
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def free(self):
+        return self.max_workers - self.running
+
+    def _run(self, rownum, inputfile, outputfile, errorfile):
+        files = []
+        captured = [None, None, None]
+        try:
+            for i, (stdio, name, mode) in enumerate(zip(self.stdio, [inputfile, outputfile, errorfile], ['r', 'w', 'w'])):
+                if name == CAPTURE:
+                    captured[i] = io.StringIO()
+                    stdio.local.f = captured[i]
+                elif name is not None:
+                    f = open(name, mode)
+                    files.append(f)
+                    stdio.local.f = f
+            rc, result, exception = call_task(self.functions[rownum])
+        finally:
+            for stdio in self.stdio:
+                stdio.local.f = None
+            for f in files:
+                f.close()
+        output = None
+        if captured[1] is not None or captured[2] is not None:
+            output = tuple(None if f is None else f.getvalue().encode() for f in captured[1:])
+        with self.lock:
+            self.done.append((rownum, None, exit_status(rc), result, exception, output))
+        try:
+            os.write(self.notify_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def submit(self, rownum, pwd=None, inputfile=None, outputfile=None, errorfile=None):
+        '''Start a task on a thread; returns True, or None if every thread is busy. pwd is ignored.'''
+        if self.free() <= 0:
+            return None
+        self.running += 1
+        self.executor.submit(self._run, rownum, inputfile, outputfile, errorfile)
+        return True
+
+    def _readable(self, fd):
+        try:
+            while os.read(self.notify_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def completed(self):
+        with self.lock:
+            done = self.done
+            self.done = []
+        self.running -= len(done)
+        return done
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        sys.stdin, sys.stdout, sys.stderr = [s.original for s in self.stdio]
+        if self.reaper is not None:
+            self.reaper.unwatch(self.notify_r)
+        os.close(self.notify_r)
+        os.close(self.notify_w)
+
+def test():
+    for Pool in [ProcessPool, ThreadPool]:
+        functions = {0: lambda: print('hello'), 1: lambda: {'answer': 42}, 2: lambda: 3, 3: lambda: 1 / 0}
+        with tempfile.TemporaryDirectory() as d, Pool(functions, workers=2) as pool:
+            done = {}
+            for rownum in range(4):
+                while pool.submit(rownum, outputfile=os.path.join(d, '{}.out'.format(rownum)),
+                                  errorfile=CAPTURE) is None:
+                    for c in pool.completed():
+                        done[c[0]] = c
+                    if isinstance(pool, ProcessPool):
+                        for w in list(pool.workers.values()):
+                            if w.rownum is not None:
+                                pool._readable(w)
+            while len(done) < 4:
+                for c in pool.completed():
+                    done[c[0]] = c
+                if isinstance(pool, ProcessPool):
+                    for w in list(pool.workers.values()):
+                        if w.rownum is not None:
+                            pool._readable(w)
+            with open(os.path.join(d, '0.out')) as f:
+                if f.read() != 'hello\n':
+                    raise Exception("{}: output was not redirected".format(Pool.__name__))
+            if done[1][3] != {'answer': 42} or done[2][2] != exit_status(3) or done[3][4] is None or b'ZeroDivisionError' not in done[3][5][1]:
+                raise Exception("{}: wrong results {}".format(Pool.__name__, done))
+
+def main():
+    test()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,13 +8,16 @@ echo The command is: ping -c 1 -t 1 10.20.c.d
 echo -n Generating list..." "
 mkdir -p $TEMPDIR
 find $TEMPDIR -maxdepth 1 \( -name \*.in.txt -or -name \*.out.txt -or -name \*.err.txt \) -exec rm -f '{}' ';'
-for x in `seq 48 51`; do for y in `seq 1 254`; do echo TASK_10.20.$x.$y,NEW,,,ping -c 1 -t 1 10.20.$x.$y,,,,$TEMPDIR; done; done > tasks.csv
-echo done. Number of lines:$(wc -l tasks.csv)
+# QRunner picks the address and time of any reply out of the output as it
+# comes, into columns of tasks.csv, and keeps none of the output itself.
+echo comment,status,pid,rc,command,group,user,host,pwd,inputfile,outputfile,errorfile,exception,params,extract,output_bytes > tasks.csv
+echo TASK_10.20.{x}.{y},TEMPLATE,,,ping -c 1 -t 1 10.20.{x}.{y},,,,$TEMPDIR,,,,,'"x=range:48:52;y=range:1:255",64 bytes from (?P<address>[0-9.]+):.*time=(?P<time_ms>[0-9.]+),0' >> tasks.csv
+echo done. QRunner adds the tasks as it goes.
 echo The CSV file looks like this:
-head -2 tasks.csv
+cat tasks.csv
 
-./QRunner.py
+./QRunner.py tasks.csv --max-tasks 256
 
-echo QRunner is done. Now going to grep for any successful pings. Showing first 10 lines:
+echo QRunner is done. The first 10 successful pings in tasks.csv:
 
-find $TEMPDIR -name \*.txt -exec grep '64 bytes' '{}' ';' | head -10 | awk '{print $4 " " $7 }'
+python3 -c 'import csv; [print(t["address"], "time=" + t["time_ms"]) for t in csv.DictReader(l for l in open("tasks.csv") if l.strip() and not l.startswith("#")) if t.get("time_ms")]' | head -10
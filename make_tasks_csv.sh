@@ -14,21 +14,14 @@ fi
 
 OUTPUTFILE="tasks.csv"
 
-echo -n > "$OUTPUTFILE"
-
 TEMPLATE="ping -c 1 -t 1"
 
-counter=0
-grp=1
-while read hosttest; do
-	counter=$(($counter + 1))
-	if [ $counter -gt 510 ]; then
-		counter=1
-		grp=$(($grp + 1))
-	fi
-	echo TASK_"$grp"_"$counter"_"$hosttest",NEW,,,"$TEMPLATE $hosttest",$grp >> "$OUTPUTFILE"
-done < "$INPUTFILE"
+# One template row stands for a task per line of the input list, 510 to a group.
+echo comment,status,pid,rc,command,group,user,host,pwd,inputfile,outputfile,errorfile,exception,params,group_size > "$OUTPUTFILE"
+echo TASK_{index}_{hosttest},TEMPLATE,,,"$TEMPLATE {hosttest}",1,,,,,,,,hosttest=file:"$INPUTFILE",510 >> "$OUTPUTFILE"
 
-echo Sample generated CSV file '`'"$OUTPUTFILE""'":
-head -5 "$OUTPUTFILE"
-echo You can run ./QRunner.py now.
+echo Generated CSV file '`'"$OUTPUTFILE""'":
+cat "$OUTPUTFILE"
+echo You can run ./QRunner.py "$OUTPUTFILE" now.
+echo For very large lists, copy it into SQLite first with:
+echo ./QRunnerTasksDatabase.py convert "$OUTPUTFILE" tasks.sqlite